@@ -0,0 +1,188 @@
+# ASU CSE 591
+# Author: Group 4
+
+import asyncio
+import time
+
+import aiohttp
+
+from instagram import InstagramClient, PrivateUserException, record_response
+from telemetry import telemetry
+
+class TokenBucket:
+    '''Token bucket limiting the request rate. It refills continuously at
+    rate tokens per second, and is corrected by the rate limit headers of
+    every response so that the crawler spends the API budget evenly instead
+    of stalling once it runs low.
+    '''
+    def __init__(self, rate, capacity, reserve=0):
+        self.rate = rate
+        self.capacity = capacity
+        self.reserve = reserve
+        self.tokens = capacity
+        self.updated = None
+
+    def refill(self, now):
+        if self.updated is not None:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        '''Waits until a token is available and takes it.'''
+        loop = asyncio.get_running_loop()
+        while True:
+            self.refill(loop.time())
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def update(self, limit, remaining, window):
+        '''Resynchronizes the bucket with the server's view of the budget.
+        limit: Requests allowed per window.
+        remaining: Requests left in the current window.
+        window: Length of the rate limit window in seconds.
+        '''
+        self.capacity = max(1, limit - self.reserve)
+        self.rate = float(limit) / window
+        self.tokens = min(self.tokens, remaining - self.reserve)
+
+    def drain(self):
+        self.tokens = min(self.tokens, 0)
+
+class AsyncInstagramClient:
+    '''asyncio counterpart of InstagramClient. All requests share one
+    keep-alive connection pool, at most `concurrency` of them are in flight
+    at once, and a token bucket fed by the x-ratelimit-* headers paces them.
+    Use as `async with AsyncInstagramClient(...) as client:`.
+    '''
+    api_base = InstagramClient.api_base
+    recent_count = InstagramClient.recent_count
+    throttle_threshold = InstagramClient.throttle_threshold
+    rate_limit = 5000
+    rate_window = 3600
+
+    def __init__(self, client_id, verbose=False, concurrency=10, timeout=30):
+        self.client_id = client_id
+        self.verbose = verbose
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.bucket = TokenBucket(float(self.rate_limit) / self.rate_window,
+            self.rate_limit, self.throttle_threshold)
+        self.session = None
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.concurrency, keepalive_timeout=60)
+        self.session = aiohttp.ClientSession(connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def safe_access(self, jsn, alt, *args):
+        return InstagramClient.safe_access(self, jsn, alt, *args)
+
+    async def api_request(self, endpoint, params=None):
+        '''Sends an Instagram API request once the rate limiter allows it.
+        endpoint: The Instagram API endpoint.
+        params: Additional HTTP GET parameters for the request.
+        returns: A tuple containing the response code and the
+            JSON document containing the response data.
+        '''
+        url = self.api_base + endpoint if endpoint.startswith('/') else '{0}/{1}'.format(self.api_base, endpoint)
+        params = dict(params or {})
+        params['client_id'] = self.client_id
+        waited = time.time()
+        await self.bucket.acquire()
+        waited = time.time() - waited
+        telemetry.incr('api.throttle_seconds', waited)
+        telemetry.observe('api.bucket_wait_seconds', waited)
+        async with self.semaphore:
+            start = time.time()
+            async with self.session.get(url, params=params) as resp:
+                content = await resp.json(content_type=None)
+                status = resp.status
+                headers = resp.headers
+                path = str(resp.url)[len(self.api_base):]
+        code = int(self.safe_access(content, status, 'meta', 'code'))
+        remaining = headers.get('x-ratelimit-remaining', '')
+        record_response(endpoint, code, time.time() - start, int(remaining) if remaining.isdigit() else None)
+        telemetry.set('api.bucket_tokens', self.bucket.tokens)
+        if self.verbose:
+            print(str(code) + " " + path)
+        self.on_rate_headers(status, headers)
+        return code, content
+
+    def on_rate_headers(self, status, headers):
+        if status == 429:
+            if self.verbose:
+                print("Rate limited, draining token bucket...")
+            telemetry.incr('api.throttles')
+            self.bucket.drain()
+            return
+        try:
+            limit = int(headers.get('x-ratelimit-limit', self.rate_limit))
+            remaining = int(headers['x-ratelimit-remaining'])
+        except (KeyError, ValueError):
+            return
+        self.bucket.update(limit, remaining, self.rate_window)
+
+    async def recent(self, user_id, max_id=None, min_id=None):
+        '''Requests the recent media posts of the given user.
+        user_id: The ID of the target user.
+        max_id: Controls where the returned media will start,
+            as per the Instagram API.
+        min_id: Only media newer than this media ID is returned.
+        returns: An async generator of tuples consisting of a page
+            of media and the max_id that will return the next page.
+        '''
+        path = '/users/{0}/media/recent'.format(user_id)
+        params = {'count': str(self.recent_count)}
+        if max_id is not None:
+            params['max_id'] = str(max_id)
+        if min_id is not None:
+            params['min_id'] = str(min_id)
+        while True:
+            code, content = await self.api_request(path, params)
+            if code == 400:
+                raise PrivateUserException(user_id)
+            if code != 200:
+                raise Exception('Unable to retrieve recent media for user {0} [Code {1}].'.format(user_id, code))
+
+            next_max_id = self.safe_access(content, None, 'pagination', 'next_max_id')
+            yield content['data'], next_max_id
+            if next_max_id is None:
+                return
+            params['max_id'] = next_max_id
+
+    async def followers(self, user_id):
+        '''Requests the user's followers.
+        user_id: The ID of the target user.
+        returns: An async generator of followers.
+        '''
+        code, content = await self.api_request('/users/{0}/followed-by'.format(user_id))
+        if code == 400:
+            raise PrivateUserException(user_id)
+        if code != 200:
+            raise Exception('Unable to retrieve followers for user {0} [Code {1}].'.format(user_id, code))
+        for follower in content['data']:
+            yield follower
+
+    async def search(self, lat, lng):
+        '''Requests recent media from the specified location.
+        lat: The latitude.
+        lng: The longitude.
+        returns: An async generator of media.
+        '''
+        code, content = await self.api_request('/media/search', {'lat': lat, 'lng': lng})
+        if code != 200:
+            raise Exception('Unable to perform search [Code {0}]'.format(code))
+        for media in content['data']:
+            yield media
@@ -3,26 +3,209 @@
 # ASU CSE 591
 # Author: Group 4
 
+import asyncio
 import os
 import pwd
 import signal
+import socket
 import sys
+import threading
+import time
 import traceback
 from collections import deque
-from random import sample
-from datetime import datetime
+from random import sample, shuffle
+from datetime import datetime, timedelta
 
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 
 from models import *
 from instagram import *
+from writer import BulkWriter
+from seen import SeenSet, BloomFilter, load_seen_set
+from async_instagram import AsyncInstagramClient
+from telemetry import telemetry, COUNT_BUCKETS, JsonLinesReporter, MetricsServer
+
+class DequeFrontier:
+    '''In-process frontier holding at most queue_size user ID's.'''
+    def __init__(self, queue_size=5000):
+        self.queue = deque(maxlen=queue_size)
+
+    def __len__(self):
+        return len(self.queue)
+
+    def popleft(self):
+        return self.queue.popleft()
+
+    def extend(self, user_ids):
+        self.queue.extend(user_ids)
+
+    def space(self):
+        return self.queue.maxlen - len(self.queue)
+
+    def finish(self, user_id):
+        pass
+
+    def attach(self, writer):
+        pass
+
+    def pending(self):
+        '''Whether users may still be added by another crawler; never, for a local queue.'''
+        return False
+
+class DatabaseFrontier:
+    '''Frontier shared by several workers through the frontier table. Each
+    worker claims users in batches, so a user is fetched by exactly one
+    worker, and successors are deduplicated by the table's primary key.
+    '''
+    def __init__(self, session, worker, batch_size=10, poll_interval=1.0, stale_after=timedelta(hours=1)):
+        '''poll_interval: Seconds between claims while the frontier is empty.
+        stale_after: Time after which an unfinished claim of a worker that
+            died is returned to the frontier.
+        '''
+        self.session = session
+        self.worker = worker
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.stale_after = stale_after
+        self.claimed = deque()
+        self.next_claim = 0.0
+        self.in_progress = 0
+        self.writer = None
+
+    def __len__(self):
+        # Claim lazily so that an empty local batch does not end the crawl
+        # while other workers are still adding to the shared frontier.
+        if len(self.claimed) == 0 and time.time() >= self.next_claim:
+            self.claimed.extend(claim_users(self.session, self.worker, self.batch_size))
+            if len(self.claimed) == 0:
+                self.next_claim = time.time() + self.poll_interval
+                release_stale_claims(self.session, self.stale_after)
+                self.in_progress = count_in_progress(self.session)
+        return len(self.claimed)
+
+    def popleft(self):
+        if len(self) == 0:
+            raise IndexError('pop from an empty frontier')
+        return self.claimed.popleft()
+
+    def attach(self, writer):
+        '''Routes frontier changes through the crawler's BulkWriter, so that
+        they commit in the same transaction as the users' rows.
+        '''
+        self.writer = writer
+
+    def extend(self, user_ids):
+        self.writer.enqueue(user_ids)
+
+    def space(self):
+        return sys.maxsize
+
+    def finish(self, user_id):
+        # Removed only once the user's media is written, so a crash before
+        # the flush leaves the user claimed, and release_stale_claims returns it.
+        self.writer.finish(user_id)
+
+    def pending(self):
+        '''Whether, at the last empty claim, users claimed by some worker were
+        still unfinished and so may yet add successors.
+        '''
+        return self.in_progress > 0
+
+class RandomScheduler:
+    '''Picks successors uniformly at random.'''
+    def select(self, user, candidates, limit):
+        if len(candidates) > limit:
+            return sample(candidates, limit)
+        return candidates
+
+class YieldScheduler:
+    '''Picks the successors expected to yield the most geotagged media per
+    API call. A candidate's geotagged fraction is estimated from its own
+    stored counts, shrunk towards the fraction of the user it was found
+    through (followers of geotaggers tend to geotag), and discounted if the
+    candidate was crawled recently. The parent's fraction stands in for the
+    location density around the seed: the density of a seed's neighbourhood
+    is not stored, whereas the parent's counts are already in the users table.
+    '''
+    def __init__(self, session, prior_strength=20.0, staleness=timedelta(days=30)):
+        '''prior_strength: How many media the parent's fraction is worth.
+        staleness: Time after which a crawled user is worth a full revisit.
+        '''
+        self.session = session
+        self.prior_strength = prior_strength
+        self.staleness = staleness
+
+    def geotag_fraction(self, media_count, geotagged_count, prior):
+        return (geotagged_count + self.prior_strength * prior) / (media_count + self.prior_strength)
+
+    def expected_yield(self, stats, prior, now):
+        if stats is None:
+            return prior
+        media_count, geotagged_count, last_crawled = stats
+        estimate = self.geotag_fraction(media_count or 0, geotagged_count or 0, prior)
+        if last_crawled is not None:
+            estimate *= min(1.0, (now - last_crawled).total_seconds() / self.staleness.total_seconds())
+        return estimate
+
+    def select(self, user, candidates, limit):
+        if len(candidates) <= limit:
+            return candidates
+        # The parent's own fraction, shrunk towards an uninformative 0.5.
+        prior = self.geotag_fraction(user.media_count or 0, user.geotagged_count or 0, 0.5)
+        stats = user_stats(self.session, candidates)
+        now = datetime.utcnow()
+        # Shuffle first so that ties, e.g. among never-seen users, are broken at random.
+        candidates = list(candidates)
+        shuffle(candidates)
+        candidates.sort(key=lambda c: self.expected_yield(stats.get(c), prior, now), reverse=True)
+        return candidates[:limit]
+
+class RefreshPolicy:
+    '''Schedules when a fully scraped user is next refreshed, from how
+    often the user posts: the interval is the time the user takes to post
+    target_new_media media, clamped to [min_interval, max_interval]. A
+    refresh that finds nothing doubles the previous interval.
+    '''
+    def __init__(self, target_new_media=20, min_interval=timedelta(days=1), max_interval=timedelta(days=60)):
+        self.target_new_media = target_new_media
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+
+    def next_refresh(self, user, activity, now):
+        '''user: The User, with last_crawled and next_refresh from the previous crawl.
+        activity: (media seen, start of the period they were posted in).
+        returns: The time of the next refresh.
+        '''
+        count, start = activity
+        span = (now - start).total_seconds() if start is not None else 0
+        if count == 0 or span <= 0:
+            if user.last_crawled is not None and user.next_refresh is not None:
+                interval = 2 * (user.next_refresh - user.last_crawled)
+            else:
+                interval = self.min_interval
+        else:
+            interval = timedelta(seconds=self.target_new_media * span / count)
+        return now + max(self.min_interval, min(self.max_interval, interval))
 
 class Crawler:
-    def __init__(self, session, max_branching=5, queue_size=5000, max_except=10):
+    def __init__(self, session, max_branching=5, queue_size=5000, max_except=10, frontier=None, seen=None,
+            scheduler=None):
         self.session = session
         self.max_branching = max_branching
-        self.queue = deque(maxlen=queue_size) # Queue contains user ID's not User objects
+        # Queue contains user ID's not User objects
+        self.queue = frontier if frontier is not None else DequeFrontier(queue_size)
         self.max_except = max_except
+        self.writer = BulkWriter(session)
+        self.queue.attach(self.writer)
+        # Without a persisted filter only this run's users are deduplicated.
+        self.seen = seen if seen is not None else SeenSet(BloomFilter(queue_size))
+        self.scheduler = scheduler if scheduler is not None else RandomScheduler()
+        self.refresh_policy = RefreshPolicy()
+        # In refresh mode only new media of fully scraped users is fetched.
+        self.refresh = False
+        self.activity = {}
+        # Per user being crawled: [start time, geotagged media stored].
+        self.crawl_stats = {}
         self.stop = False
 
     def on_except(self):
@@ -32,22 +215,43 @@ class Crawler:
             sys.stderr.write('Stopping due to exceptions...\n\n')
             self.stop = True
 
+    def on_integrity_error(self, e):
+        # Duplicate keys are absorbed by the BulkWriter's ON CONFLICT clauses, so this
+        # now means a constraint such as a foreign key failed during a flush.
+        # We will count down self.max_except, but we also need to rollback the session
+        # or else it will throw an exception on every subsequence call.
+        sys.stderr.write('IntegrityError: {0} {1}\n\n'.format(e.statement, e.params))
+        telemetry.incr('errors.IntegrityError')
+        self.session.rollback()
+        self.on_except()
+
+    def on_error(self):
+        telemetry.incr('errors.' + sys.exc_info()[0].__name__)
+        traceback.print_exc(file=sys.stderr)
+        sys.stderr.write('\n')
+        # Any failed statement, e.g. an OperationalError on a dropped connection,
+        # leaves the session unusable until it is rolled back.
+        if isinstance(sys.exc_info()[1], SQLAlchemyError):
+            self.session.rollback()
+        self.on_except()
+
     def attempt(self, func):
         try:
             func()
         except IntegrityError as e:
-            # This happens when another crawler adds an object to the database between
-            # the time that this crawler queries to see if an object with that id exists
-            # in the database and the time that the object is added to the database.
-            # We will count down self.max_except, but we also need to rollback the session
-            # or else it will throw an exception on every subsequence call.
-            sys.stderr.write('IntegrityError: {0} {1}\n\n'.format(e.statement, e.params))
-            self.session.rollback()
-            self.on_except()
+            self.on_integrity_error(e)
         except:
-            traceback.print_exc(file=sys.stderr)
-            sys.stderr.write('\n')
-            self.on_except()
+            self.on_error()
+
+    async def attempt_async(self, func):
+        try:
+            await func()
+        except IntegrityError as e:
+            self.on_integrity_error(e)
+        except asyncio.CancelledError:
+            raise
+        except:
+            self.on_error()
 
     def run(self):
         '''Crawls the target site by performing a hybrid breadth-first/depth-first
@@ -55,30 +259,106 @@ class Crawler:
         Assumes the crawler has already been seeded.
         '''
         self.stop = False
-        while len(self.queue) > 0 and not self.stop:
+        while not self.stop:
+            if len(self.queue) == 0:
+                # Other workers sharing the frontier may still be about to branch.
+                if not self.queue.pending():
+                    break
+                self.flush_idle()
+                time.sleep(0.1)
+                continue
             user_id = self.queue.popleft()
-            user = self.session.query(User).get(user_id)
-            if user is None:
-                user = User(id=user_id)
-                self.session.add(user)
+            if self.skip_done(user_id):
+                continue
+            user = self.load_user(user_id)
             self.attempt(lambda: self.scrape(user))
             self.attempt(lambda: self.branch(user))
-            self.attempt(lambda: self.session.commit())
+            self.finish_user(user)
+        self.attempt(self.writer.flush)
+
+    def flush_idle(self):
+        '''Flushes while waiting on the frontier, since the users still in
+        progress may be this crawler's own, finished but not yet written.
+        '''
+        if self.writer.pending() > 0:
+            self.attempt(self.writer.flush)
+
+    def skip_done(self, user_id):
+        '''Skips users known to be fully scraped or private before any
+        database or API work is done for them.
+        '''
+        if self.refresh or not self.seen.is_done(user_id):
+            return False
+        telemetry.incr('users.skipped_done')
+        self.attempt(lambda: self.queue.finish(user_id))
+        return True
+
+    def finish_user(self, user):
+        now = datetime.utcnow()
+        start, geotagged = self.crawl_stats.pop(user.id, (time.time(), 0))
+        telemetry.incr('users.crawled')
+        if user.private:
+            telemetry.incr('users.private')
+        telemetry.observe('user.crawl_seconds', time.time() - start)
+        telemetry.observe('user.geotagged', geotagged, COUNT_BUCKETS)
+        activity = self.activity.pop(user.id, None)
+        if user.fully_scraped and not user.private and (activity is not None or user.next_refresh is None):
+            user.next_refresh = self.refresh_policy.next_refresh(user, activity or (0, None), now)
+        user.last_crawled = now
+        self.attempt(lambda: self.queue.finish(user.id))
+        self.seen.visit(user)
+        self.writer.add_user(user)
+        self.attempt(self.writer.maybe_flush)
+
+    def load_user(self, user_id):
+        '''Returns the User with the given ID, detached from the session so
+        that its state is only ever written by the BulkWriter. The user is
+        registered with the writer before any of its media.
+        '''
+        self.crawl_stats[user_id] = [time.time(), 0]
+        with telemetry.timer('db.load_user_seconds'):
+            user = self.session.query(User).get(user_id)
+        if user is None:
+            user = User(id=user_id)
+        else:
+            self.session.expunge(user)
+        self.writer.add_user(user)
+        return user
 
     def branch(self, user):
         '''Adds to the search queue by selecting from the successors
-        of this user.
+        of this user. Refreshing does not branch.
         '''
-        successors = self.successors(user)
-        limit = min(self.max_branching, self.queue.maxlen - len(self.queue))
-        if len(successors) > limit:
-            self.queue.extend(sample(successors, limit))
-        else:
-            self.queue.extend(successors)
+        if self.refresh:
+            return
+        self.enqueue_successors(user, self.successors(user))
+
+    def observe_activity(self, user, count, oldest):
+        '''Accumulates the media seen for a user this crawl and the earliest
+        time they were posted, from which the refresh policy estimates how
+        active the user is.
+        '''
+        seen_count, start = self.activity.get(user.id, (0, None))
+        if start is None or (oldest is not None and oldest < start):
+            start = oldest
+        self.activity[user.id] = (seen_count + count, start)
+
+    def enqueue_successors(self, user, successors):
+        telemetry.incr('branch.candidates', len(successors))
+        successors = self.seen.unseen(successors)
+        telemetry.incr('branch.unseen', len(successors))
+        limit = min(self.max_branching, self.queue.space())
+        successors = self.scheduler.select(user, successors, limit)
+        telemetry.incr('branch.queued', len(successors))
+        self.seen.mark_queued(successors)
+        self.queue.extend(successors)
 
 class InstagramCrawler(Crawler):
-    def __init__(self, session, client_id, verbose, max_branching=5, queue_size=5000, max_except=10):
-        super().__init__(session, max_branching, queue_size, max_except)
+    seed_size = 5000
+
+    def __init__(self, session, client_id, verbose, max_branching=5, queue_size=5000, max_except=10, frontier=None,
+            seen=None, scheduler=None):
+        super().__init__(session, max_branching, queue_size, max_except, frontier, seen, scheduler)
         self.client = InstagramClient(client_id, verbose)
 
     def successors(self, user):
@@ -103,59 +383,115 @@ class InstagramCrawler(Crawler):
         user: The User object representing the user to be scraped.
         returns: Nothing.
         '''
-        if user.private or user.fully_scraped:
+        if user.private:
+            return
+        if user.fully_scraped:
+            if self.refresh:
+                self.refresh_recent(user)
             return
         try:
             for content, next_max_id in self.client.recent(user.id, user.next_max_id):
-                user.next_max_id = next_max_id
-                if next_max_id is None:
-                    user.fully_scraped = True
-                geotagged = [m for m in content if self.has_location(m)]
-                for media in geotagged:
-                    self.store_media(user, media)
-                if len(geotagged) == 0:
+                if not self.store_page(user, content, next_max_id):
                     return
         except PrivateUserException:
             user.private = True
 
+    def refresh_recent(self, user):
+        '''Fetches only the media the user posted since the last crawl.
+        user: A fully scraped User object.
+        returns: Nothing.
+        '''
+        self.start_refresh(user)
+        try:
+            for content, next_max_id in self.client.recent(user.id, min_id=user.min_id):
+                if not self.store_new_page(user, content):
+                    return
+        except PrivateUserException:
+            user.private = True
+
+    def start_refresh(self, user):
+        self.activity[user.id] = (0, user.last_crawled)
+
+    def store_new_page(self, user, content):
+        '''Stores one page of media newer than the user's watermark.
+        returns: Whether the next page should be fetched.
+        '''
+        had_watermark = user.min_id is not None
+        self.store_content(user, content)
+        # Without a watermark every page is new; one page is enough to set it.
+        return had_watermark
+
+    def store_page(self, user, content, next_max_id):
+        '''Stores the geotagged media of one page of recent media.
+        user: The User object whose media this is.
+        content: The page of media.
+        next_max_id: The max_id that will return the next page.
+        returns: Whether the next page should be scraped.
+        '''
+        user.next_max_id = next_max_id
+        if next_max_id is None:
+            user.fully_scraped = True
+        return self.store_content(user, content) > 0
+
+    def store_content(self, user, content):
+        '''Stores the geotagged media of a page and updates the user's
+        counts, newest media watermark and activity.
+        returns: The number of geotagged media on the page.
+        '''
+        geotagged = [m for m in content if self.has_location(m)]
+        user.media_count = (user.media_count or 0) + len(content)
+        user.geotagged_count = (user.geotagged_count or 0) + len(geotagged)
+        if len(content) > 0:
+            newest = max(content, key=lambda m: self.media_number(m['id']))['id']
+            if user.min_id is None or self.media_number(newest) > self.media_number(user.min_id):
+                user.min_id = newest
+            oldest = min(int(m['created_time']) for m in content)
+            self.observe_activity(user, len(content), datetime.utcfromtimestamp(oldest))
+        for media in geotagged:
+            self.store_media(user, media)
+        telemetry.incr('media.seen', len(content))
+        telemetry.incr('media.geotagged', len(geotagged))
+        if user.id in self.crawl_stats:
+            self.crawl_stats[user.id][1] += len(geotagged)
+        return len(geotagged)
+
+    def media_number(self, media_id):
+        '''Media ID's are of the form <media>_<user>; the first part increases over time.'''
+        return int(str(media_id).split('_')[0])
+
     def store_media(self, user, media):
-        '''Stores the given media, which must contain location information.
+        '''Buffers the given media, which must contain location information,
+        for the next bulk write.
         user: The User object associated with the media.
         media: The JSON representation of the media.
         returns: Nothing.
         '''
-        id_ = int(media['id'].split('_')[0])
-        if self.session.query(Media).get(id_) is None:
-            if media['caption'] is not None and 'text' in media['caption']:
-                caption = media['caption']['text']
-            else:
-                caption = None
-            location = self.store_location(media['location'])
-
-            media_obj = Media(id=id_,
-                date=datetime.fromtimestamp(int(media['created_time'])),
-                caption=caption,
-                tags=media['tags'],
-                type=media['type'],
-                user=user,
-                location=location)
-            self.session.add(media_obj)
+        if media['caption'] is not None and 'text' in media['caption']:
+            caption = media['caption']['text']
+        else:
+            caption = None
+        location_id = self.store_location(media['location'])
+
+        self.writer.add_media({'id': int(media['id'].split('_')[0]),
+            'date': datetime.fromtimestamp(int(media['created_time'])),
+            'caption': caption,
+            'tags': media['tags'],
+            'type': media['type'],
+            'user_id': user.id,
+            'location_id': location_id})
 
     def store_location(self, location):
-        '''Stores the given location in the database.
+        '''Buffers the given location for the next bulk write.
         location: The JSON representation of the location as returned
             by the Instagram API.
-        return: The Location object.
+        return: The location ID.
         '''
         id_ = int(location['id'])
-        location_obj = self.session.query(Location).get(id_)
-        if location_obj is None:
-            location_obj = Location(id=id_,
-                name=location['name'],
-                latitude=float(location['latitude']),
-                longitude=float(location['longitude']))
-            self.session.add(location_obj)
-        return location_obj
+        self.writer.add_location({'id': id_,
+            'name': location['name'],
+            'latitude': float(location['latitude']),
+            'longitude': float(location['longitude'])})
+        return id_
 
     def seed_by_location(self, lat, lng):
         '''Uses the /media/search API endpoint to initialize the search queue
@@ -167,26 +503,135 @@ class InstagramCrawler(Crawler):
         content = self.client.search(lat, lng)
         self.queue.extend(int(m['user']['id']) for m in content)
 
+    def seed_due_users(self):
+        '''Queues the scraped users whose next refresh is due, most overdue
+        first, and switches the crawler to refresh mode.
+        '''
+        self.refresh = True
+        self.queue.extend(due_users(self.session, datetime.utcnow(), min(self.queue.space(), self.seed_size)))
+
     def seed_from_database(self):
         '''Seeds the queue with random users for the database.
         returns: Nothing.
         '''
-        limit = self.queue.maxlen - len(self.queue)
+        limit = min(self.queue.space(), self.seed_size)
         self.queue.extend([u.id for u in random_users(self.session, limit)])
 
+class AsyncInstagramCrawler(InstagramCrawler):
+    '''InstagramCrawler that crawls up to `concurrency` users at once with
+    the asyncio client. API calls overlap; database work stays on the
+    event loop thread, so the session is never used concurrently.
+    '''
+    def __init__(self, session, client_id, verbose, concurrency=10, max_branching=5, queue_size=5000, max_except=10,
+            frontier=None, seen=None, scheduler=None):
+        super().__init__(session, client_id, verbose, max_branching, queue_size, max_except, frontier, seen,
+            scheduler)
+        self.concurrency = concurrency
+        self.active = 0
+
+    def run(self):
+        self.stop = False
+        asyncio.run(self.run_async())
+
+    async def run_async(self):
+        async with AsyncInstagramClient(self.client.client_id, self.client.verbose, self.concurrency) as aclient:
+            self.aclient = aclient
+            await asyncio.gather(*[self.worker() for _ in range(self.concurrency)])
+        self.attempt(self.writer.flush)
+
+    async def worker(self):
+        while not self.stop:
+            if len(self.queue) == 0:
+                # Other workers, here or sharing the frontier, may still be about to branch.
+                if self.active == 0:
+                    if not self.queue.pending():
+                        return
+                    self.flush_idle()
+                await asyncio.sleep(0.1)
+                continue
+            user_id = self.queue.popleft()
+            if self.skip_done(user_id):
+                continue
+            self.active += 1
+            telemetry.set('crawl.active', self.active)
+            try:
+                user = self.load_user(user_id)
+                await self.attempt_async(lambda: self.scrape_async(user))
+                await self.attempt_async(lambda: self.branch_async(user))
+                self.finish_user(user)
+            finally:
+                self.active -= 1
+                telemetry.set('crawl.active', self.active)
+
+    async def branch_async(self, user):
+        if self.refresh:
+            return
+        self.enqueue_successors(user, await self.successors_async(user))
+
+    async def successors_async(self, user):
+        if user.private:
+            return []
+        try:
+            return [int(u['id']) async for u in self.aclient.followers(user.id)]
+        except PrivateUserException:
+            user.private = True
+        return []
+
+    async def scrape_async(self, user):
+        if user.private:
+            return
+        if user.fully_scraped:
+            if self.refresh:
+                await self.refresh_recent_async(user)
+            return
+        try:
+            async for content, next_max_id in self.aclient.recent(user.id, user.next_max_id):
+                if not self.store_page(user, content, next_max_id):
+                    return
+        except PrivateUserException:
+            user.private = True
+
+    async def refresh_recent_async(self, user):
+        self.start_refresh(user)
+        try:
+            async for content, next_max_id in self.aclient.recent(user.id, min_id=user.min_id):
+                if not self.store_new_page(user, content):
+                    return
+        except PrivateUserException:
+            user.private = True
+
 def get_args():
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument('-v', '--verbose', action='store_true',
         help='Verbose output.')
     parser.add_argument('-c', '--create-tables', action='store_true',
-        help='Create database tables.')
+        help='Create database tables, or add the columns newer versions need to existing ones.')
     parser.add_argument('-l', '--seed-location', metavar='LAT,LONG',
         help='Seed crawler with recent users at the given location.')
     parser.add_argument('-e', '--max-except', type=int, default=10,
         help='Maximum number of exceptions before exiting (default 10).')
+    parser.add_argument('-a', '--async-concurrency', type=int, metavar='N',
+        help='Crawl N users concurrently with the asyncio client.')
+    parser.add_argument('-w', '--workers', type=int, metavar='N',
+        help='Run N worker threads sharing the frontier table in the database.')
+    parser.add_argument('-s', '--seen-file', metavar='PATH',
+        help='Bloom filter of done users, loaded if present and saved on exit.')
+    parser.add_argument('--scheduler', choices=['yield', 'random'], default='yield',
+        help='How successors are chosen when branching (default yield).')
+    parser.add_argument('-r', '--refresh', action='store_true',
+        help='Fetch new media of scraped users that are due for a refresh instead of branching.')
+    parser.add_argument('-t', '--telemetry', metavar='PATH',
+        help='Append telemetry snapshots as JSON lines to PATH, or - for stdout.')
+    parser.add_argument('--telemetry-interval', type=float, default=60.0, metavar='SECONDS',
+        help='Seconds between telemetry snapshots (default 60).')
+    parser.add_argument('-m', '--metrics-port', type=int, metavar='PORT',
+        help='Serve telemetry on localhost:PORT, in Prometheus format at /metrics and as JSON elsewhere.')
     args = parser.parse_args()
 
+    if args.refresh and args.workers is not None:
+        parser.error('--refresh cannot be combined with --workers.')
+
     if args.seed_location is not None:
         try:
             args.seed_location_split = [float(c) for c in args.seed_location.split(',')]
@@ -208,35 +653,112 @@ def get_args():
 
     return args
 
+def start_telemetry(args):
+    '''Starts the reporters asked for on the command line.
+    returns: The started reporters, each with a stop() method.
+    '''
+    reporters = []
+    if args.telemetry is not None:
+        reporters.append(JsonLinesReporter(telemetry, args.telemetry, args.telemetry_interval).start())
+    if args.metrics_port is not None:
+        reporters.append(MetricsServer(telemetry, args.metrics_port).start())
+    return reporters
+
 def stop_crawler(crawler):
     print('Stopping crawler...')
     crawler.stop = True
 
-def main():
-    args = get_args()
-    engine = create_engine(args.dbstring)
-
-    if args.create_tables:
-        print('Creating tables...')
-        create_tables(engine)
-        return
-
-    session = create_session(engine)
-    crawler = InstagramCrawler(session, args.client_id, args.verbose, max_except=args.max_except)
+def make_crawler(args, session, frontier=None, seen=None):
+    scheduler = YieldScheduler(session) if args.scheduler == 'yield' else RandomScheduler()
+    if args.async_concurrency is not None:
+        return AsyncInstagramCrawler(session, args.client_id, args.verbose,
+            concurrency=args.async_concurrency, max_except=args.max_except, frontier=frontier, seen=seen,
+            scheduler=scheduler)
+    return InstagramCrawler(session, args.client_id, args.verbose, max_except=args.max_except, frontier=frontier,
+        seen=seen, scheduler=scheduler)
 
-    if args.seed_location is not None:
+def seed(args, crawler):
+    if args.refresh:
+        print('Seeding with users due for a refresh...')
+        crawler.seed_due_users()
+    elif args.seed_location is not None:
         print('Seeding by location...')
         crawler.seed_by_location(args.seed_location_split[0], args.seed_location_split[1])
     else:
         print('Seeding from database...')
         crawler.seed_from_database()
 
+def run_workers(args, engine):
+    '''Runs args.workers crawlers in threads, each with its own session,
+    pulling users from the shared frontier table.
+    '''
+    session = create_session(engine)
+    release_stale_claims(session, timedelta(hours=1))
+    print('Loading seen users...')
+    seen = load_seen_set(session, args.seen_file)
+    seeder = make_crawler(args, session, DatabaseFrontier(session, None), seen)
+    seed(args, seeder)
+    seeder.writer.flush()
+    session.close()
+
+    prefix = '{0}-{1}'.format(socket.gethostname(), os.getpid())
+    crawlers = []
+    for i in range(args.workers):
+        worker_session = create_session(engine)
+        frontier = DatabaseFrontier(worker_session, '{0}-{1}'.format(prefix, i))
+        # The seen set is shared; its Bloom filters lock their adds, and it
+        # locks starting a new visited generation.
+        crawlers.append(make_crawler(args, worker_session, frontier, seen))
+
+    signal.signal(signal.SIGINT, lambda s, f: [stop_crawler(c) for c in crawlers])
+
+    def work(crawler):
+        crawler.run()
+        crawler.session.close()
+
+    threads = [threading.Thread(target=work, args=(c,)) for c in crawlers]
+    for thread in threads:
+        thread.start()
+    # Join with a timeout so the main thread stays responsive to SIGINT.
+    while any(thread.is_alive() for thread in threads):
+        for thread in threads:
+            thread.join(1)
+    seen.save()
+
+def run_crawler(args, engine):
+    '''Runs a single crawler with its own session.'''
+    session = create_session(engine)
+    print('Loading seen users...')
+    crawler = make_crawler(args, session, seen=load_seen_set(session, args.seen_file))
+    seed(args, crawler)
+
     # Setup handler so that the interrupt signal can be caught and
     # the crawler can exit cleanly.
     signal.signal(signal.SIGINT, lambda s, f: stop_crawler(crawler))
     crawler.run()
+    crawler.seen.save()
 
     session.close()
+
+def main():
+    args = get_args()
+    engine = create_engine(args.dbstring)
+
+    if args.create_tables:
+        print('Creating tables...')
+        create_tables(engine)
+        return
+
+    upgrade_tables(engine)
+    reporters = start_telemetry(args)
+    try:
+        if args.workers is not None:
+            run_workers(args, engine)
+        else:
+            run_crawler(args, engine)
+    finally:
+        for reporter in reporters:
+            reporter.stop()
     engine.dispose()
 
 if __name__ == '__main__':
@@ -0,0 +1,216 @@
+# ASU CSE 591
+# Author: Group 4
+
+import csv
+import os
+import sys
+from datetime import datetime
+
+from models import create_engine, create_session, training_media
+
+# Tags are normalized by the same module the model builder and the prediction service use.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'model_python', 'model'))
+import TagNormalizer
+
+# Columns of the sample CSV read by ModelGen.loadSamples in model_scala/learning.
+COLUMNS = ['id', 'user_id', 'date', 'tags', 'location_id', 'location_name', 'latitude', 'longitude']
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+class CSVExporter:
+    '''Writes media in the 8 column sample format of the model builders:
+    id,user_id,date,{tag,...},location_id,location_name,latitude,longitude
+    The sample parser has no escape for quotes and the tag list parser none
+    for braces or commas, so those characters are dropped from the values.
+    '''
+    def __init__(self, path):
+        self.file = sys.stdout if path == '-' else open(path, 'w', encoding='utf-8', newline='')
+        self.writer = csv.writer(self.file, lineterminator='\n')
+        self.rows = 0
+
+    def clean(self, text, drop):
+        return ''.join(c for c in (text or '') if c not in drop and c not in '\r\n')
+
+    def write_chunk(self, rows):
+        self.writer.writerows([
+            (m_id, user_id, date.strftime(DATE_FORMAT),
+                '{' + ','.join(self.clean(t, '{},"') for t in tags) + '}',
+                location_id, self.clean(name, '"'), lat, lon)
+            for m_id, user_id, date, tags, location_id, name, lat, lon in rows])
+        self.rows += len(rows)
+
+    def close(self):
+        if self.file is not sys.stdout:
+            self.file.close()
+
+class ArrowExporter:
+    '''Writes media as Parquet or Arrow IPC shards of at most shard_rows
+    rows each, named <path>-00000.parquet and so on. Every chunk becomes
+    one record batch (a row group for Parquet). Requires pyarrow.
+    '''
+    def __init__(self, path, fmt='parquet', shard_rows=1000000, vocabulary=None):
+        '''vocabulary: If given, a tag_ids column holds the vocabulary ID of
+        every tag, which must already be interned.
+        '''
+        import pyarrow
+        self.pa = pyarrow
+        self.path = path
+        self.fmt = fmt
+        self.shard_rows = shard_rows
+        self.schema = pyarrow.schema([
+            ('id', pyarrow.int64()),
+            ('user_id', pyarrow.int64()),
+            ('date', pyarrow.timestamp('s')),
+            ('tags', pyarrow.list_(pyarrow.string())),
+            ('location_id', pyarrow.int64()),
+            ('location_name', pyarrow.string()),
+            ('latitude', pyarrow.float64()),
+            ('longitude', pyarrow.float64())])
+        self.vocabulary = vocabulary
+        if vocabulary is not None:
+            self.schema = self.schema.append(pyarrow.field('tag_ids', pyarrow.list_(pyarrow.int32())))
+        self.writer = None
+        self.shard = 0
+        self.shard_count = 0
+        self.rows = 0
+
+    def open_shard(self):
+        filename = '{0}-{1:05d}.{2}'.format(self.path, self.shard, self.fmt)
+        if self.fmt == 'parquet':
+            import pyarrow.parquet
+            self.writer = pyarrow.parquet.ParquetWriter(filename, self.schema)
+        else:
+            import pyarrow.ipc
+            self.writer = pyarrow.ipc.new_file(filename, self.schema)
+        self.shard += 1
+        self.shard_count = 0
+
+    def write_chunk(self, rows):
+        while len(rows) > 0:
+            if self.writer is None or self.shard_count >= self.shard_rows:
+                self.close()
+                self.open_shard()
+            part = rows[:self.shard_rows - self.shard_count]
+            rows = rows[len(part):]
+            columns = list(zip(*part))
+            if self.vocabulary is not None:
+                columns.append([[self.vocabulary.lookup(t) for t in tags] for tags in columns[3]])
+            batch = self.pa.RecordBatch.from_arrays(
+                [self.pa.array(column, type=field.type) for column, field in zip(columns, self.schema)],
+                schema=self.schema)
+            if self.fmt == 'parquet':
+                self.writer.write_table(self.pa.Table.from_batches([batch]))
+            else:
+                self.writer.write_batch(batch)
+            self.shard_count += len(part)
+            self.rows += len(part)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+def normalize_tags(rows, stop_tags=TagNormalizer.STOP_TAGS, vocabulary=None):
+    '''Normalizes the tags of every row (see TagNormalizer.py), interning
+    them into vocabulary if one is given.
+    '''
+    for m_id, user_id, date, tags, location_id, name, lat, lon in rows:
+        tags = TagNormalizer.normalizeTags(tags, stop_tags)
+        if vocabulary is not None:
+            vocabulary.internAll(tags)
+        yield m_id, user_id, date, tags, location_id, name, lat, lon
+
+def export(rows, exporter, chunk_size=10000, verbose=False):
+    '''Writes rows through the exporter chunk_size rows at a time, so only
+    one chunk is ever held in memory.
+    returns: The number of rows written.
+    '''
+    chunk = []
+    try:
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                exporter.write_chunk(chunk)
+                chunk = []
+                if verbose:
+                    print('{0} rows exported'.format(exporter.rows), file=sys.stderr)
+        if len(chunk) > 0:
+            exporter.write_chunk(chunk)
+    finally:
+        exporter.close()
+    return exporter.rows
+
+def get_args():
+    import argparse
+    parser = argparse.ArgumentParser(description='Exports crawled media as model training samples.')
+    parser.add_argument('output',
+        help='Output CSV file (- for stdout), or the shard prefix for parquet and arrow.')
+    parser.add_argument('-f', '--format', choices=['csv', 'parquet', 'arrow'], default='csv',
+        help='Output format (default csv). parquet and arrow require pyarrow.')
+    parser.add_argument('--start', metavar='YYYY-MM-DD',
+        help='Only export media posted on or after this date.')
+    parser.add_argument('--end', metavar='YYYY-MM-DD',
+        help='Only export media posted before this date.')
+    parser.add_argument('-b', '--bbox', metavar='MINLAT,MINLONG,MAXLAT,MAXLONG',
+        help='Only export media inside this bounding box.')
+    parser.add_argument('--chunk-size', type=int, default=10000,
+        help='Rows fetched from the database and written at a time (default 10000).')
+    parser.add_argument('--shard-rows', type=int, default=1000000,
+        help='Rows per parquet or arrow shard (default 1000000).')
+    parser.add_argument('--raw-tags', action='store_true',
+        help='Export tags as crawled instead of normalized.')
+    parser.add_argument('--stop-tags', metavar='PATH',
+        help='File of stop tags, one per line, replacing the built-in list.')
+    parser.add_argument('--vocabulary', metavar='PATH',
+        help='Tag vocabulary, extended with new tags and saved; parquet and arrow also get a tag_ids column.')
+    parser.add_argument('-v', '--verbose', action='store_true',
+        help='Report progress on stderr.')
+    args = parser.parse_args()
+
+    if args.raw_tags and (args.stop_tags is not None or args.vocabulary is not None):
+        parser.error('--raw-tags cannot be combined with --stop-tags or --vocabulary.')
+
+    try:
+        args.start = datetime.strptime(args.start, '%Y-%m-%d') if args.start is not None else None
+        args.end = datetime.strptime(args.end, '%Y-%m-%d') if args.end is not None else None
+    except ValueError as e:
+        parser.error('Invalid date: {0}'.format(e))
+
+    if args.bbox is not None:
+        try:
+            args.bbox = [float(c) for c in args.bbox.split(',')]
+            assert(len(args.bbox) == 4)
+        except:
+            parser.error('Invalid format for bounding box: {0}'.format(args.bbox))
+
+    try:
+        args.dbstring = os.environ['DBSTRING']
+    except:
+        parser.error('DBSTRING must be provided as an environmental variable.')
+
+    return args
+
+def main():
+    args = get_args()
+    vocabulary = TagNormalizer.loadVocabulary(args.vocabulary) if args.vocabulary is not None else None
+    if args.format == 'csv':
+        exporter = CSVExporter(args.output)
+    else:
+        exporter = ArrowExporter(args.output, args.format, args.shard_rows, vocabulary)
+
+    engine = create_engine(args.dbstring)
+    session = create_session(engine)
+    rows = training_media(session, args.start, args.end, args.bbox, args.chunk_size)
+    if not args.raw_tags:
+        stop_tags = TagNormalizer.loadStopTags(args.stop_tags) if args.stop_tags is not None else TagNormalizer.STOP_TAGS
+        rows = normalize_tags(rows, stop_tags, vocabulary)
+    count = export(rows, exporter, args.chunk_size, args.verbose)
+    print('Exported {0} media.'.format(count), file=sys.stderr)
+    if vocabulary is not None:
+        vocabulary.save(args.vocabulary)
+        print('Vocabulary has {0} tags.'.format(len(vocabulary)), file=sys.stderr)
+
+    session.close()
+    engine.dispose()
+
+if __name__ == '__main__':
+    main()
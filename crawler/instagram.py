@@ -2,10 +2,13 @@
 # Author: Group 4
 
 import json
+import time
 from time import sleep
 
 import requests
 
+from telemetry import telemetry
+
 class PrivateUserException(Exception):
     def __init__(self, user_id):
         self.user_id = user_id
@@ -13,6 +16,22 @@ class PrivateUserException(Exception):
     def __str__(self):
         return 'User {0} is private.'.format(user_id)
 
+def endpoint_kind(endpoint):
+    '''Names an endpoint for telemetry without the user ID, e.g. users.media.recent.'''
+    parts = [p for p in endpoint.strip('/').split('/') if not p.isdigit()]
+    return '.'.join(parts).replace('-', '_')
+
+def record_response(endpoint, code, seconds, remaining=None):
+    '''Counts an API response by endpoint and code and observes its latency.'''
+    kind = endpoint_kind(endpoint)
+    telemetry.incr('api.requests')
+    telemetry.incr('api.requests.' + kind)
+    telemetry.incr('api.responses.{0}'.format(code))
+    telemetry.observe('api.latency_seconds', seconds)
+    telemetry.observe('api.latency_seconds.' + kind, seconds)
+    if remaining is not None:
+        telemetry.set('api.ratelimit_remaining', remaining)
+
 class InstagramClient:
     api_base = 'https://api.instagram.com/v1'
     recent_count = 100
@@ -38,23 +57,29 @@ class InstagramClient:
         '''
         url = self.api_base + endpoint if endpoint.startswith('/') else '{0}/{1}'.format(self.api_base, endpoint)
         params['client_id'] = self.client_id
+        start = time.time()
         resp = requests.get(url, params)
         content = resp.json()
         code = int(self.safe_access(content, resp.status_code, 'meta', 'code'))
+        remaining = int(self.safe_access(resp.headers, self.throttle_threshold, 'x-ratelimit-remaining'))
+        record_response(endpoint, code, time.time() - start, remaining)
         if self.verbose:
             print(str(code) + " " + resp.url[len(self.api_base):])
         # Avoid exceeding the Instagram API limits and getting access turned off.
-        if resp.status_code == 429 or int(self.safe_access(resp.headers, self.throttle_threshold, 'x-ratelimit-remaining')) < self.throttle_threshold:
+        if resp.status_code == 429 or remaining < self.throttle_threshold:
             if self.verbose:
                 print("Pausing to throttle API calls...")
+            telemetry.incr('api.throttles')
+            telemetry.incr('api.throttle_seconds', 60)
             sleep(60)
         return code, content
 
-    def recent(self, user_id, max_id=None):
+    def recent(self, user_id, max_id=None, min_id=None):
         '''Requests the recent media posts of the given user.
         user_id: The ID of the target user.
         max_id: Controls where the returned media will start,
             as per the Instagram API.
+        min_id: Only media newer than this media ID is returned.
         returns: A generator which will return tuples consisting
             of a page of media and the max_id that will return
             the next page.
@@ -63,6 +88,8 @@ class InstagramClient:
         params = {'count': str(self.recent_count)}
         if max_id is not None:
             params['max_id'] = str(max_id)
+        if min_id is not None:
+            params['min_id'] = str(min_id)
         while True:
             code, content = self.api_request(path, params)
             if code == 400:
@@ -5,6 +5,7 @@ import sqlalchemy as sql
 import sqlalchemy.orm as orm
 import sqlalchemy.sql.expression as sqlexpr
 import sqlalchemy.dialects.postgresql as psql
+from datetime import datetime
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
@@ -16,6 +17,13 @@ class User(Base):
     next_max_id = sql.Column(sql.String)
     fully_scraped = sql.Column(sql.Boolean, default=False)
     private = sql.Column(sql.Boolean, default=False)
+    # Crawl statistics used by the scheduler to estimate geotag yield.
+    media_count = sql.Column(sql.Integer, default=0)
+    geotagged_count = sql.Column(sql.Integer, default=0)
+    last_crawled = sql.Column(sql.DateTime)
+    # Incremental refresh: newest media ID seen, and when the user is next due.
+    min_id = sql.Column(sql.String)
+    next_refresh = sql.Column(sql.DateTime, index=True)
 
     def __repr__(self):
         return "<User(id={0}, next_max_id='{1}' fully_scraped={2}, private={3})>".format(
@@ -52,6 +60,26 @@ class Media(Base):
         return "<Image(id={0}, date='{1}', tags={2}, type='{3}', user={4}, location={5}>".format(
             self.id, self.date, self.tags, self.is_image, self.user, self.location)
 
+class FrontierEntry(Base):
+    __tablename__ = 'frontier'
+
+    user_id = sql.Column(sql.BigInteger, primary_key=True)
+    claimed_by = sql.Column(sql.String)
+    claimed_at = sql.Column(sql.DateTime)
+    # Finished users are deleted, so that they can be enqueued again; rows
+    # marked done are left by older crawlers and removed by upgrade_tables.
+    done = sql.Column(sql.Boolean, default=False, nullable=False)
+
+    __table_args__ = (
+        # Partial index over the unclaimed part of the queue, which is all claim_users scans.
+        sql.Index('ix_frontier_unclaimed', 'user_id',
+            postgresql_where=sql.text('claimed_by IS NULL AND NOT done')),
+    )
+
+    def __repr__(self):
+        return "<FrontierEntry(user_id={0}, claimed_by='{1}', claimed_at={2}, done={3})>".format(
+            self.user_id, self.claimed_by, self.claimed_at, self.done)
+
 def create_engine(connstring):
 	return sql.create_engine(connstring)
 
@@ -59,8 +87,151 @@ def create_session(engine):
 	return orm.sessionmaker(bind=engine)()
 
 def create_tables(engine):
-	Base.metadata.create_all(engine)
-
-def random_users(session, num):
-	# Postgres specific
-    return session.query(User).order_by(sqlexpr.func.random()).limit(num).all()
+	upgrade_tables(engine)
+
+# Columns added to users after the table was first created; create_all does
+# not alter existing tables.
+ADDED_USER_COLUMNS = ['media_count', 'geotagged_count', 'last_crawled', 'min_id', 'next_refresh']
+
+def upgrade_tables(engine):
+    '''Brings an existing database up to the current schema: creates missing
+    tables such as the frontier, and adds the users columns and index that
+    newer crawlers need. Postgres specific; safe to run on every start.
+    '''
+    Base.metadata.create_all(engine)
+    users = User.__table__
+    with engine.begin() as conn:
+        for name in ADDED_USER_COLUMNS:
+            column = users.c[name]
+            conn.execute(sql.text('ALTER TABLE users ADD COLUMN IF NOT EXISTS {0} {1}'.format(
+                name, column.type.compile(dialect=engine.dialect))))
+        conn.execute(sql.text('CREATE INDEX IF NOT EXISTS ix_users_next_refresh ON users (next_refresh)'))
+        conn.execute(sql.text('DELETE FROM frontier WHERE done'))
+
+def random_users(session, num, oversample=4.0):
+    # Postgres specific. TABLESAMPLE SYSTEM reads a random subset of the table's
+    # pages instead of sorting the whole table by random(), so the cost depends
+    # on num rather than on the size of the table. The planner's row estimate
+    # sizes the sample without counting the table. The sampled pages come back
+    # in physical order, so the sample itself is shuffled before the limit;
+    # otherwise the oldest pages in it would supply every seed.
+    total = session.execute(sql.text("SELECT reltuples FROM pg_class WHERE relname = 'users'")).scalar()
+    if not total or total <= 0:
+        return session.query(User).limit(num).all()
+    percent = min(100.0, 100.0 * oversample * num / total)
+    sampled = orm.aliased(User, sql.tablesample(User.__table__, sqlexpr.func.system(percent)))
+    return session.query(sampled).order_by(sqlexpr.func.random()).limit(num).all()
+
+def due_users(session, now, num):
+    '''Returns the ID's of up to num fully scraped users whose refresh is
+    due, most overdue first. Users scraped before refreshes were scheduled
+    have no next_refresh and are treated as the most overdue.
+    '''
+    rows = session.query(User.id).\
+        filter(User.fully_scraped.is_(True), User.private.isnot(True),
+            sql.or_(User.next_refresh.is_(None), User.next_refresh <= now)).\
+        order_by(User.next_refresh.asc().nullsfirst()).limit(num)
+    return [row[0] for row in rows]
+
+def user_stats(session, user_ids):
+    '''Returns {user_id: (media_count, geotagged_count, last_crawled)} for the
+    given users that are already in the database, in one query.
+    '''
+    if len(user_ids) == 0:
+        return {}
+    rows = session.query(User.id, User.media_count, User.geotagged_count, User.last_crawled).\
+        filter(User.id.in_(user_ids))
+    return {row[0]: row[1:] for row in rows}
+
+def enqueue_users(session, user_ids):
+    '''Adds user ID's to the shared frontier, ignoring ones already in it.
+    The rows are inserted in key order, as the BulkWriter's are, so that
+    concurrent workers cannot deadlock on each other's index locks.
+    '''
+    rows = [{'user_id': user_id, 'done': False} for user_id in sorted(set(user_ids))]
+    if len(rows) > 0:
+        session.execute(psql.insert(FrontierEntry.__table__).values(rows).on_conflict_do_nothing())
+
+def claim_users(session, worker, num):
+    '''Atomically claims up to num unclaimed users for the given worker.
+    Rows locked by a concurrent claim are skipped rather than waited on,
+    so no two workers ever receive the same user. The claim commits on its
+    own connection, leaving the session's pending writes untouched.
+    returns: The claimed user ID's.
+    '''
+    # Postgres specific
+    frontier = FrontierEntry.__table__
+    candidates = sql.select([frontier.c.user_id]).\
+        where(sql.and_(frontier.c.claimed_by.is_(None), sql.not_(frontier.c.done))).\
+        limit(num).with_for_update(skip_locked=True)
+    with session.get_bind().begin() as conn:
+        claimed = conn.execute(frontier.update().
+            where(frontier.c.user_id.in_(candidates)).
+            values(claimed_by=worker, claimed_at=datetime.utcnow()).
+            returning(frontier.c.user_id))
+        return [row[0] for row in claimed]
+
+def finish_users(session, user_ids):
+    '''Removes finished users from the frontier, in key order. A user that
+    is not done for good can then be enqueued again when it is found
+    anew, as with the in-memory frontier; the seen set keeps out the users
+    that are done. The table only holds users still to be crawled.
+    '''
+    session.query(FrontierEntry).filter(FrontierEntry.user_id.in_(sorted(user_ids))).\
+        delete(synchronize_session=False)
+
+def count_in_progress(session):
+    '''Returns the number of frontier users claimed by some worker and not
+    yet finished, whose successors may still be added to the frontier.
+    '''
+    return session.query(sqlexpr.func.count(FrontierEntry.user_id)).\
+        filter(FrontierEntry.done.is_(False), FrontierEntry.claimed_by.isnot(None)).scalar()
+
+def release_stale_claims(session, older_than):
+    '''Returns users claimed by workers that died before finishing them to the frontier.
+    older_than: A timedelta after which an unfinished claim is considered stale.
+    '''
+    session.query(FrontierEntry).\
+        filter(FrontierEntry.done.is_(False), FrontierEntry.claimed_at < datetime.utcnow() - older_than).\
+        update({'claimed_by': None, 'claimed_at': None}, synchronize_session=False)
+    session.commit()
+
+def done_filter():
+    return sql.or_(User.fully_scraped.is_(True), User.private.is_(True))
+
+def count_done_users(session):
+    return session.query(sqlexpr.func.count(User.id)).filter(done_filter()).scalar()
+
+def done_user_ids(session, chunk_size=10000):
+    '''Streams the ID's of users that are fully scraped or private through
+    a server-side cursor, so memory stays constant.
+    '''
+    for (user_id,) in session.query(User.id).filter(done_filter()).yield_per(chunk_size):
+        yield user_id
+
+def training_media(session, start=None, end=None, bbox=None, chunk_size=10000):
+    '''Streams geotagged media with tags, joined to their locations, through
+    a server-side cursor fetching chunk_size rows at a time.
+    start, end: Optional datetimes; media dated in [start, end) are returned.
+    bbox: Optional (min_lat, min_lon, max_lat, max_lon). A min_lon greater
+        than max_lon selects the box that crosses the antimeridian.
+    returns: A generator of (id, user_id, date, tags, location_id,
+        location_name, latitude, longitude) tuples.
+    '''
+    query = session.query(Media.id, Media.user_id, Media.date, Media.tags, Media.location_id,
+        Location.name, Location.latitude, Location.longitude).\
+        join(Location, Media.location_id == Location.id).\
+        filter(sqlexpr.func.array_length(Media.tags, 1) > 0)
+    if start is not None:
+        query = query.filter(Media.date >= start)
+    if end is not None:
+        query = query.filter(Media.date < end)
+    if bbox is not None:
+        min_lat, min_lon, max_lat, max_lon = bbox
+        query = query.filter(Location.latitude.between(min_lat, max_lat))
+        if min_lon <= max_lon:
+            query = query.filter(Location.longitude.between(min_lon, max_lon))
+        else:
+            query = query.filter(sql.or_(Location.longitude >= min_lon, Location.longitude <= max_lon))
+    for row in query.yield_per(chunk_size):
+        yield tuple(row)
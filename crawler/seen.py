@@ -0,0 +1,143 @@
+# ASU CSE 591
+# Author: Group 4
+
+import hashlib
+import math
+import os
+import struct
+import threading
+
+from models import done_user_ids, count_done_users
+
+class BloomFilter:
+    '''Fixed-size Bloom filter over 64-bit integer keys. Membership tests
+    never give false negatives and give false positives at roughly
+    error_rate once capacity keys have been added. Adds are locked, so a
+    filter can be shared by crawler threads.
+    '''
+    header = struct.Struct('<QQQ')
+
+    def __init__(self, capacity, error_rate=0.001, num_bits=None, num_hashes=None, bits=None):
+        if num_bits is None:
+            num_bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        if capacity is None:
+            # A loaded filter's capacity follows from its size and the error rate it was built for.
+            capacity = int(-num_bits * math.log(2) ** 2 / math.log(error_rate))
+        self.capacity = capacity
+        if num_hashes is None:
+            num_hashes = max(1, int(round(float(num_bits) / capacity * math.log(2))))
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.bits = bits if bits is not None else bytearray((num_bits + 7) // 8)
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def positions(self, key):
+        # Double hashing: k positions derived from two independent 64-bit hashes.
+        digest = hashlib.blake2b(struct.pack('<q', key), digest_size=16).digest()
+        h1, h2 = struct.unpack('<QQ', digest)
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, key):
+        positions = list(self.positions(key))
+        with self.lock:
+            for pos in positions:
+                self.bits[pos >> 3] |= 1 << (pos & 7)
+            self.count += 1
+
+    def saturated(self):
+        '''Whether more keys than capacity were added, so that false
+        positives are above error_rate.
+        '''
+        return self.count > self.capacity
+
+    def __contains__(self, key):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self.positions(key))
+
+    def save(self, path):
+        '''Writes the filter beside path and renames it into place.'''
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(self.header.pack(self.num_bits, self.num_hashes, self.count))
+            f.write(self.bits)
+        os.replace(tmp, path)
+
+    @staticmethod
+    def load(path, error_rate=0.001):
+        '''error_rate: The rate the filter was built for, from which its capacity is derived.'''
+        with open(path, 'rb') as f:
+            num_bits, num_hashes, count = BloomFilter.header.unpack(f.read(BloomFilter.header.size))
+            bloom = BloomFilter(None, error_rate, num_bits=num_bits, num_hashes=num_hashes,
+                bits=bytearray(f.read()))
+        bloom.count = count
+        return bloom
+
+class SeenSet:
+    '''Frontier deduplication. `done` is a Bloom filter of users that never
+    need crawling again (fully scraped or private), persisted between runs.
+    `visited` is an in-memory Bloom filter of users queued or crawled during
+    this run. When it fills up it becomes `previous` and a new one is
+    started, so memory stays bounded on long runs; a user last seen two
+    generations ago may be queued again.
+    '''
+    def __init__(self, done, path=None, visited_capacity=1000000, error_rate=0.001):
+        self.done = done
+        self.path = path
+        self.visited_capacity = visited_capacity
+        self.error_rate = error_rate
+        self.visited = BloomFilter(visited_capacity, error_rate)
+        self.previous = None
+        self.lock = threading.Lock()
+
+    def was_visited(self, user_id):
+        return user_id in self.visited or (self.previous is not None and user_id in self.previous)
+
+    def remember(self, user_id):
+        '''Adds a user to `visited`, starting a new generation once it is full.'''
+        if self.visited.saturated():
+            with self.lock:
+                if self.visited.saturated():
+                    self.previous = self.visited
+                    self.visited = BloomFilter(self.visited_capacity, self.error_rate)
+        self.visited.add(user_id)
+
+    def is_done(self, user_id):
+        return user_id in self.done
+
+    def unseen(self, user_ids):
+        '''Filters out users that are done or were already queued this run.'''
+        return [u for u in user_ids if not self.was_visited(u) and u not in self.done]
+
+    def mark_queued(self, user_ids):
+        for user_id in user_ids:
+            self.remember(user_id)
+
+    def visit(self, user):
+        '''Records a crawled user, remembering it for good once it is done.'''
+        self.remember(user.id)
+        if user.fully_scraped or user.private:
+            self.done.add(user.id)
+
+    def save(self):
+        if self.path is not None:
+            self.done.save(self.path)
+
+def load_seen_set(session, path=None, min_capacity=1000000, error_rate=0.001):
+    '''Loads the persisted filter at path if there is one, otherwise warms a
+    new filter by streaming the ID's of done users from the users table.
+    A persisted filter that has outgrown its capacity is rebuilt the same
+    way, sized for the users done by now.
+    path: Where the filter is persisted, or None to keep it in memory only.
+    returns: A SeenSet.
+    '''
+    if path is not None and os.path.exists(path):
+        done = BloomFilter.load(path, error_rate)
+        if not done.saturated():
+            return SeenSet(done, path)
+        print('Seen filter is over capacity ({0} of {1}), rebuilding...'.format(done.count, done.capacity))
+
+    done = BloomFilter(max(min_capacity, 2 * count_done_users(session)), error_rate)
+    for user_id in done_user_ids(session):
+        done.add(user_id)
+    return SeenSet(done, path)
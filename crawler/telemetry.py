@@ -0,0 +1,198 @@
+# ASU CSE 591
+# Author: Group 4
+
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SECONDS_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120]
+COUNT_BUCKETS = [0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000]
+
+class Histogram:
+    '''Counts observations into fixed buckets; bucket i holds the values
+    in (bounds[i - 1], bounds[i]] and the last bucket everything larger.
+    '''
+    def __init__(self, bounds):
+        self.bounds = list(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = None
+
+    def observe(self, value):
+        slot = len(self.bounds)
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                slot = i
+                break
+        self.counts[slot] += 1
+        self.count += 1
+        self.total += value
+        self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, q):
+        '''Upper bound of the bucket holding the q-th quantile, or the
+        largest value seen if it lies past the last bound.
+        '''
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return self.max
+
+    def snapshot(self):
+        cumulative = 0
+        buckets = []
+        for bound, count in zip(self.bounds + ['+Inf'], self.counts):
+            cumulative += count
+            buckets.append([bound, cumulative])
+        return {'count': self.count, 'sum': self.total, 'max': self.max,
+            'mean': self.total / self.count if self.count > 0 else None,
+            'p50': self.quantile(0.5), 'p90': self.quantile(0.9), 'p99': self.quantile(0.99),
+            'buckets': buckets}
+
+class Telemetry:
+    '''Thread-safe counters, gauges and histograms of a crawl. Metric names
+    are dotted, e.g. api.requests or db.flush_seconds; histograms are created
+    on their first observation with the bounds given then.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def incr(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def set(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def observe(self, name, value, bounds=SECONDS_BUCKETS):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(bounds)
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name):
+        '''Observes the seconds the body of a with statement takes.'''
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start)
+
+    def snapshot(self):
+        with self.lock:
+            now = time.time()
+            return {'time': now,
+                'uptime': now - self.started,
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+                'histograms': {name: h.snapshot() for name, h in self.histograms.items()}}
+
+    def prometheus(self):
+        '''Returns the current values in the Prometheus text format, with
+        dots in names replaced by underscores.
+        '''
+        snap = self.snapshot()
+        lines = []
+        for name, value in sorted(snap['counters'].items()):
+            name = 'crawler_' + name.replace('.', '_')
+            lines += ['# TYPE {0} counter'.format(name), '{0} {1}'.format(name, value)]
+        for name, value in sorted(snap['gauges'].items()):
+            name = 'crawler_' + name.replace('.', '_')
+            lines += ['# TYPE {0} gauge'.format(name), '{0} {1}'.format(name, value)]
+        for name, h in sorted(snap['histograms'].items()):
+            name = 'crawler_' + name.replace('.', '_')
+            lines.append('# TYPE {0} histogram'.format(name))
+            for bound, cumulative in h['buckets']:
+                lines.append('{0}_bucket{{le="{1}"}} {2}'.format(name, bound, cumulative))
+            lines += ['{0}_sum {1}'.format(name, h['sum']), '{0}_count {1}'.format(name, h['count'])]
+        return '\n'.join(lines) + '\n'
+
+class JsonLinesReporter:
+    '''Writes a snapshot of the telemetry as one JSON line every interval
+    seconds from a daemon thread, adding the per-second rate of every
+    counter over the interval. stop() writes a final line.
+    '''
+    def __init__(self, telemetry, path='-', interval=60.0):
+        '''path: File the lines are appended to, or - for stdout.'''
+        self.telemetry = telemetry
+        self.out = sys.stdout if path == '-' else open(path, 'a')
+        self.interval = interval
+        self.previous = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def loop(self):
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+    def report(self):
+        snap = self.telemetry.snapshot()
+        if self.previous is not None:
+            elapsed = max(1e-9, snap['time'] - self.previous['time'])
+            before = self.previous['counters']
+            snap['rates'] = {name: (value - before.get(name, 0)) / elapsed for name, value in snap['counters'].items()}
+        self.previous = snap
+        self.out.write(json.dumps(snap, sort_keys=True) + '\n')
+        self.out.flush()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.report()
+        if self.out is not sys.stdout:
+            self.out.close()
+
+class MetricsServer:
+    '''Serves the telemetry on a local port: /metrics in the Prometheus
+    text format and anything else as a JSON snapshot.
+    '''
+    def __init__(self, telemetry, port, host='127.0.0.1'):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/metrics':
+                    body, content_type = telemetry.prometheus(), 'text/plain; version=0.0.4'
+                else:
+                    body, content_type = json.dumps(telemetry.snapshot(), sort_keys=True), 'application/json'
+                body = body.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+# Shared by the clients, crawlers and writer of this process.
+telemetry = Telemetry()
@@ -0,0 +1,123 @@
+# ASU CSE 591
+# Author: Group 4
+
+import time
+
+import sqlalchemy.dialects.postgresql as psql
+
+from models import User, Location, Media, enqueue_users, finish_users
+from telemetry import telemetry, COUNT_BUCKETS
+
+class BulkWriter:
+    '''Buffers crawled users, locations and media in memory and writes them
+    in batches of multi-row INSERT ... ON CONFLICT statements. Rows that
+    already exist are skipped (locations, media) or updated (users) by the
+    database, so no existence checks are needed and duplicate keys cannot
+    raise IntegrityError. Changes to the shared frontier table are buffered
+    too, so that a user is only marked done in the transaction that
+    writes its rows.
+    '''
+    statement_rows = 1000
+
+    def __init__(self, session, batch_size=500, flush_interval=10.0):
+        '''session: The session whose transaction the batches are written in.
+        batch_size: Number of buffered rows that triggers a flush.
+        flush_interval: Seconds after which buffered rows are flushed regardless.
+        '''
+        self.session = session
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.users = {}
+        self.locations = {}
+        self.media = {}
+        self.enqueued = set()
+        self.finished = set()
+        self.last_flush = time.time()
+
+    def add_user(self, user):
+        '''Registers a User object. Its state is read when the batch is
+        flushed, so later changes to it are picked up.
+        '''
+        self.users[user.id] = user
+
+    def add_location(self, row):
+        self.locations.setdefault(row['id'], row)
+
+    def add_media(self, row):
+        self.media.setdefault(row['id'], row)
+
+    def enqueue(self, user_ids):
+        '''Buffers user ID's to be added to the frontier table.'''
+        self.enqueued.update(user_ids)
+
+    def finish(self, user_id):
+        '''Buffers removing a finished user from the frontier table.'''
+        self.finished.add(user_id)
+
+    def pending(self):
+        return len(self.users) + len(self.locations) + len(self.media) + len(self.enqueued) + len(self.finished)
+
+    def maybe_flush(self):
+        if self.pending() >= self.batch_size or time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        '''Writes every buffered row and commits. Users go first and media
+        last so that foreign keys are satisfied within the batch. Each table's
+        rows are written in primary key order, so concurrent writers lock
+        overlapping rows in the same order instead of deadlocking. If the
+        write fails the transaction is rolled back and the rows stay buffered
+        for the next flush.
+        '''
+        rows = self.pending()
+        start = time.time()
+        try:
+            users = [self.user_row(self.users[key]) for key in sorted(self.users)]
+            self.upsert(User.__table__, users, ['next_max_id', 'fully_scraped', 'private',
+                'media_count', 'geotagged_count', 'last_crawled', 'min_id', 'next_refresh'])
+            self.insert_ignore(Location.__table__, [self.locations[key] for key in sorted(self.locations)])
+            self.insert_ignore(Media.__table__, [self.media[key] for key in sorted(self.media)])
+            for chunk in self.chunks(sorted(self.enqueued)):
+                enqueue_users(self.session, chunk)
+            for chunk in self.chunks(sorted(self.finished)):
+                finish_users(self.session, chunk)
+            self.session.commit()
+        except:
+            self.session.rollback()
+            raise
+        finally:
+            self.last_flush = time.time()
+        self.users.clear()
+        self.locations.clear()
+        self.media.clear()
+        self.enqueued.clear()
+        self.finished.clear()
+        telemetry.observe('db.flush_seconds', time.time() - start)
+        telemetry.observe('db.flush_rows', rows, COUNT_BUCKETS)
+        telemetry.incr('db.rows_written', rows)
+
+    def user_row(self, user):
+        return {'id': user.id,
+            'next_max_id': user.next_max_id,
+            'fully_scraped': bool(user.fully_scraped),
+            'private': bool(user.private),
+            'media_count': user.media_count or 0,
+            'geotagged_count': user.geotagged_count or 0,
+            'last_crawled': user.last_crawled,
+            'min_id': user.min_id,
+            'next_refresh': user.next_refresh}
+
+    def chunks(self, rows):
+        for i in range(0, len(rows), self.statement_rows):
+            yield rows[i:i + self.statement_rows]
+
+    def insert_ignore(self, table, rows):
+        for chunk in self.chunks(rows):
+            self.session.execute(psql.insert(table).values(chunk).on_conflict_do_nothing())
+
+    def upsert(self, table, rows, update_columns):
+        for chunk in self.chunks(rows):
+            stmt = psql.insert(table).values(chunk)
+            stmt = stmt.on_conflict_do_update(index_elements=[table.c.id],
+                set_={c: getattr(stmt.excluded, c) for c in update_columns})
+            self.session.execute(stmt)
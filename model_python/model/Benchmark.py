@@ -0,0 +1,165 @@
+# ASU CSE 591
+# Author: Group 4
+
+# Latency benchmark of the scoring entry points over synthetic models of
+# increasing size (see SyntheticModel.py), so scaling regressions show up
+# without the production model. Every engine answers the same workload; the
+# models are generated once per (classes, seed) and reused from the work directory.
+#
+#   python Benchmark.py --classes 1000,10000,100000,1000000
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+import Evaluation
+import SyntheticModel
+
+
+CLASS_COUNTS = [1000, 10000, 100000]
+ENGINES = ['scan', 'memory', 'mmap', 'web']
+FILE_ENGINES = ['scan', 'mmap']     #the engines that rescan the whole model file for every query
+QUERIES = 1000
+MMAP_QUERIES = 20       #queries given to each of FILE_ENGINES
+WARMUP_QUERIES = 10
+
+
+
+#function returns the synthetic model file and workload for a class count, generating them if needed
+def syntheticFiles(work_dir, num_classes, num_queries, seed):
+    model_filename = os.path.join(work_dir, 'synthetic-{0}-{1}.csv'.format(num_classes, seed))
+    workload_filename = os.path.join(work_dir, 'synthetic-{0}-{1}-{2}.jsonl'.format(num_classes, seed, num_queries))
+
+    synthetic = SyntheticModel.SyntheticModel(num_classes, seed=seed)
+    if not os.path.exists(model_filename):
+        synthetic.writeModel(model_filename + '.tmp')
+        os.rename(model_filename + '.tmp', model_filename)
+    if not os.path.exists(workload_filename):
+        synthetic.writeQueries(workload_filename, num_queries)
+    return model_filename, workload_filename
+
+
+def readWorkload(workload_filename):
+    file = open(workload_filename, 'r')
+    try:
+        return [json.loads(line) for line in file]
+    finally:
+        file.close()
+
+
+#function returns (load seconds, score(request)) for an engine; scan is the original CLASSIFIER.findOptimalClass,
+#the baseline the others are measured against; web takes the raw json request like the flask route,
+#with the prediction cache disabled so it times the full request path on every query
+def loadEngine(name, model_filename):
+    start = time.time()
+    if name == 'scan':
+        import CLASSIFIER
+        score = lambda request: quietly(CLASSIFIER.findOptimalClass, request['tags'], model_filename, request['count'])
+    elif name == 'web':
+        import CLASSIFIER
+        import NaiveBayesModel
+        import PredictionCache
+        model = NaiveBayesModel.loadModel(model_filename)
+
+        #A CACHE THAT KEEPS NOTHING, SO WARM-UP QUERIES AND REPEATED TAG SETS ARE SCORED LIKE EVERY OTHER QUERY
+        CLASSIFIER.prediction_cache = PredictionCache.PredictionCache(max_entries=0)
+        score = lambda request: CLASSIFIER.webFacingFindOptimalClass(json.dumps(request), model)
+    else:
+        engine = Evaluation.loadEngines(model_filename, [name])[name]
+        score = lambda request: engine(request['tags'], request['count'])
+    return time.time() - start, score
+
+
+#function calls func with stdout sent to os.devnull; the original scan prints every prediction it makes
+def quietly(func, *args):
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        return func(*args)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+#function times every request and returns {queries, p50Ms, p99Ms, queriesPerSecond}
+def timeRequests(score, requests):
+    for request in requests[0:WARMUP_QUERIES]:
+        score(request)
+
+    latencies = []
+    for request in requests:
+        start = time.time()
+        score(request)
+        latencies.append(time.time() - start)
+
+    milliseconds = np.asarray(latencies) * 1000.0
+    return {
+        'queries': len(latencies),
+        'p50Ms': float(np.percentile(milliseconds, 50)),
+        'p99Ms': float(np.percentile(milliseconds, 99)),
+        'queriesPerSecond': len(latencies) / max(1e-9, sum(latencies)),
+    }
+
+
+#function benchmarks every engine on every model size and returns a list of result rows
+def runBenchmarks(work_dir, class_counts=CLASS_COUNTS, engine_names=ENGINES, num_queries=QUERIES,
+                  mmap_queries=MMAP_QUERIES, seed=0, verbose=True):
+    rows = []
+    for num_classes in class_counts:
+        model_filename, workload_filename = syntheticFiles(work_dir, num_classes, num_queries, seed)
+        requests = readWorkload(workload_filename)
+
+        for name in engine_names:
+            load_seconds, score = loadEngine(name, model_filename)
+            result = timeRequests(score, requests[0:mmap_queries] if name in FILE_ENGINES else requests)
+            result.update({'classes': num_classes, 'engine': name, 'loadSeconds': load_seconds})
+            rows.append(result)
+            if verbose:
+                printRow(result)
+    return rows
+
+
+def printHeader():
+    print(''.join('{0:>12}'.format(column) for column in
+        ['classes', 'engine', 'load s', 'queries', 'p50 ms', 'p99 ms', 'queries/s']))
+
+
+def printRow(row):
+    print(''.join('{0:>12}'.format(column) for column in [row['classes'], row['engine'],
+        '{0:.2f}'.format(row['loadSeconds']), row['queries'], '{0:.3f}'.format(row['p50Ms']),
+        '{0:.3f}'.format(row['p99Ms']), '{0:.1f}'.format(row['queriesPerSecond'])]))
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the scoring engines on synthetic models.')
+    parser.add_argument('-c', '--classes', default=','.join(str(count) for count in CLASS_COUNTS),
+        help='Comma separated model sizes in classes.')
+    parser.add_argument('-e', '--engines', default=','.join(ENGINES),
+        help='Comma separated engines out of scan, web, ' + ', '.join(Evaluation.ENGINES) + '.')
+    parser.add_argument('-q', '--queries', type=int, default=QUERIES)
+    parser.add_argument('-m', '--mmap-queries', type=int, default=MMAP_QUERIES,
+        help='Queries given to the engines that rescan the model file, ' + ', '.join(FILE_ENGINES) + '.')
+    parser.add_argument('-d', '--work-dir', default='.', help='Where synthetic models are kept between runs.')
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', help='Also write the results as json to this file.')
+    args = parser.parse_args()
+
+    printHeader()
+    rows = runBenchmarks(args.work_dir, [int(count) for count in args.classes.split(',')], args.engines.split(','),
+        args.queries, args.mmap_queries, args.seed)
+
+    if args.output is not None:
+        file = open(args.output, 'w')
+        try:
+            json.dump(rows, file, indent=2)
+        finally:
+            file.close()
+
+
+if __name__ == '__main__':
+    main()
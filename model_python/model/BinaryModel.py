@@ -0,0 +1,251 @@
+# ASU CSE 591
+# Author: Group 4
+
+# Compact binary model format. All sections are little-endian and 8-byte aligned:
+#
+#   header          magic, version, smoothing constant, class/tag/posting counts, string table sizes
+#   priors          float64[classes]
+#   latitudes       float64[classes]
+#   longitudes      float64[classes]
+#   denominators    int64[classes]
+#   logPriors       float64[classes]     log(prior)
+#   logMisses       float64[classes]     log(s / (denominator + s)), a query tag the class never saw
+#   classOffsets    int64[classes+1]     into the class name string table
+#   classNames      utf-8 bytes
+#   tagOffsets      int64[tags+1]        into the tag string table, tags sorted by their utf-8 bytes
+#   tagNames        utf-8 bytes
+#   postingOffsets  int64[tags+1]        into the posting arrays
+#   postingClasses  int32[postings]      classes containing each tag
+#   postingCounts   int32[postings]      occurrences of the tag in that class
+#
+# The loader mmaps the file and wraps every section with numpy.frombuffer, so worker
+# processes share one page-cached copy and nothing is parsed at startup.
+
+import mmap
+import os
+import struct
+import sys
+
+import numpy as np
+
+import Metrics
+import NaiveBayesModel
+import ScoreRanking
+
+
+MAGIC = b'IPNB'
+VERSION = 1
+HEADER = struct.Struct('<4sIdQQQQQ')
+
+
+
+def align(offset):
+    return (offset + 7) & ~7
+
+
+#function converts a comma-separated model file into the binary layout, publishing it atomically
+def writeBinaryModel(model_filename, binary_filename, smoothing_constant=NaiveBayesModel.SMOOTHING_CONSTANT):
+
+    model = NaiveBayesModel.loadModel(model_filename, smoothing_constant)
+    writeModel(model, binary_filename)
+
+    #THE MANIFEST SAYS HOW THE MODEL'S TAGS WERE NORMALIZED, WHICH THE BINARY COPY NEEDS AS WELL
+    manifest = NaiveBayesModel.readManifest(model_filename)
+    if manifest is not None:
+        NaiveBayesModel.writeManifest(binary_filename, manifest)
+
+
+#function writes an in-memory NaiveBayesModel into the binary layout
+def writeModel(model, binary_filename):
+
+    smoothing_constant = model.smoothing
+    priors = np.asarray(model.priors, dtype='<f8')
+    denominators = np.asarray(model.denominators, dtype='<i8')
+    with np.errstate(divide='ignore'):
+        log_priors = np.log(priors)
+    log_misses = np.log(smoothing_constant) - np.log(denominators + smoothing_constant)
+
+    class_offsets, class_names = stringTable([name.encode('utf-8') for name in model.classes])
+
+    #SORT THE TAG TABLE BY BYTES SO LOOKUPS CAN BISECT WITHOUT BUILDING A DICT
+    tags = sorted(model.postings, key=lambda tag: tag.encode('utf-8'))
+    tag_offsets, tag_names = stringTable([tag.encode('utf-8') for tag in tags])
+
+    posting_offsets = [0]
+    posting_classes = []
+    posting_counts = []
+    for tag in tags:
+        posting = model.postings[tag]
+        for index in sorted(posting):
+            posting_classes.append(index)
+            posting_counts.append(posting[index])
+        posting_offsets.append(len(posting_classes))
+
+    sections = [
+        priors,
+        np.asarray(model.latitudes, dtype='<f8'),
+        np.asarray(model.longitudes, dtype='<f8'),
+        denominators,
+        log_priors.astype('<f8'),
+        log_misses.astype('<f8'),
+        class_offsets,
+        class_names,
+        tag_offsets,
+        tag_names,
+        np.asarray(posting_offsets, dtype='<i8'),
+        np.asarray(posting_classes, dtype='<i4'),
+        np.asarray(posting_counts, dtype='<i4'),
+    ]
+
+    header = HEADER.pack(MAGIC, VERSION, smoothing_constant, model.numClasses(), len(tags),
+                         len(posting_classes), len(class_names), len(tag_names))
+
+    #WRITE BESIDE THE TARGET AND RENAME, SO READERS NEVER MAP A HALF-WRITTEN FILE
+    temp_filename = binary_filename + '.tmp'
+    out = open(temp_filename, 'wb')
+    try:
+        out.write(header)
+        offset = len(header)
+        for section in sections:
+            padding = align(offset) - offset
+            out.write(b'\0' * padding)
+            data = section.tobytes() if hasattr(section, 'tobytes') else section
+            out.write(data)
+            offset += padding + len(data)
+    finally:
+        out.close()
+    os.rename(temp_filename, binary_filename)
+
+
+def stringTable(strings):
+    offsets = [0]
+    for s in strings:
+        offsets.append(offsets[-1] + len(s))
+    return np.asarray(offsets, dtype='<i8'), b''.join(strings)
+
+
+#function mmaps a binary model file and returns a BinaryModel reading it in place
+def loadBinaryModel(binary_filename):
+
+    file = open(binary_filename, 'rb')
+    try:
+        buf = mmap.mmap(file.fileno(), length=0, access=mmap.ACCESS_READ)
+    finally:
+        file.close()
+    return BinaryModel(buf)
+
+
+
+#Naive Bayes model scored in log space directly from the memory-mapped binary layout
+class BinaryModel:
+
+    def __init__(self, buf):
+        magic, version, smoothing_constant, num_classes, num_tags, num_postings, class_bytes, tag_bytes = \
+            HEADER.unpack_from(buf, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('Not an insta-predict binary model (version {0})'.format(VERSION))
+
+        self.buf = buf
+        self.smoothing = smoothing_constant
+        self.offset = HEADER.size
+
+        self.priors = self.section('<f8', num_classes)
+        self.latitudes = self.section('<f8', num_classes)
+        self.longitudes = self.section('<f8', num_classes)
+        self.denominators = self.section('<i8', num_classes)
+        self.logPriors = self.section('<f8', num_classes)
+        self.logMisses = self.section('<f8', num_classes)
+        self.classOffsets = self.section('<i8', num_classes + 1)
+        self.classNames = self.section('u1', class_bytes)
+        self.tagOffsets = self.section('<i8', num_tags + 1)
+        self.tagNames = self.section('u1', tag_bytes)
+        self.postingOffsets = self.section('<i8', num_tags + 1)
+        self.postingClasses = self.section('<i4', num_postings)
+        self.postingCounts = self.section('<i4', num_postings)
+
+
+    #zero-copy view of the next aligned section of the file
+    def section(self, dtype, count):
+        self.offset = align(self.offset)
+        array = np.frombuffer(self.buf, dtype=dtype, count=count, offset=self.offset)
+        self.offset += array.nbytes
+        return array
+
+
+    def numClasses(self):
+        return len(self.priors)
+
+
+    def numTags(self):
+        return len(self.tagOffsets) - 1
+
+
+    def className(self, index):
+        return self.classNames[self.classOffsets[index]:self.classOffsets[index + 1]].tobytes().decode('utf-8')
+
+
+    def tagName(self, tag_id):
+        return self.tagNames[self.tagOffsets[tag_id]:self.tagOffsets[tag_id + 1]].tobytes()
+
+
+    #binary search of the sorted tag table, returns the tag id or None
+    def tagId(self, tag):
+        key = tag.encode('utf-8')
+        lo = 0
+        hi = self.numTags()
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.tagName(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.numTags() and self.tagName(lo) == key:
+            return lo
+        return None
+
+
+    #returns (classes, counts) for every class containing the tag
+    def posting(self, tag_id):
+        start = self.postingOffsets[tag_id]
+        end = self.postingOffsets[tag_id + 1]
+        return self.postingClasses[start:end], self.postingCounts[start:end]
+
+
+    #returns the log posterior of every class for one tag set
+    def logPosteriors(self, Given_Tags):
+        scores = self.logPriors + len(Given_Tags) * self.logMisses
+        for tag in Given_Tags:
+            tag_id = self.tagId(tag)
+            if tag_id is not None:
+                classes, counts = self.posting(tag_id)
+                scores[classes] += np.log1p(counts / self.smoothing)
+        return scores
+
+
+    #always scored in log space; logSpace is accepted for interface compatibility with NaiveBayesModel
+    def findOptimalClass(self, Given_Tags, return_num, logSpace=True):
+
+        #IGNORE EMPTY TAG SETS
+        if Given_Tags == []:
+            return []
+
+        Metrics.recordScan(self.numClasses())
+        top, confidences = ScoreRanking.rankLogPosteriors(self.logPosteriors(Given_Tags)[np.newaxis, :], return_num)
+        return ScoreRanking.buildCoordinates(top[0], confidences[0], self.latitudes, self.longitudes)
+
+
+    def findOptimalClasses(self, tag_sets, return_num, logSpace=True):
+        return [self.findOptimalClass(tags, return_num) for tags in tag_sets]
+
+
+
+def main():
+    if len(sys.argv) != 3:
+        print('Usage: python BinaryModel.py MODELFILE BINARYFILE')
+        return
+
+    writeBinaryModel(sys.argv[1], sys.argv[2])
+
+
+if __name__ == '__main__':
+    main()
@@ -2,17 +2,191 @@
 # Author: Group 4
 
 import UtilityClasses
-import operator
-import codecs
-import platform
+import Metrics
+import NaiveBayesModel
+import PredictionCache
+import TagNormalizer
 import json
-import mmap
+import math
+import os
+import threading
+import time
 
 
+#the model file served when no filename is given; INSTA_PREDICT_MODEL overrides it per deployment
+MODEL_FILENAME = os.environ.get('INSTA_PREDICT_MODEL', '/home/ubuntu/workspace/new_sorted_labeled.csv')
+#MODEL_FILENAME = r'C:\Users\Vincent\workspace\cse591_swm_project\new_sorted_labeled.csv'
+
+LOG_SPACE_SCORING = True
+
+CACHE_MAX_ENTRIES = 10000
+CACHE_TTL = 300
+
+RELOAD_CHECK_INTERVAL = 5.0     #seconds between checks for a newly published model file
+WARMUP_TAG_COUNTS = range(1, 9) #query lengths scored once at startup so their per-length baselines are built
+
+resident_model = None
+resident_model_filename = None
+resident_model_mtime = None
+prediction_cache = None
+reload_lock = threading.Lock()
+reloading = False
+last_reload_check = 0
+ready = False
+warmup_seconds = None
+
+
+
+#function returns the in-memory model, parsing the model file only on first use
+#binary models (see BinaryModel.py) are memory-mapped instead, so WSGI processes share one copy
+#when a new version of the file is published (see ModelUpdate.py) it is loaded in the background and swapped in
+def getModel(model_filename=None):
+    global resident_model, resident_model_filename, resident_model_mtime
+
+    if resident_model is None:
+        with reload_lock:
+            if resident_model is None:
+                model_filename = model_filename or MODEL_FILENAME
+                resident_model_filename = model_filename
+                resident_model_mtime = readModelMtime(model_filename)
+                resident_model = loadModelFile(model_filename)
+    else:
+        checkForNewModel()
+    return resident_model
+
+
+#function loads the model, scores a query of every length in WARMUP_TAG_COUNTS and marks the process ready
+#servers call it before taking traffic so the first requests are not the ones paying for the load
+def preload(model_filename=None):
+    global ready, warmup_seconds
+
+    model = getModel(model_filename)
+    getCache()
+
+    start = time.time()
+    warmUp(model)
+    warmup_seconds = time.time() - start
+    Metrics.MODEL_WARMUP_SECONDS.set(warmup_seconds)
+    ready = True
+    return model
+
+
+#scores tag sets no class contains; that builds the baselines shared by every query of the same length
+#and, for binary models, faults in the per-class arrays of the mapped file
+def warmUp(model):
+    for count in WARMUP_TAG_COUNTS:
+        model.findOptimalClass(['__warmup{0}__'.format(ii) for ii in range(count)], 1, LOG_SPACE_SCORING)
+
+
+#returns whether the model is resident and warm, with what a readiness probe needs to know about it
+def status():
+    return {
+        'ready': ready,
+        'modelFilename': resident_model_filename,
+        'modelResident': resident_model is not None,
+        'classes': resident_model.numClasses() if resident_model is not None else None,
+        'warmupSeconds': warmup_seconds,
+        'reloading': reloading,
+    }
+
+
+def loadModelFile(model_filename):
+    start = time.time()
+    if model_filename.endswith('.bin'):
+        import BinaryModel
+        model = BinaryModel.loadBinaryModel(model_filename)
+    else:
+        model = NaiveBayesModel.loadModel(model_filename)
+
+    #HOW THE MODEL'S TRAINING TAGS WERE NORMALIZED, SO QUERIES ARE NORMALIZED ALIKE (SEE TagNormalizer.py)
+    manifest = NaiveBayesModel.readManifest(model_filename) or {}
+    model.tagNormalization = manifest.get('tagNormalization')
+
+    Metrics.MODEL_LOAD_SECONDS.set(time.time() - start)
+    Metrics.MODEL_LOADS.inc()
+    Metrics.MODEL_CLASSES.set(model.numClasses())
+    return model
+
+
+#returns the tag normalization version a model was trained with, looking through a ModelServer to its model;
+#models loaded without reading a manifest (e.g. by NaiveBayesModel.loadModel directly) are assumed to be current
+def tagNormalizationOf(model):
+    model = getattr(model, 'model', model)
+    return getattr(model, 'tagNormalization', TagNormalizer.VERSION)
+
+
+def readModelMtime(model_filename):
+    try:
+        return os.path.getmtime(model_filename)
+    except OSError:
+        return None
+
+
+#starts a background reload once the model file's mtime changes, checking at most every RELOAD_CHECK_INTERVAL seconds
+#requests keep scoring against the old model until the new one is fully loaded
+def checkForNewModel():
+    global reloading, last_reload_check
+
+    now = time.time()
+    if reloading or now - last_reload_check < RELOAD_CHECK_INTERVAL:
+        return
+    with reload_lock:
+        if reloading or now - last_reload_check < RELOAD_CHECK_INTERVAL:
+            return
+        last_reload_check = now
+        mtime = readModelMtime(resident_model_filename)
+        if mtime is None or mtime == resident_model_mtime:
+            return
+        reloading = True
+
+    thread = threading.Thread(target=reloadModel, args=(mtime,))
+    thread.daemon = True
+    thread.start()
+
+
+def reloadModel(mtime):
+    global resident_model, resident_model_mtime, reloading
+
+    try:
+        model = loadModelFile(resident_model_filename)
+
+        #SWAP THE REFERENCE; REQUESTS ALREADY SCORING FINISH ON THE OLD MODEL
+        resident_model = model
+        resident_model_mtime = mtime
+        if prediction_cache is not None:
+            prediction_cache.invalidate()
+    except Exception:
+        #A FAILED LOAD KEEPS THE OLD MODEL; THE NEXT CHECK RETRIES
+        pass
+    finally:
+        reloading = False
+
+
+#function returns the prediction cache in front of the resident model, cleared whenever the model file changes
+def getCache():
+    global prediction_cache
+
+    if prediction_cache is None:
+        prediction_cache = PredictionCache.PredictionCache(CACHE_MAX_ENTRIES, CACHE_TTL, resident_model_filename)
+        Metrics.registerCollector(collectCacheMetrics)
+    return prediction_cache
+
+
+#reports the prediction cache's counters on every /metrics scrape
+def collectCacheMetrics():
+    stats = prediction_cache.stats()
+    return [
+        ('cache_hits_total', 'counter', 'Predictions answered from the cache.', [({}, stats['hits'])]),
+        ('cache_misses_total', 'counter', 'Predictions scored because they were not cached.', [({}, stats['misses'])]),
+        ('cache_entries', 'gauge', 'Predictions currently cached.', [({}, stats['entries'])]),
+    ]
+
 
 #function searches through the provided model file, calculates posterior probabilities, and returns most likely class(es)
 def findOptimalClass(Given_Tags, model_filename, return_num):
 
+    import codecs
+
     #OPEN FILE USING UNICODE
     file = codecs.open(model_filename, mode = 'rb', encoding = 'utf-8')
 
@@ -89,7 +263,11 @@ def findOptimalClass(Given_Tags, model_filename, return_num):
 
 
 #FASTER function searches through the provided model file, calculates posterior probabilities, and returns most likely class(es)
-def findOptimalClassMmap(Given_Tags, model_filename, return_num):
+#logSpace accumulates log-probabilities so long tag lists do not underflow to 0.0
+def findOptimalClassMmap(Given_Tags, model_filename, return_num, logSpace=False):
+
+    import codecs
+    import mmap
 
     smoothing_constant = 0.001
 
@@ -104,6 +282,7 @@ def findOptimalClassMmap(Given_Tags, model_filename, return_num):
     else:
         p = UtilityClasses.Probability()
         index = 0
+        scan_start = time.time()
 
         #ITERATE THROUGH EACH CLASS
         while True:
@@ -125,14 +304,26 @@ def findOptimalClassMmap(Given_Tags, model_filename, return_num):
             denominator = last_tag_index - 4        #number of tags found in class
 
 
-            temp_likilihood = 1
-            for tag in Given_Tags:
+            if logSpace:
+                temp_likilihood = 0
+                for tag in Given_Tags:
 
-                #CALCULATE LIKILIHOOD RATIO
-                temp_likilihood *= (Tags.count(tag) + smoothing_constant) / (float(denominator) + smoothing_constant)
+                    #ACCUMULATE LOG LIKILIHOOD RATIO
+                    temp_likilihood += math.log((Tags.count(tag) + smoothing_constant) / (float(denominator) + smoothing_constant))
+
+                #CALCULATE LOG POSTERIOR PROBABILITY
+                temp_posterior = temp_likilihood + NaiveBayesModel.safeLog(float(p.priors[index]))
+
+            else:
+                temp_likilihood = 1
+                for tag in Given_Tags:
+
+                    #CALCULATE LIKILIHOOD RATIO
+                    temp_likilihood *= (Tags.count(tag) + smoothing_constant) / (float(denominator) + smoothing_constant)
+
+                #CALCULATE POSTERIOR PROBABILITY
+                temp_posterior = temp_likilihood * float(p.priors[index])
 
-            #CALCULATE POSTERIOR PROBABILITY
-            temp_posterior = temp_likilihood * float(p.priors[index])
             p.posteriors.append(temp_posterior)
 
 
@@ -141,28 +332,35 @@ def findOptimalClassMmap(Given_Tags, model_filename, return_num):
 
 
 
-        #SORT ON CLASSNAME
-        posteriors = p.posteriors[:]
-        posteriors.sort()
-        posteriors.reverse()
-        normalizing_val = sum(posteriors)
-        if normalizing_val == 0:
-            normalizing_val =1
+        Metrics.observeStage('scan', time.time() - scan_start)
+        Metrics.recordScan(index)
+        results_start = time.time()
 
+        #SELECT THE TOP CLASSES WITH A BOUNDED HEAP, TIES GO TO THE LOWER CLASS NUMBER
+        highest = NaiveBayesModel.highestScores(p.posteriors, range(len(p.posteriors)), return_num)
 
-        highest_probs = posteriors[0:return_num]
+        if logSpace:
+            log_normalizing_val = NaiveBayesModel.logSumExp(p.posteriors)
+        else:
+            normalizing_val = sum(p.posteriors)
+            if normalizing_val == 0:
+                normalizing_val =1
 
 
         classes = []
-        for ii in highest_probs:
+        for index in highest:
             c = UtilityClasses.Coordinates()
-            c.confidence = float(ii) / normalizing_val
-            index = int(p.posteriors.index(ii))
+            if logSpace:
+                c.confidence = NaiveBayesModel.logConfidence(p.posteriors[index], log_normalizing_val)
+            else:
+                c.confidence = float(p.posteriors[index]) / normalizing_val
             c.classNum = int(index)
             c.lat = float(p.latitudes[index])
             c.lon = float(p.longitudes[index])
             classes.append(c)
 
+        Metrics.observeStage('results', time.time() - results_start)
+
         #print 'The top {0} classes and their longitude include: '.format(return_num)
         #for ii in classes:
             #print 'Class: {0}, Lat/Long: {1},{2}, Confidence: {3}'.format(c.classNum, ii.lat, ii.lon, ii.confidence)
@@ -172,26 +370,111 @@ def findOptimalClassMmap(Given_Tags, model_filename, return_num):
 
 
 #function is web-facing.  It takes a returns a json object
-def webFacingFindOptimalClass(json_request):
+def webFacingFindOptimalClass(json_request, model=None):
+
+    with Metrics.timer('decode'):
+        json_req = json.loads(json_request)
 
-    json_req = json.loads(json_request)
-    #filename = r'C:\Users\Vincent\workspace\cse591_swm_project\new_sorted_labeled.csv'
-    filename = '/home/ubuntu/workspace/new_sorted_labeled.csv'
+        #READ THE CACHE GENERATION BEFORE THE MODEL, SO A MISS SCORED ON A MODEL THAT A RELOAD REPLACES MEANWHILE IS NOT STORED
+        generation = prediction_cache.generation if prediction_cache is not None else None
+        if model is None:
+            model = getModel()
 
-    #tags = given_tags.split(',')
-    tags = list(json_req['tags'])
-    numClasses = int(json_req['count'])
+        #tags = given_tags.split(',')
+        #NORMALIZED AS THE TRAINING SAMPLES WERE (SEE TagNormalizer.py)
+        tags = PredictionCache.normalizeQueryTags(json_req['tags'], tagNormalizationOf(model))
+        numClasses = int(json_req['count'])
 
 
     #classes = findOptimalClass(tags, filename, numClasses)
-    classes = findOptimalClassMmap(tags, filename, numClasses)
+    #classes = findOptimalClassMmap(tags, filename, numClasses)
+    #HOT TAG SETS ARE ANSWERED FROM THE CACHE; MISSES SCORE THE NORMALIZED TAG SET
+    with Metrics.timer('lookup'):
+        classes = getCache().lookup(tags, numClasses, lambda tags, count: scoreQuery(model, tags, count), generation)
 
     #all_json = []
     #for ii in classes:
     #    json_obj = json.dumps(ii.__dict__)
     #    all_json.append(json_obj)
     #print 'ok got here'
-    json_string = json.dumps([ii.__dict__ for ii in classes])
+    with Metrics.timer('serialize'):
+        json_string = json.dumps([ii.__dict__ for ii in classes])
     #print json_string
 
     return json_string
+
+
+#scores a cache miss, timed separately from the lookup so cache hits and model time can be told apart
+def scoreQuery(model, tags, count):
+    with Metrics.timer('score'):
+        return model.findOptimalClass(tags, count, LOG_SPACE_SCORING)
+
+
+#function is web-facing.  It takes a json array of {tags, count, param} requests (see model_scala/README.md)
+#and returns a json array of responses in the same order, scoring the whole batch together
+def webFacingFindOptimalClasses(json_request, model=None):
+
+    json_reqs = json.loads(json_request)
+    if not isinstance(json_reqs, list):
+        raise ValueError('Batch request must be a JSON array')
+    if model is None:
+        model = getModel()
+
+    responses = [None] * len(json_reqs)
+    tag_sets = []
+    counts = []
+    positions = []
+    for ii, json_req in enumerate(json_reqs):
+        try:
+            if not isinstance(json_req, dict):
+                raise ValueError('request must be a JSON object')
+            if 'tags' not in json_req:
+                raise ValueError('tags is required')
+            tags = json_req['tags']
+            if not isinstance(tags, list):
+                raise ValueError('tags must be an array')
+            try:
+                count = int(json_req.get('count', 1))
+            except (TypeError, ValueError):
+                raise ValueError('count must be an integer')
+            if count < 0:
+                raise ValueError('count must not be negative')
+            tag_set = PredictionCache.normalizeQueryTags(tags, tagNormalizationOf(model))
+
+            #NO MORE CLASSES THAN THE MODEL HAS, SO ONE HUGE COUNT CANNOT INFLATE THE WHOLE BATCH'S RANKING
+            counts.append(min(count, model.numClasses()))
+            tag_sets.append(tag_set)
+            positions.append(ii)
+        except ValueError as exc:
+            responses[ii] = {'status': 400, 'error': str(exc), 'param': paramOf(json_req), 'results': []}
+        except Exception:
+            #ANYTHING ELSE, E.G. A TAG THAT IS NOT A STRING, GETS A FIXED MESSAGE RATHER THAN THE EXCEPTION'S TEXT
+            responses[ii] = {'status': 400, 'error': 'invalid request', 'param': paramOf(json_req), 'results': []}
+
+    #SCORE FOR THE LARGEST COUNT ONCE, EACH REQUEST KEEPS ITS OWN PREFIX OF THE RANKING
+    if len(tag_sets) > 0:
+        with Metrics.timer('score'):
+            batch = model.findOptimalClasses(tag_sets, max(counts), LOG_SPACE_SCORING)
+        for ii, classes, count in zip(positions, batch, counts):
+            responses[ii] = buildResponse(classes[0:count], paramOf(json_reqs[ii]))
+
+    with Metrics.timer('serialize'):
+        return json.dumps(responses)
+
+
+def paramOf(json_req):
+    if isinstance(json_req, dict):
+        return json_req.get('param')
+    return None
+
+
+#function builds one response object in the format described in model_scala/README.md
+def buildResponse(classes, param):
+    results = []
+    for ii in classes:
+        results.append({
+            'center': [ii.lat, ii.lon],
+            'polygon': [[ii.lat, ii.lon]],
+            'confidence': ii.confidence,
+        })
+    return {'status': 200, 'param': param, 'results': results}
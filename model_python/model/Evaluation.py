@@ -0,0 +1,206 @@
+# ASU CSE 591
+# Author: Group 4
+
+# k-fold cross validation of the classifier together with a latency benchmark
+# of every scoring engine.
+#
+# Every sample is given a random fold. For each fold a model is built from the
+# other folds (ModelBuilder, one fold per pool process), and that fold's held-out
+# samples are scored by each engine. A prediction is correct at level n when the
+# sample's own cell (the nearest class center) is among the top n classes, which
+# is how ModelGen.crossValidate measures accuracy. Distance error is measured
+# from the sample to the top class's center.
+
+import argparse
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+import ModelBuilder
+import NaiveBayesModel
+import PredictionCache
+import SpatialIndex
+
+
+FOLDS = 5
+LEVELS = [1, 4, 16]
+QUERIES_PER_FOLD = 1000
+ENGINES = ['memory', 'vectorized', 'binary', 'mmap']
+
+#fold of every sample, set before the pool forks so workers inherit it
+sample_folds = None
+
+
+
+#function gives every well formed sample a random fold
+def assignFolds(sample_filename, folds, seed):
+    num_samples = sum(1 for sample in ModelBuilder.readSamples(sample_filename))
+    return np.random.RandomState(seed).randint(0, folds, num_samples).astype(np.uint8)
+
+
+#runs in a pool process: builds the model of one fold from every other fold's samples
+def buildFold(args):
+    sample_filename, model_filename, fold, samples_per_class, seed = args
+    start = time.time()
+    ModelBuilder.buildModel(sample_filename, model_filename, samples_per_class, seed,
+        keep=lambda index: sample_folds[index] != fold)
+    return time.time() - start
+
+
+#function returns {engine name: findOptimalClass(Given_Tags, return_num)} for one fold's model file
+def loadEngines(model_filename, names):
+    engines = {}
+    for name in names:
+        if name == 'memory':
+            model = NaiveBayesModel.loadModel(model_filename)
+        elif name == 'vectorized':
+            import VectorizedModel
+            model = VectorizedModel.loadVectorizedModel(model_filename)
+        elif name == 'binary':
+            import BinaryModel
+            BinaryModel.writeBinaryModel(model_filename, model_filename + '.bin')
+            model = BinaryModel.loadBinaryModel(model_filename + '.bin')
+        elif name == 'mmap':
+            import CLASSIFIER
+            engines[name] = lambda tags, count: CLASSIFIER.findOptimalClassMmap(tags, model_filename, count, True)
+            continue
+        else:
+            raise ValueError('Unknown engine: ' + name)
+        engines[name] = (lambda model: lambda tags, count: model.findOptimalClass(tags, count, True))(model)
+    return engines
+
+
+#function returns up to num_queries (tags, lat, lon) held-out samples of a fold, skipping ones without tags
+def heldOutSamples(sample_filename, fold, num_queries):
+    samples = []
+    for tags, lat, lon in ModelBuilder.readSamples(sample_filename, lambda index: sample_folds[index] == fold):
+        if len(tags) > 0:
+            samples.append((PredictionCache.normalizeQueryTags(tags), lat, lon))
+            if len(samples) >= num_queries:
+                break
+    return samples
+
+
+
+#accumulates the accuracy, distance error and latency of one engine across folds
+class EngineResults:
+
+    def __init__(self, levels):
+        self.levels = levels
+        self.hits = [0] * len(levels)
+        self.queries = 0
+        self.errors = []
+        self.latencies = []
+
+
+    def add(self, classes, truth, lat, lon, elapsed):
+        self.queries += 1
+        self.latencies.append(elapsed)
+        ranked = [c.classNum for c in classes]
+        for ii, level in enumerate(self.levels):
+            if truth in ranked[0:level]:
+                self.hits[ii] += 1
+        if len(classes) > 0:
+            self.errors.append(SpatialIndex.haversineDistance(lat, lon, classes[0].lat, classes[0].lon))
+
+
+    def summary(self):
+        latencies = np.asarray(self.latencies) * 1000.0
+        return {
+            'queries': self.queries,
+            'accuracy': [float(hits) / max(1, self.queries) for hits in self.hits],
+            'meanErrorKm': float(np.mean(self.errors)) if len(self.errors) > 0 else float('nan'),
+            'p50Ms': float(np.percentile(latencies, 50)) if self.queries > 0 else float('nan'),
+            'p99Ms': float(np.percentile(latencies, 99)) if self.queries > 0 else float('nan'),
+            'queriesPerSecond': self.queries / max(1e-9, float(np.sum(self.latencies))),
+        }
+
+
+
+#function cross validates every engine and returns {engine name: summary}
+def crossValidate(sample_filename, folds=FOLDS, samples_per_class=ModelBuilder.SAMPLES_PER_CLASS, levels=LEVELS,
+                  num_queries=QUERIES_PER_FOLD, engine_names=ENGINES, processes=None, seed=0, verbose=True):
+    global sample_folds
+
+    sample_folds = assignFolds(sample_filename, folds, seed)
+    work_dir = tempfile.mkdtemp(prefix='crossvalidate')
+    try:
+        model_filenames = [os.path.join(work_dir, 'fold{0}.csv'.format(fold)) for fold in range(folds)]
+
+        #TRAIN EVERY FOLD IN PARALLEL; FORK SO THE WORKERS INHERIT THE FOLD ASSIGNMENT
+        if hasattr(multiprocessing, 'get_context'):
+            pool = multiprocessing.get_context('fork').Pool(processes or min(folds, multiprocessing.cpu_count()))
+        else:
+            pool = multiprocessing.Pool(processes or min(folds, multiprocessing.cpu_count()))
+        try:
+            build_times = pool.map(buildFold, [(sample_filename, model_filenames[fold], fold, samples_per_class, seed)
+                for fold in range(folds)])
+        finally:
+            pool.close()
+            pool.join()
+
+        #SCORE ONE ENGINE AT A TIME IN THIS PROCESS SO LATENCIES ARE NOT SKEWED BY TRAINING
+        results = dict((name, EngineResults(levels)) for name in engine_names)
+        for fold in range(folds):
+            model = NaiveBayesModel.loadModel(model_filenames[fold])
+            samples = heldOutSamples(sample_filename, fold, num_queries)
+            truths = SpatialIndex.forModel(model).assign(
+                [sample[1] for sample in samples], [sample[2] for sample in samples]).tolist()
+
+            engines = loadEngines(model_filenames[fold], engine_names)
+            for name in engine_names:
+                score = engines[name]
+                for (tags, lat, lon), truth in zip(samples, truths):
+                    start = time.time()
+                    classes = score(tags, max(levels))
+                    results[name].add(classes, truth, lat, lon, time.time() - start)
+
+            if verbose:
+                print('Fold {0}: {1} classes built in {2:.1f}s, {3} queries'.format(
+                    fold, model.numClasses(), build_times[fold], len(samples)))
+
+        return dict((name, results[name].summary()) for name in engine_names)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def printSummary(summaries, engine_names, levels):
+    header = ['engine', 'queries'] + ['top-{0}'.format(level) for level in levels] + ['mean km', 'p50 ms', 'p99 ms', 'queries/s']
+    print(''.join('{0:>12}'.format(column) for column in header))
+    for name in engine_names:
+        summary = summaries[name]
+        row = [name, summary['queries']] + ['{0:.4f}'.format(accuracy) for accuracy in summary['accuracy']]
+        row += ['{0:.1f}'.format(summary['meanErrorKm']), '{0:.3f}'.format(summary['p50Ms']),
+            '{0:.3f}'.format(summary['p99Ms']), '{0:.1f}'.format(summary['queriesPerSecond'])]
+        print(''.join('{0:>12}'.format(column) for column in row))
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cross validates the classifier and benchmarks its scoring engines.')
+    parser.add_argument('samples', help='Sample CSV written by crawler/export.py.')
+    parser.add_argument('-k', '--folds', type=int, default=FOLDS)
+    parser.add_argument('-n', '--samples-per-class', type=int, default=ModelBuilder.SAMPLES_PER_CLASS)
+    parser.add_argument('-l', '--levels', default=','.join(str(level) for level in LEVELS),
+        help='Comma separated top-n accuracy levels.')
+    parser.add_argument('-q', '--queries', type=int, default=QUERIES_PER_FOLD,
+        help='Held-out samples scored per fold; mmap rescans the model file for each one.')
+    parser.add_argument('-e', '--engines', default=','.join(ENGINES),
+        help='Comma separated engines out of ' + ', '.join(ENGINES) + '.')
+    parser.add_argument('-p', '--processes', type=int, help='Folds trained at once.')
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    levels = [int(level) for level in args.levels.split(',')]
+    engine_names = args.engines.split(',')
+    summaries = crossValidate(args.samples, args.folds, args.samples_per_class, levels, args.queries,
+        engine_names, args.processes, args.seed)
+    printSummary(summaries, engine_names, levels)
+
+
+if __name__ == '__main__':
+    main()
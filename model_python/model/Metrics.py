@@ -0,0 +1,264 @@
+# ASU CSE 591
+# Author: Group 4
+
+# In-process metrics of the prediction path, exposed in the Prometheus text format
+# (see the /metrics route in webapp/config/flaskr.py).
+#
+# Stage timers split a request into building the request json, decoding it, the
+# cache lookup, scoring on a miss, the model scan and result construction inside
+# the scorers, and serializing the response. Every metric lives in this process;
+# under a multi-process WSGI server each process reports its own.
+#
+# SlowRequestProfiler runs cProfile over a sample of requests and keeps a .prof
+# dump of the ones slower than a threshold. The dumps open with pstats, snakeviz,
+# or flameprof (for a flamegraph).
+
+import math
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+
+PREFIX = 'instapredict_'
+SECONDS_BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+CLASS_BUCKETS = [1, 10, 100, 1000, 10000, 100000, 1000000]
+
+registry = []
+collectors = []
+scan_tally = threading.local()
+
+
+
+def formatValue(value):
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(value)
+
+
+def escapeLabel(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def formatLabels(names, values):
+    if len(names) == 0:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(name, escapeLabel(value)) for name, value in zip(names, values)) + '}'
+
+
+#function returns the header lines of one metric family
+def formatHeader(name, kind, help_text):
+    return ['# HELP {0} {1}'.format(name, help_text), '# TYPE {0} {1}'.format(name, kind)]
+
+
+
+#counter or gauge, one value per combination of label values
+class Metric:
+
+    def __init__(self, name, kind, help_text, label_names=()):
+        self.name = PREFIX + name
+        self.kind = kind
+        self.help = help_text
+        self.labelNames = tuple(label_names)
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+
+    def inc(self, amount=1, labels=()):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+    def set(self, value, labels=()):
+        with self.lock:
+            self.values[labels] = value
+
+
+    def render(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        lines = formatHeader(self.name, self.kind, self.help)
+        for labels, value in values:
+            lines.append('{0}{1} {2}'.format(self.name, formatLabels(self.labelNames, labels), formatValue(value)))
+        return lines
+
+
+
+#cumulative histogram with fixed bucket bounds, one series per combination of label values
+class Histogram:
+
+    def __init__(self, name, help_text, buckets, label_names=()):
+        self.name = PREFIX + name
+        self.help = help_text
+        self.buckets = list(buckets)
+        self.labelNames = tuple(label_names)
+        self.series = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+
+    def observe(self, value, labels=()):
+        #FIRST BUCKET WHOSE BOUND HOLDS THE VALUE; THE LAST SLOT IS +Inf
+        slot = len(self.buckets)
+        for ii, bound in enumerate(self.buckets):
+            if value <= bound:
+                slot = ii
+                break
+
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][slot] += 1
+            series[1] += value
+            series[2] += 1
+
+
+    #times the body of a with statement into this histogram
+    @contextmanager
+    def time(self, labels=()):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, labels)
+
+
+    def render(self):
+        with self.lock:
+            series = sorted((labels, (list(counts), total, count)) for labels, (counts, total, count) in self.series.items())
+        lines = formatHeader(self.name, 'histogram', self.help)
+        names = self.labelNames + ('le',)
+        for labels, (counts, total, count) in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + [float('inf')], counts):
+                cumulative += bucket_count
+                lines.append('{0}_bucket{1} {2}'.format(self.name, formatLabels(names, labels + (formatValue(float(bound)),)), cumulative))
+            suffix = formatLabels(self.labelNames, labels)
+            lines.append('{0}_sum{1} {2}'.format(self.name, suffix, formatValue(total)))
+            lines.append('{0}_count{1} {2}'.format(self.name, suffix, count))
+        return lines
+
+
+
+STAGE_SECONDS = Histogram('stage_seconds', 'Seconds spent in each stage of a prediction request.', SECONDS_BUCKETS, ['stage'])
+REQUEST_SECONDS = Histogram('request_seconds', 'Seconds spent answering a request, by endpoint.', SECONDS_BUCKETS, ['endpoint'])
+CLASSES_SCANNED = Histogram('classes_scanned', 'Classes scored per query.', CLASS_BUCKETS)
+MODEL_LOAD_SECONDS = Metric('model_load_seconds', 'gauge', 'Seconds the last model load took.')
+MODEL_LOADS = Metric('model_loads_total', 'counter', 'Model files loaded, including hot-swaps.')
+MODEL_WARMUP_SECONDS = Metric('model_warmup_seconds', 'gauge', 'Seconds the startup warm-up queries took.')
+MODEL_CLASSES = Metric('model_classes', 'gauge', 'Classes in the resident model.')
+PROFILES_WRITTEN = Metric('profiles_written_total', 'counter', 'Slow request profiles dumped to disk.')
+
+
+
+#returns a context manager timing one stage of a request
+def timer(stage):
+    return STAGE_SECONDS.time((stage,))
+
+
+def observeStage(stage, seconds):
+    STAGE_SECONDS.observe(seconds, (stage,))
+
+
+#records the number of classes one query scored; also tallied per thread between startScans and drainScans
+def recordScan(num_classes):
+    CLASSES_SCANNED.observe(num_classes)
+    scans = getattr(scan_tally, 'scans', None)
+    if scans is not None:
+        scans.append(num_classes)
+
+
+#holds every metric's lock across a fork, so the child never inherits a lock taken mid-update by another thread
+@contextmanager
+def heldForFork():
+    locks = [metric.lock for metric in registry]
+    for lock in locks:
+        lock.acquire()
+    try:
+        yield
+    finally:
+        for lock in reversed(locks):
+            lock.release()
+
+
+#runs first in a forked child, whose copies of the metric locks were taken while held
+def resetAfterFork():
+    for metric in registry:
+        metric.lock = threading.Lock()
+
+
+#pool workers (see ModelServer.py) tally their scans and hand them back to the parent, which serves /metrics
+def startScans():
+    scan_tally.scans = []
+
+
+def drainScans():
+    scans = getattr(scan_tally, 'scans', None) or []
+    scan_tally.scans = None
+    return scans
+
+
+#function registers collect(), called on every render, returning [(name, kind, help, [(label dict, value)])]
+#for values kept elsewhere such as the prediction cache's hit counts
+def registerCollector(collect):
+    collectors.append(collect)
+
+
+#function returns every metric in the Prometheus text exposition format
+def render():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    for collect in collectors:
+        for name, kind, help_text, samples in collect():
+            lines.extend(formatHeader(PREFIX + name, kind, help_text))
+            for labels, value in samples:
+                names = sorted(labels.keys())
+                lines.append('{0}{1} {2}'.format(PREFIX + name, formatLabels(names, [labels[key] for key in names]), formatValue(value)))
+    return '\n'.join(lines) + '\n'
+
+
+
+#opt-in cProfile of a sample of requests, keeping a dump of every profiled request slower than threshold seconds
+class SlowRequestProfiler:
+
+    def __init__(self, threshold, directory, sample_rate=1.0):
+        self.threshold = threshold
+        self.directory = directory
+        self.sampleRate = sample_rate
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+
+    #returns a running profile for this request, or None when it is not sampled
+    def start(self):
+        if random.random() >= self.sampleRate:
+            return None
+        import cProfile
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            #ANOTHER PROFILER IS ALREADY ACTIVE (ONE PER INTERPRETER SINCE PYTHON 3.12)
+            return None
+        return profile
+
+
+    #stops the profile and dumps it when the request was slow, returns the dump's filename or None
+    def stop(self, profile, name, elapsed):
+        if profile is None:
+            return None
+        profile.disable()
+        if elapsed < self.threshold:
+            return None
+
+        filename = os.path.join(self.directory, '{0}-{1}-{2}-{3:.0f}ms.prof'.format(
+            name, time.strftime('%Y%m%dT%H%M%S'), os.getpid(), elapsed * 1000.0))
+        profile.dump_stats(filename)
+        PROFILES_WRITTEN.inc()
+        return filename
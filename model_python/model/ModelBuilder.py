@@ -0,0 +1,240 @@
+# ASU CSE 591
+# Author: Group 4
+
+# Builds a model file from the sample CSV written by crawler/export.py
+# (id,user_id,date,{tag,...},location_id,location_name,lat,lon).
+#
+# 1. every sample location is read into memory as a unit vector
+# 2. mini-batch k-means divides the sphere into SAMPLES_PER_CLASS sized cells
+# 3. one streaming pass assigns each sample to its nearest cell and counts
+#    samples and tags per cell
+# 4. every non-empty cell becomes a row: class,prior,lat,lon,tag,tag,...,
+#    and the sample count goes in the manifest ModelUpdate.py needs
+
+import io
+import os
+import re
+import sys
+from array import array
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+import NaiveBayesModel
+import SpatialIndex
+import TagNormalizer
+
+
+SAMPLES_PER_CLASS = 1000
+BATCH_SIZE = 10000
+ITERATIONS = 100
+SEED_SAMPLES_PER_CLUSTER = 10
+CHUNK_SIZE = 100000
+
+FIELD_PATTERN = re.compile(r'"([^"]*)"|([^,]*)')
+
+
+
+#function splits a sample row the way ModelGen's CSVLine parser does: quoted fields have no escapes
+def splitSampleRow(row):
+    fields = []
+    pos = 0
+    while True:
+        match = FIELD_PATTERN.match(row, pos)
+        fields.append(match.group(1) if match.group(1) is not None else match.group(2))
+        pos = match.end()
+        if pos >= len(row) or row[pos] != ',':
+            return fields
+        pos += 1
+
+
+#function parses a {tag,tag} list into the tags usable in a model row, normalized the way queries are
+def parseTagList(text):
+    text = text.strip()
+    if text.startswith('{') and text.endswith('}'):
+        text = text[1:-1]
+    return TagNormalizer.normalizeTags(text.split(','))
+
+
+#generator yields (tags, lat, lon) for every well formed row of a sample file
+#keep, if given, is called with the index of each well formed row and skips the rows it rejects
+def readSamples(sample_filename, keep=None):
+    file = io.open(sample_filename, mode='r', encoding='utf-8')
+    try:
+        index = 0
+        for row in file:
+            data = splitSampleRow(row.rstrip('\r\n'))
+            if len(data) != 8:
+                continue
+            try:
+                lat, lon = float(data[6]), float(data[7])
+            except ValueError:
+                continue
+            if keep is None or keep(index):
+                yield parseTagList(data[3]), lat, lon
+            index += 1
+    finally:
+        file.close()
+
+
+#mini-batch k-means (Sculley 2010) over points on the unit sphere
+class MiniBatchKMeans:
+
+    def __init__(self, num_clusters, batch_size=BATCH_SIZE, iterations=ITERATIONS, seed=None):
+        self.numClusters = num_clusters
+        self.batchSize = batch_size
+        self.iterations = iterations
+        self.random = np.random.RandomState(seed)
+        self.centers = None
+
+
+    def fit(self, points):
+        num_points = len(points)
+        num_clusters = min(self.numClusters, num_points)
+
+        centers = self.seedCenters(points, num_clusters)
+        seen = np.zeros(num_clusters, dtype=np.float64)
+
+        for iteration in range(self.iterations):
+            batch = points[self.random.randint(0, num_points, min(self.batchSize, num_points))]
+            nearest = SpatialIndex.nearestCenters(cKDTree(centers), batch)
+
+            #EACH CENTER MOVES TO THE RUNNING MEAN OF EVERY POINT EVER ASSIGNED TO IT
+            counts = np.bincount(nearest, minlength=num_clusters).astype(np.float64)
+            sums = np.zeros_like(centers)
+            np.add.at(sums, nearest, batch)
+            updated = counts > 0
+            seen[updated] += counts[updated]
+            centers[updated] += (sums[updated] - counts[updated, None] * centers[updated]) / seen[updated, None]
+
+            #PROJECT BACK ONTO THE SPHERE
+            centers[updated] /= np.linalg.norm(centers[updated], axis=1)[:, None]
+
+        self.centers = centers
+        return self
+
+
+    #k-means++ seeding over a random subsample, so seeding costs O(k^2) rather than O(nk)
+    def seedCenters(self, points, num_clusters):
+        sample_size = min(len(points), SEED_SAMPLES_PER_CLUSTER * num_clusters)
+        sample = points[self.random.choice(len(points), sample_size, replace=False)]
+
+        chosen = [self.random.randint(sample_size)]
+        distances = ((sample - sample[chosen[0]]) ** 2).sum(axis=1)
+        for ii in range(1, num_clusters):
+            total = distances.sum()
+            if total <= 0:
+                chosen.append(self.random.randint(sample_size))
+            else:
+                chosen.append(min(sample_size - 1, int(np.searchsorted(np.cumsum(distances), self.random.rand() * total))))
+            distances = np.minimum(distances, ((sample - sample[chosen[-1]]) ** 2).sum(axis=1))
+        return sample[chosen].copy()
+
+
+    def index(self):
+        return SpatialIndex.SpatialIndex(*SpatialIndex.toLatLon(self.centers))
+
+
+
+#accumulates per-cell sample and tag counts in one streaming pass over the samples
+class CellCounts:
+
+    def __init__(self, num_cells):
+        self.samples = np.zeros(num_cells, dtype=np.int64)
+        self.tags = [{} for ii in range(num_cells)]
+
+
+    def add(self, cells, tag_lists):
+        self.samples += np.bincount(cells, minlength=len(self.samples))
+        for cell, tags in zip(cells, tag_lists):
+            counts = self.tags[cell]
+            for tag in tags:
+                counts[tag] = counts.get(tag, 0) + 1
+
+
+    def total(self):
+        return int(self.samples.sum())
+
+
+
+#function streams the samples in chunks, assigning each chunk to its nearest cells
+def countCells(sample_filename, index, chunk_size=CHUNK_SIZE, keep=None):
+    counts = CellCounts(index.numCells())
+    tag_lists = []
+    latitudes = []
+    longitudes = []
+
+    for tags, lat, lon in readSamples(sample_filename, keep):
+        tag_lists.append(tags)
+        latitudes.append(lat)
+        longitudes.append(lon)
+        if len(tag_lists) >= chunk_size:
+            counts.add(index.assign(latitudes, longitudes), tag_lists)
+            tag_lists, latitudes, longitudes = [], [], []
+
+    if len(tag_lists) > 0:
+        counts.add(index.assign(latitudes, longitudes), tag_lists)
+    return counts
+
+
+#function writes every non-empty cell as a model row, numbering classes by row
+def writeModelRows(model_filename, centers, counts):
+    latitudes, longitudes = SpatialIndex.toLatLon(centers)
+    total = float(counts.total())
+
+    #WRITE BESIDE THE TARGET AND RENAME SO READERS NEVER SEE A PARTIAL MODEL
+    temp_filename = model_filename + '.tmp'
+    file = io.open(temp_filename, mode='w', encoding='utf-8', newline='')
+    try:
+        class_num = 0
+        for cell in range(len(centers)):
+            if counts.samples[cell] == 0:
+                continue
+            file.write(u'{0},{1!r},{2:.6f},{3:.6f},'.format(
+                class_num, float(counts.samples[cell]) / total, latitudes[cell], longitudes[cell]))
+            for tag, count in sorted(counts.tags[cell].items()):
+                file.write((tag + u',') * count)
+            file.write(u'\n')
+            class_num += 1
+    finally:
+        file.close()
+    os.rename(temp_filename, model_filename)
+    return class_num
+
+
+#function builds a model file from a sample file and returns the number of classes written
+#keep selects the rows to train on by index, see readSamples
+def buildModel(sample_filename, model_filename, samples_per_class=SAMPLES_PER_CLASS, seed=None, keep=None):
+
+    latitudes = array('d')
+    longitudes = array('d')
+    for tags, lat, lon in readSamples(sample_filename, keep):
+        latitudes.append(lat)
+        longitudes.append(lon)
+    if len(latitudes) == 0:
+        raise ValueError('No samples in ' + sample_filename)
+
+    points = SpatialIndex.toUnitVectors(np.frombuffer(latitudes, dtype=np.float64), np.frombuffer(longitudes, dtype=np.float64))
+    num_cells = max(1, len(points) // samples_per_class)
+    kmeans = MiniBatchKMeans(num_cells, seed=seed).fit(points)
+    del points
+
+    counts = countCells(sample_filename, kmeans.index(), keep=keep)
+    num_classes = writeModelRows(model_filename, kmeans.centers, counts)
+    NaiveBayesModel.writeManifest(model_filename, {'version': 1, 'samples': counts.total(),
+        'tagNormalization': TagNormalizer.VERSION})
+    return num_classes
+
+
+
+def main():
+    if len(sys.argv) not in (3, 4):
+        print('Usage: python ModelBuilder.py SAMPLEFILE MODELFILE [SAMPLES_PER_CLASS]')
+        return
+
+    samples_per_class = int(sys.argv[3]) if len(sys.argv) == 4 else SAMPLES_PER_CLASS
+    print('{0} classes written'.format(buildModel(sys.argv[1], sys.argv[2], samples_per_class)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+# ASU CSE 591
+# Author: Group 4
+
+import multiprocessing
+import os
+import threading
+import time
+
+import Metrics
+
+
+REQUEST_TIMEOUT = 30
+
+#the model the parent preloaded; forked workers inherit it copy-on-write instead of reloading it
+resident_model = None
+
+
+
+#runs inside a pool worker, returns the worker's pid, scoring latency and classes scanned alongside the result
+#the scan counts go back to the parent since only its metrics are served
+def scoreRequest(Given_Tags, return_num, logSpace):
+    start = time.time()
+    Metrics.startScans()
+    classes = resident_model.findOptimalClass(Given_Tags, return_num, logSpace)
+    return os.getpid(), time.time() - start, Metrics.drainScans(), classes
+
+
+def scoreBatch(tag_sets, return_num, logSpace):
+    start = time.time()
+    Metrics.startScans()
+    batch = resident_model.findOptimalClasses(tag_sets, return_num, logSpace)
+    return os.getpid(), time.time() - start, Metrics.drainScans(), batch
+
+
+
+#pool of forked scoring workers sharing one preloaded model, usable wherever a model is expected
+class ModelServer:
+
+    def __init__(self, model, workers=None, timeout=REQUEST_TIMEOUT):
+        global resident_model
+
+        resident_model = model
+        self.model = model
+        self.workers = workers or multiprocessing.cpu_count()
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.queueDepth = 0
+        self.workerStats = {}
+        self.pool = self.createPool()
+
+
+    #forks the workers with every metric lock held, so no other thread is halfway through an update the
+    #children would inherit; each child then replaces the copied, held locks with fresh ones
+    def createPool(self):
+        #FORK EXPLICITLY SO WORKERS SHARE THE PARENT'S MODEL PAGES
+        if hasattr(multiprocessing, 'get_context'):
+            context = multiprocessing.get_context('fork')
+        else:
+            context = multiprocessing
+        with Metrics.heldForFork():
+            return context.Pool(self.workers, initializer=Metrics.resetAfterFork)
+
+
+    #forks a fresh pool from a model the parent has already loaded, so the new workers share its pages as
+    #the first ones did; requests already queued finish on the old pool, which then exits
+    def swapModel(self, model):
+        global resident_model
+
+        with self.lock:
+            if model is self.model:
+                return
+            old_pool = self.pool
+
+            #FORKED UNDER self.lock, WHICH NO WORKER USES, SO CONCURRENT SWAPS DO NOT BOTH RE-FORK
+            resident_model = model
+            self.pool = self.createPool()
+            self.model = model
+            self.workerStats = {}
+
+        old_pool.close()
+        reaper = threading.Thread(target=old_pool.join)
+        reaper.daemon = True
+        reaper.start()
+
+
+    def numClasses(self):
+        return self.model.numClasses()
+
+
+    def findOptimalClass(self, Given_Tags, return_num, logSpace=True):
+        #SUBMIT UNDER THE LOCK SO A REQUEST NEVER GOES TO A POOL THAT A CONCURRENT SWAP HAS CLOSED
+        with self.lock:
+            self.queueDepth += 1
+            pending = self.pool.apply_async(scoreRequest, (Given_Tags, return_num, logSpace))
+        try:
+            pid, elapsed, scans, classes = pending.get(self.timeout)
+        finally:
+            with self.lock:
+                self.queueDepth -= 1
+
+        self.recordLatency(pid, elapsed, scans)
+        return classes
+
+
+    #splits a batch into one chunk per worker and scores the chunks in parallel
+    def findOptimalClasses(self, tag_sets, return_num, logSpace=True):
+        chunk_size = max(1, -(-len(tag_sets) // self.workers))
+        chunks = [tag_sets[start:start + chunk_size] for start in range(0, len(tag_sets), chunk_size)]
+
+        with self.lock:
+            self.queueDepth += len(chunks)
+            pending = [self.pool.apply_async(scoreBatch, (chunk, return_num, logSpace)) for chunk in chunks]
+        try:
+            results = [request.get(self.timeout) for request in pending]
+        finally:
+            with self.lock:
+                self.queueDepth -= len(chunks)
+
+        batch = []
+        for pid, elapsed, scans, classes in results:
+            self.recordLatency(pid, elapsed, scans)
+            batch.extend(classes)
+        return batch
+
+
+    def recordLatency(self, pid, elapsed, scans=()):
+        for num_classes in scans:
+            Metrics.recordScan(num_classes)
+        with self.lock:
+            stats = self.workerStats.setdefault(pid, {'requests': 0, 'totalSeconds': 0.0, 'maxSeconds': 0.0})
+            stats['requests'] += 1
+            stats['totalSeconds'] += elapsed
+            stats['maxSeconds'] = max(stats['maxSeconds'], elapsed)
+
+
+    #returns the queue depth and per-worker latency as a json-serializable dict
+    def stats(self):
+        with self.lock:
+            workers = {}
+            for pid, stats in self.workerStats.items():
+                workers[str(pid)] = {
+                    'requests': stats['requests'],
+                    'meanSeconds': stats['totalSeconds'] / stats['requests'],
+                    'maxSeconds': stats['maxSeconds'],
+                }
+            return {'workers': self.workers, 'queueDepth': self.queueDepth, 'workerLatency': workers}
+
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
@@ -0,0 +1,82 @@
+# ASU CSE 591
+# Author: Group 4
+
+# Folds newly exported samples (crawler/export.py --start ...) into an existing
+# model instead of rebuilding it. Every sample is assigned to the nearest class
+# center, its tags are added to that class's counts, and the priors are rescaled
+# using the sample count kept in the model's manifest. The updated model is then
+# renamed over the old one, and servers pick it up on their next check (see
+# CLASSIFIER.getModel).
+
+import sys
+
+import ModelBuilder
+import NaiveBayesModel
+import SpatialIndex
+
+
+CHUNK_SIZE = ModelBuilder.CHUNK_SIZE
+
+
+
+#generator yields (classIndex, tags) for every delta sample, assigning them a chunk at a time
+def assignSamples(model, sample_filename, chunk_size=CHUNK_SIZE):
+    index = SpatialIndex.forModel(model)
+
+    chunk = []
+    for sample in ModelBuilder.readSamples(sample_filename):
+        chunk.append(sample)
+        if len(chunk) >= chunk_size:
+            for observation in assignChunk(index, chunk):
+                yield observation
+            chunk = []
+
+    for observation in assignChunk(index, chunk):
+        yield observation
+
+
+def assignChunk(index, chunk):
+    if len(chunk) == 0:
+        return []
+    cells = index.assign([sample[1] for sample in chunk], [sample[2] for sample in chunk]).tolist()
+    return zip(cells, [sample[0] for sample in chunk])
+
+
+#function applies a delta sample file to a model file, publishes it as the next version and returns the new manifest
+#binary_filename, if given, is republished from the updated model as well
+def updateModel(model_filename, sample_filename, binary_filename=None):
+
+    manifest = NaiveBayesModel.readManifest(model_filename)
+    if manifest is None:
+        raise ValueError('{0} has no manifest; write {{"version": 1, "samples": N}} to {0}{1}, '
+            'where N is the number of samples the model was trained on'.format(model_filename, NaiveBayesModel.MANIFEST_SUFFIX))
+
+    model = NaiveBayesModel.loadModel(model_filename)
+    samples = model.update(assignSamples(model, sample_filename), manifest['samples'])
+
+    #THE CSV IS PUBLISHED LAST SINCE IT IS THE SOURCE OF THE NEXT UPDATE
+    if binary_filename is not None:
+        import BinaryModel
+        BinaryModel.writeModel(model, binary_filename)
+    NaiveBayesModel.saveModel(model, model_filename)
+
+    #OTHER FIELDS, SUCH AS tagNormalization, CARRY OVER TO THE NEW VERSION
+    manifest = dict(manifest, version=manifest.get('version', 1) + 1, samples=samples)
+    if binary_filename is not None:
+        NaiveBayesModel.writeManifest(binary_filename, manifest)
+    NaiveBayesModel.writeManifest(model_filename, manifest)
+    return manifest
+
+
+
+def main():
+    if len(sys.argv) not in (3, 4):
+        print('Usage: python ModelUpdate.py MODELFILE SAMPLEFILE [BINARYFILE]')
+        return
+
+    manifest = updateModel(sys.argv[1], sys.argv[2], sys.argv[3] if len(sys.argv) == 4 else None)
+    print('Published version {0} ({1} samples)'.format(manifest['version'], manifest['samples']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,310 @@
+# ASU CSE 591
+# Author: Group 4
+
+import heapq
+import io
+import json
+import math
+import os
+import time
+
+import Metrics
+import UtilityClasses
+
+
+SMOOTHING_CONSTANT = 0.001
+MAX_BASELINE_CACHE = 64
+MANIFEST_SUFFIX = '.manifest'
+
+
+
+#generator yields (class, prior, lat, lon, tags) for every row of a model file
+def readModelRows(model_filename):
+
+    #READ RAW BYTES SO ROWS ONLY BREAK ON NEWLINES, AS IN findOptimalClassMmap
+    file = open(model_filename, 'rb')
+    try:
+        for row in file:
+            data = row.decode('utf-8').split(',')
+            last_tag_index = len(data)-1
+            yield data[0], float(data[1]), float(data[2]), float(data[3]), data[4:last_tag_index]
+    finally:
+        file.close()
+
+
+#log that maps a zero probability to -inf instead of raising
+def safeLog(value):
+    if value <= 0:
+        return float('-inf')
+    return math.log(value)
+
+
+#function returns log(sum(exp(values))) without underflowing
+def logSumExp(values):
+    highest = max(values) if len(values) > 0 else float('-inf')
+    if highest == float('-inf') or highest == float('inf'):
+        return highest
+    return highest + math.log(sum(math.exp(value - highest) for value in values))
+
+
+#function turns a log posterior into a confidence given the log of the normalizing value
+def logConfidence(log_posterior, log_normalizing_val):
+    if log_normalizing_val == float('-inf'):
+        return 0.0
+    return math.exp(log_posterior - log_normalizing_val)
+
+
+#function picks the return_num highest scoring candidates with a bounded heap, ties go to the lower index
+def highestScores(scores, candidates, return_num):
+    return heapq.nlargest(return_num, candidates, key=lambda ii: (scores[ii], -ii))
+
+
+#function parses a model file once and returns a NaiveBayesModel holding it in memory
+def loadModel(model_filename, smoothing_constant=SMOOTHING_CONSTANT):
+
+    model = NaiveBayesModel(smoothing_constant)
+    for className, prior, lat, lon, tags in readModelRows(model_filename):
+        model.addClass(className, prior, lat, lon, tags)
+    return model
+
+
+
+#function writes a model back out in the row format readModelRows parses
+#the rows go to a temporary file that is renamed over the target, so readers only ever see a complete model
+def saveModel(model, model_filename):
+
+    #INVERT THE POSTINGS INTO PER-CLASS TAG COUNTS
+    class_tags = [{} for ii in range(model.numClasses())]
+    for tag, posting in model.postings.items():
+        for index, count in posting.items():
+            class_tags[index][tag] = count
+
+    temp_filename = model_filename + '.tmp'
+    file = io.open(temp_filename, mode='w', encoding='utf-8', newline='')
+    try:
+        for index in range(model.numClasses()):
+            file.write(u'{0},{1!r},{2!r},{3!r},'.format(
+                model.classes[index], model.priors[index], model.latitudes[index], model.longitudes[index]))
+            for tag, count in sorted(class_tags[index].items()):
+                file.write((tag + u',') * count)
+            file.write(u'\n')
+    finally:
+        file.close()
+    os.rename(temp_filename, model_filename)
+
+
+#function returns the manifest stored beside a model file, {'version': n, 'samples': n}, or None
+def readManifest(model_filename):
+    try:
+        file = open(model_filename + MANIFEST_SUFFIX, 'r')
+    except IOError:
+        return None
+    try:
+        return json.load(file)
+    finally:
+        file.close()
+
+
+def writeManifest(model_filename, manifest):
+    temp_filename = model_filename + MANIFEST_SUFFIX + '.tmp'
+    file = open(temp_filename, 'w')
+    try:
+        json.dump(manifest, file)
+    finally:
+        file.close()
+    os.rename(temp_filename, model_filename + MANIFEST_SUFFIX)
+
+
+
+#in-memory Naive Bayes model: per-class priors and denominators plus a tag -> {class: count} inverted index
+class NaiveBayesModel:
+
+    def __init__(self, smoothing_constant=SMOOTHING_CONSTANT):
+        self.smoothing = smoothing_constant
+        self.classes = []
+        self.priors = []
+        self.latitudes = []
+        self.longitudes = []
+        self.denominators = []
+        self.postings = {}
+        self.baselines = {}
+
+
+    def numClasses(self):
+        return len(self.classes)
+
+
+    def addClass(self, className, prior, lat, lon, tags):
+        index = len(self.classes)
+        self.classes.append(className)
+        self.priors.append(float(prior))
+        self.latitudes.append(float(lat))
+        self.longitudes.append(float(lon))
+        self.denominators.append(len(tags))        #number of tags found in class
+
+        for tag in tags:
+            posting = self.postings.setdefault(tag, {})
+            posting[index] = posting.get(index, 0) + 1
+
+        self.baselines.clear()
+        return index
+
+
+    #adds a delta of (classIndex, tags) observations to the counts in place
+    #total_samples is the number of samples the model was trained on; priors are rescaled to include the delta
+    #returns the new number of samples
+    def update(self, observations, total_samples):
+        class_samples = [prior * total_samples for prior in self.priors]
+        added = 0
+
+        for index, tags in observations:
+            class_samples[index] += 1
+            self.denominators[index] += len(tags)
+            for tag in tags:
+                posting = self.postings.setdefault(tag, {})
+                posting[index] = posting.get(index, 0) + 1
+            added += 1
+
+        total_samples += added
+        if total_samples > 0:
+            self.priors = [float(samples) / total_samples for samples in class_samples]
+
+        self.baselines.clear()
+        return total_samples
+
+
+    #posterior of a single class, multiplied out exactly as findOptimalClassMmap does
+    def posterior(self, Given_Tags, index):
+        denominator = float(self.denominators[index]) + self.smoothing
+
+        temp_likilihood = 1
+        for tag in Given_Tags:
+            temp_likilihood *= (self.count(tag, index) + self.smoothing) / denominator
+
+        return temp_likilihood * self.priors[index]
+
+
+    #log posterior of a single class, immune to underflow for long tag lists
+    def logPosterior(self, Given_Tags, index):
+        denominator = float(self.denominators[index]) + self.smoothing
+
+        temp_likilihood = 0
+        for tag in Given_Tags:
+            temp_likilihood += math.log((self.count(tag, index) + self.smoothing) / denominator)
+
+        return temp_likilihood + safeLog(self.priors[index])
+
+
+    def count(self, tag, index):
+        posting = self.postings.get(tag)
+        if posting is None:
+            return 0
+        return posting.get(index, 0)
+
+
+    #returns (normalizing value, per-class values, classes by value) for a query of n tags matching no class
+    def baseline(self, n, logSpace=False):
+        cached = self.baselines.get((n, logSpace))
+        if cached is not None:
+            return cached
+
+        values = []
+        for index in range(len(self.classes)):
+            miss = self.smoothing / (float(self.denominators[index]) + self.smoothing)
+            if logSpace:
+                values.append(safeLog(self.priors[index]) + n * math.log(miss))
+            else:
+                values.append(self.priors[index] * miss ** n)
+
+        ordering = sorted(range(len(values)), key=lambda ii: (-values[ii], ii))
+        if logSpace:
+            cached = (logSumExp(values), values, ordering)
+        else:
+            cached = (sum(values), values, ordering)
+
+        if len(self.baselines) >= MAX_BASELINE_CACHE:
+            self.baselines.clear()
+        self.baselines[(n, logSpace)] = cached
+        return cached
+
+
+    #scores only the classes on the query tags' posting lists, returns the most likely class(es)
+    #logSpace accumulates log-probabilities and normalizes with log-sum-exp
+    def findOptimalClass(self, Given_Tags, return_num, logSpace=False):
+
+        #IGNORE EMPTY TAG SETS
+        if Given_Tags == []:
+            return []
+
+        scan_start = time.time()
+        matched = set()
+        for tag in Given_Tags:
+            posting = self.postings.get(tag)
+            if posting is not None:
+                matched.update(posting)
+
+        score = self.logPosterior if logSpace else self.posterior
+        base_normalizing_val, base_values, ordering = self.baseline(len(Given_Tags), logSpace)
+
+        posteriors = {}
+        for index in matched:
+            posteriors[index] = score(Given_Tags, index)
+
+        #UNMATCHED CLASSES CAN ONLY COMPETE IN THEIR BASELINE ORDER
+        unmatched = 0
+        for index in ordering:
+            if unmatched >= return_num:
+                break
+            if index not in matched:
+                posteriors[index] = score(Given_Tags, index)
+                unmatched += 1
+
+        Metrics.observeStage('scan', time.time() - scan_start)
+        Metrics.recordScan(len(posteriors))
+        results_start = time.time()
+
+        highest = highestScores(posteriors, posteriors, return_num)
+
+        #CORRECT THE UNMATCHED BASELINE FOR EVERY CLASS THAT CONTAINS A QUERY TAG
+        if logSpace:
+            log_normalizing_val = self.logNormalizingValue(base_normalizing_val, base_values, posteriors, matched)
+        else:
+            normalizing_val = base_normalizing_val
+            for index in matched:
+                normalizing_val += posteriors[index] - base_values[index]
+            if normalizing_val <= 0:
+                normalizing_val = 1
+
+        classes = []
+        for index in highest:
+            c = UtilityClasses.Coordinates()
+            if logSpace:
+                c.confidence = logConfidence(posteriors[index], log_normalizing_val)
+            else:
+                c.confidence = float(posteriors[index]) / normalizing_val
+            c.classNum = int(index)
+            c.lat = self.latitudes[index]
+            c.lon = self.longitudes[index]
+            classes.append(c)
+
+        Metrics.observeStage('results', time.time() - results_start)
+        return classes
+
+
+    #scores a batch of tag sets against the resident index, returns the most likely class(es) for each
+    def findOptimalClasses(self, tag_sets, return_num, logSpace=False):
+        return [self.findOptimalClass(tags, return_num, logSpace) for tags in tag_sets]
+
+
+    #log of the baseline sum with the matched classes' baselines swapped for their posteriors
+    def logNormalizingValue(self, base_log_normalizing_val, base_values, posteriors, matched):
+        shift = max([base_log_normalizing_val] + [posteriors[index] for index in matched])
+        if shift == float('-inf'):
+            return shift
+
+        matched_sum = sum(math.exp(posteriors[index] - shift) for index in matched)
+        total = math.exp(base_log_normalizing_val - shift) + matched_sum
+        total -= sum(math.exp(base_values[index] - shift) for index in matched)
+
+        #CANCELLATION CAN ONLY UNDERSHOOT THE MATCHED CLASSES' OWN MASS
+        return shift + math.log(max(total, matched_sum))
@@ -0,0 +1,122 @@
+# ASU CSE 591
+# Author: Group 4
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import TagNormalizer
+
+
+MAX_ENTRIES = 10000
+TTL = 300                   #seconds a cached prediction stays valid
+CHECK_INTERVAL = 1.0        #seconds between checks of the model file's modification time
+
+
+
+#function normalizes a query into the sorted tag set (see TagNormalizer.py) used for both scoring and cache keys
+#version is the model's tagNormalization; None, for models trained before TagNormalizer, only lowercases
+def normalizeQueryTags(tags, version=TagNormalizer.VERSION):
+    if version is None:
+        return sorted(TagNormalizer.normalizeLegacyTags(tags))
+    return sorted(TagNormalizer.normalizeTags(tags))
+
+
+
+#bounded, thread-safe LRU cache of predictions keyed on (normalized tag set, count); callers normalize the tags
+class PredictionCache:
+
+    def __init__(self, max_entries=MAX_ENTRIES, ttl=TTL, model_filename=None, check_interval=CHECK_INTERVAL):
+        self.maxEntries = max_entries
+        self.ttl = ttl
+        self.modelFilename = model_filename
+        self.checkInterval = check_interval
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self.lastCheck = time.time()
+        self.modelMtime = self.readModelMtime()
+
+
+    def key(self, tags, count):
+        return tuple(sorted(tags)), int(count)
+
+
+    #returns the cached classes or None, counting the hit or miss
+    def get(self, key):
+        self.checkModelFile()
+        now = time.time()
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < now:
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+
+            #MOVE TO THE MOST RECENTLY USED END
+            del self.entries[key]
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+
+    #stores classes computed during the given generation; ones scored before the last invalidate are dropped
+    def put(self, key, classes, generation=None):
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            if key in self.entries:
+                del self.entries[key]
+            self.entries[key] = (time.time() + self.ttl, classes)
+            while len(self.entries) > self.maxEntries:
+                self.entries.popitem(last=False)
+
+
+    #returns the cached classes for the query, computing and storing them on a miss
+    #pass the generation read before choosing the model to score with, so a miss scored on a replaced model is not stored
+    def lookup(self, tags, count, compute, generation=None):
+        if generation is None:
+            generation = self.generation
+        key = self.key(tags, count)
+        classes = self.get(key)
+        if classes is None:
+            classes = compute(list(key[0]), key[1])
+            self.put(key, classes, generation)
+        return classes
+
+
+    def invalidate(self):
+        with self.lock:
+            self.entries.clear()
+            self.generation += 1
+
+
+    def readModelMtime(self):
+        if self.modelFilename is None:
+            return None
+        try:
+            return os.path.getmtime(self.modelFilename)
+        except OSError:
+            return None
+
+
+    #drops every entry once the model file has been replaced, checking at most every check_interval seconds
+    def checkModelFile(self):
+        if self.modelFilename is None or time.time() - self.lastCheck < self.checkInterval:
+            return
+        self.lastCheck = time.time()
+
+        mtime = self.readModelMtime()
+        if mtime != self.modelMtime:
+            self.modelMtime = mtime
+            self.invalidate()
+
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'maxEntries': self.maxEntries, 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,47 @@
+# ASU CSE 591
+# Author: Group 4
+
+import numpy as np
+
+import UtilityClasses
+
+
+
+#function picks the top return_num classes of each row of (query x class) log posteriors
+#returns (class indices, confidences), both ordered by descending score
+def rankLogPosteriors(scores, return_num):
+
+    k = min(return_num, scores.shape[1])
+    if k <= 0:
+        empty = np.zeros((scores.shape[0], 0))
+        return empty.astype(np.int64), empty
+
+    #TOP k PER ROW WITHOUT A FULL SORT, THEN ORDER THOSE k BY SCORE
+    top = np.argpartition(-scores, k - 1, axis=1)[:, 0:k]
+    top_scores = np.take_along_axis(scores, top, axis=1)
+    order = np.lexsort((top, -top_scores), axis=1)
+    top = np.take_along_axis(top, order, axis=1)
+    top_scores = np.take_along_axis(top_scores, order, axis=1)
+
+    #NORMALIZE WITH LOG-SUM-EXP SO LONG TAG LISTS DO NOT UNDERFLOW
+    highest = scores.max(axis=1)
+    finite = np.isfinite(highest)
+    shift = np.where(finite, highest, 0.0)
+    with np.errstate(divide='ignore'):
+        log_norm = shift + np.log(np.exp(scores - shift[:, np.newaxis]).sum(axis=1))
+    confidences = np.where(finite[:, np.newaxis], np.exp(top_scores - log_norm[:, np.newaxis]), 0.0)
+
+    return top, confidences
+
+
+#function wraps one row of ranked classes as UtilityClasses.Coordinates
+def buildCoordinates(top, confidences, latitudes, longitudes):
+    classes = []
+    for index, confidence in zip(top, confidences):
+        c = UtilityClasses.Coordinates()
+        c.confidence = float(confidence)
+        c.classNum = int(index)
+        c.lat = float(latitudes[index])
+        c.lon = float(longitudes[index])
+        classes.append(c)
+    return classes
@@ -0,0 +1,127 @@
+# ASU CSE 591
+# Author: Group 4
+
+# Nearest-cell lookups over class centers by great-circle distance.
+#
+# Centers are stored as points on the unit sphere in a KD-tree. The straight-line
+# (chord) distance between two such points grows monotonically with their great-circle
+# distance, so the nearest points by chord are exactly the nearest by haversine;
+# only the reported distances are converted, with d = 2R asin(chord / 2).
+
+import math
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+EARTH_RADIUS_KM = 6371.0088
+CHUNK_SIZE = 100000
+
+
+
+#function returns the great-circle distance in km between two points given in degrees
+def haversineDistance(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+#function converts degrees of latitude and longitude into points on the unit sphere
+def toUnitVectors(latitudes, longitudes):
+    lat = np.radians(np.asarray(latitudes, dtype=np.float64))
+    lon = np.radians(np.asarray(longitudes, dtype=np.float64))
+    return np.column_stack((np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)))
+
+
+#function converts points on (or near) the unit sphere back into degrees of latitude and longitude
+def toLatLon(points):
+    lat = np.degrees(np.arctan2(points[:, 2], np.hypot(points[:, 0], points[:, 1])))
+    lon = np.degrees(np.arctan2(points[:, 1], points[:, 0]))
+    return lat, lon
+
+
+def chordToKm(chord):
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.minimum(1.0, np.asarray(chord) / 2))
+
+
+def kmToChord(km):
+    return 2 * math.sin(min(math.pi, km / EARTH_RADIUS_KM) / 2)
+
+
+#function queries a tree on all cores where scipy supports it, returns (chord distances, indices)
+def queryTree(tree, points, k=1):
+    try:
+        return tree.query(points, k, workers=-1)
+    except TypeError:
+        return tree.query(points, k, n_jobs=-1)
+
+
+#function returns the index of the nearest center of every point
+def nearestCenters(tree, points):
+    return queryTree(tree, points)[1]
+
+
+#function returns the spatial index over a model's class centers, building it on first use
+def forModel(model):
+    index = getattr(model, 'spatialIndex', None)
+    if index is None:
+        index = SpatialIndex(model.latitudes, model.longitudes)
+        model.spatialIndex = index
+    return index
+
+
+
+#KD-tree over cell centers answering point -> cell, k-nearest-cells and radius queries
+class SpatialIndex:
+
+    def __init__(self, latitudes, longitudes):
+        self.latitudes = np.asarray(latitudes, dtype=np.float64)
+        self.longitudes = np.asarray(longitudes, dtype=np.float64)
+        self.tree = cKDTree(toUnitVectors(self.latitudes, self.longitudes))
+
+
+    def numCells(self):
+        return len(self.latitudes)
+
+
+    #returns the nearest cell of every point, querying chunk_size points at a time
+    def assign(self, latitudes, longitudes, chunk_size=CHUNK_SIZE):
+        latitudes = np.asarray(latitudes, dtype=np.float64)
+        longitudes = np.asarray(longitudes, dtype=np.float64)
+        cells = np.empty(len(latitudes), dtype=np.int64)
+        for start in range(0, len(latitudes), chunk_size):
+            end = start + chunk_size
+            cells[start:end] = nearestCenters(self.tree, toUnitVectors(latitudes[start:end], longitudes[start:end]))
+        return cells
+
+
+    #returns (km, cells), both points x k and nearest first, for the k nearest cells of every point
+    def nearestCells(self, latitudes, longitudes, k=1):
+        k = min(k, self.numCells())
+        points = toUnitVectors(latitudes, longitudes)
+        chords, cells = queryTree(self.tree, points, k)
+        shape = (len(points), k)
+        return chordToKm(np.reshape(chords, shape)), np.reshape(cells, shape)
+
+
+    #returns [(cell, km)] of the k cells nearest one point
+    def nearest(self, lat, lon, k=1):
+        km, cells = self.nearestCells([lat], [lon], k)
+        return list(zip(cells[0].tolist(), km[0].tolist()))
+
+
+    #returns [(cell, km)] of the k cells nearest a cell, not counting the cell itself
+    def neighbors(self, cell, k):
+        found = self.nearest(self.latitudes[cell], self.longitudes[cell], k + 1)
+        return [(other, km) for other, km in found if other != cell][0:k]
+
+
+    #returns the cells within radius_km of a point, nearest first
+    def withinRadius(self, lat, lon, radius_km):
+        point = toUnitVectors([lat], [lon])[0]
+        cells = self.tree.query_ball_point(point, kmToChord(radius_km))
+        return sorted(cells, key=lambda cell: self.distance(cell, lat, lon))
+
+
+    def distance(self, cell, lat, lon):
+        return haversineDistance(self.latitudes[cell], self.longitudes[cell], lat, lon)
@@ -0,0 +1,134 @@
+# ASU CSE 591
+# Author: Group 4
+
+# Generates model files in the class,prior,lat,lon,tag,tag,..., format, with
+# matching query workloads, so engines can be benchmarked without the real model.
+#
+# Tag frequencies follow a Zipf law over the vocabulary (tag rank r is drawn with
+# probability proportional to 1/r^ZIPF_EXPONENT). A share of every class's tags
+# comes from a small class-local set instead, which is what lets the classifier
+# tell classes apart. Class sizes are lognormal and centers are uniform over the
+# sphere. Everything is derived from the seed, so a (seed, parameters) pair
+# always produces the same model and workload.
+
+import io
+import json
+import sys
+
+import numpy as np
+
+
+VOCABULARY_SIZE = 100000
+ZIPF_EXPONENT = 1.1
+TAGS_PER_CLASS = 50             #mean tag occurrences per class row
+LOCAL_TAGS = 20                 #size of each class's local tag set
+LOCAL_SHARE = 0.3               #share of tags drawn from the class's local set
+QUERY_TAGS = 5                  #mean tags per query
+
+
+
+#generates classes and queries of one synthetic model
+class SyntheticModel:
+
+    def __init__(self, num_classes, vocabulary_size=VOCABULARY_SIZE, zipf_exponent=ZIPF_EXPONENT,
+                 tags_per_class=TAGS_PER_CLASS, local_share=LOCAL_SHARE, seed=0):
+        self.numClasses = num_classes
+        self.vocabularySize = vocabulary_size
+        self.tagsPerClass = tags_per_class
+        self.localShare = local_share
+        self.seed = seed
+
+        self.tagNames = [u'tag{0}'.format(rank) for rank in range(vocabulary_size)]
+        weights = 1.0 / np.arange(1, vocabulary_size + 1, dtype=np.float64) ** zipf_exponent
+        self.cdf = np.cumsum(weights / weights.sum())
+
+        random = np.random.RandomState(seed)
+        sizes = random.lognormal(0.0, 1.0, num_classes)
+        self.priors = sizes / sizes.sum()
+        self.latitudes = np.degrees(np.arcsin(random.uniform(-1.0, 1.0, num_classes)))
+        self.longitudes = random.uniform(-180.0, 180.0, num_classes)
+
+
+    #draws tag ranks from the global Zipf distribution
+    def zipfTags(self, random, num):
+        return np.minimum(np.searchsorted(self.cdf, random.uniform(0.0, 1.0, num)), self.vocabularySize - 1)
+
+
+    #the class's local tag set is a hash of (seed, class), uniform over the vocabulary,
+    #so queries can regenerate it without storing it
+    def localTags(self, index):
+        offset = (int(self.seed) * 0x9E3779B97F4A7C15 + int(index) * LOCAL_TAGS) & 0xFFFFFFFFFFFFFFFF
+        keys = np.arange(LOCAL_TAGS, dtype=np.uint64) + np.uint64(offset)
+
+        #SPLITMIX64 FINALIZER; UINT64 ARRAY ARITHMETIC WRAPS
+        keys ^= keys >> np.uint64(30)
+        keys *= np.uint64(0xBF58476D1CE4E5B9)
+        keys ^= keys >> np.uint64(27)
+        keys *= np.uint64(0x94D049BB133111EB)
+        keys ^= keys >> np.uint64(31)
+        return (keys % np.uint64(self.vocabularySize)).astype(np.int64)
+
+
+    #draws num tag ranks of class index, mixing the global and local distributions
+    def classTags(self, random, index, num):
+        local = random.uniform(0.0, 1.0, num) < self.localShare
+        tags = self.zipfTags(random, num)
+        tags[local] = self.localTags(index)[random.randint(0, LOCAL_TAGS, int(local.sum()))]
+        return tags
+
+
+    #writes the model rows one class at a time, so memory does not grow with the class count
+    def writeModel(self, model_filename):
+        random = np.random.RandomState([self.seed, self.numClasses])
+        counts = 1 + random.poisson(self.tagsPerClass - 1, self.numClasses)
+
+        file = io.open(model_filename, mode='w', encoding='utf-8', newline='')
+        try:
+            for index in range(self.numClasses):
+                tags = np.sort(self.classTags(random, index, counts[index]))
+                file.write(u'{0},{1!r},{2:.4f},{3:.4f},'.format(
+                    index, float(self.priors[index]), self.latitudes[index], self.longitudes[index]))
+                file.write(u''.join(self.tagNames[tag] + u',' for tag in tags))
+                file.write(u'\n')
+        finally:
+            file.close()
+
+
+    #returns num_queries {tags, count} requests, each drawn from a class picked by prior
+    def queries(self, num_queries, query_tags=QUERY_TAGS, count=3, seed=None):
+        random = np.random.RandomState(self.seed + 1 if seed is None else seed)
+        classes = np.minimum(np.searchsorted(np.cumsum(self.priors), random.uniform(0.0, 1.0, num_queries)),
+            self.numClasses - 1)
+
+        requests = []
+        for index in classes:
+            num_tags = 1 + random.poisson(query_tags - 1)
+            tags = sorted(set(self.tagNames[tag] for tag in self.classTags(random, index, num_tags)))
+            requests.append({'tags': tags, 'count': count})
+        return requests
+
+
+    #writes a workload as json lines that webFacingFindOptimalClass accepts as they are
+    def writeQueries(self, workload_filename, num_queries, query_tags=QUERY_TAGS, count=3):
+        file = open(workload_filename, 'w')
+        try:
+            for request in self.queries(num_queries, query_tags, count):
+                file.write(json.dumps(request) + '\n')
+        finally:
+            file.close()
+
+
+
+def main():
+    if len(sys.argv) not in (3, 5):
+        print('Usage: python SyntheticModel.py NUMCLASSES MODELFILE [WORKLOADFILE NUMQUERIES]')
+        return
+
+    model = SyntheticModel(int(sys.argv[1]))
+    model.writeModel(sys.argv[2])
+    if len(sys.argv) == 5:
+        model.writeQueries(sys.argv[3], int(sys.argv[4]))
+
+
+if __name__ == '__main__':
+    main()
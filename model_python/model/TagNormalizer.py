@@ -0,0 +1,143 @@
+# ASU CSE 591
+# Author: Group 4
+
+# Tag normalization shared by training (crawler/export.py, ModelBuilder.py) and serving
+# (PredictionCache.normalizeQueryTags, which webFacingFindOptimalClass keys and scores with).
+# Two tags are the same once they agree after NFKC (full-width letters, ligatures, composed
+# accents), case folding, and stripping whitespace, a leading '#' and the characters the
+# sample and model CSVs cannot hold. Duplicates and stop tags are dropped.
+#
+# This changes which tags a query scores with, so it only applies to models trained with it.
+# ModelBuilder.py records VERSION in the model's manifest as tagNormalization; models without
+# it, such as ones built before this module, were trained on lowercased tags and are queried
+# with normalizeLegacyTags.
+#
+# Vocabulary interns normalized tags as integer IDs that stay the same across exports. It is
+# kept as one tag per line, the line number being the ID.
+
+import io
+import os
+import unicodedata
+
+
+#recorded in the manifest of models trained on tags normalized by this module
+VERSION = 1
+
+#engagement tags posted everywhere, which say nothing about where a photo was taken
+STOP_TAGS = frozenset([
+    u'instagood', u'photooftheday', u'picoftheday', u'instadaily', u'instalike', u'instamood', u'igers',
+    u'tbt', u'follow', u'followme', u'follow4follow', u'followforfollow', u'f4f', u'like', u'like4like',
+    u'likeforlike', u'l4l', u'tagsforlikes', u'repost', u'regram', u'nofilter', u'instapic', u'webstagram',
+])
+
+#separators of the CSV formats, and control characters, which would also split a model row
+DROPPED_CHARACTERS = dict((ord(c), None) for c in u',{}"')
+DROPPED_CHARACTERS.update((code, None) for code in list(range(0, 32)) + [127])
+
+
+
+#function returns the normalized form of one tag, '' if nothing is left of it
+def normalizeTag(tag):
+    if isinstance(tag, bytes):
+        tag = tag.decode('utf-8')
+    tag = unicodedata.normalize('NFKC', tag)
+
+    #CASE FOLDING CAN LEAVE TEXT THAT IS NOT NFKC (PYTHON 2 HAS NO casefold, SO IT LOWERCASES)
+    tag = tag.casefold() if hasattr(tag, 'casefold') else tag.lower()
+    tag = unicodedata.normalize('NFKC', tag)
+    return tag.translate(DROPPED_CHARACTERS).strip().lstrip(u'#').strip()
+
+
+#function normalizes a tag list, dropping empty tags, stop tags and repeats, keeping first occurrences in order
+def normalizeTags(tags, stop_tags=STOP_TAGS):
+    seen = set()
+    normalized = []
+    for tag in tags:
+        tag = normalizeTag(tag)
+        if tag != u'' and tag not in stop_tags and tag not in seen:
+            seen.add(tag)
+            normalized.append(tag)
+    return normalized
+
+
+#function normalizes a tag list the way models built before this module were trained: lowercased, without repeats
+def normalizeLegacyTags(tags):
+    seen = set()
+    normalized = []
+    for tag in tags:
+        tag = tag.lower()
+        if tag not in seen:
+            seen.add(tag)
+            normalized.append(tag)
+    return normalized
+
+
+#function reads a stop tag file, one tag per line, for deployments replacing STOP_TAGS
+def loadStopTags(filename):
+    file = io.open(filename, mode='r', encoding='utf-8')
+    try:
+        return frozenset(tag for tag in (normalizeTag(line) for line in file) if tag != u'')
+    finally:
+        file.close()
+
+
+
+#normalized tag <-> integer ID mapping; IDs are handed out in order and never reused
+class Vocabulary:
+
+    def __init__(self, tags=()):
+        self.tags = []
+        self.ids = {}
+        for tag in tags:
+            self.intern(tag)
+
+
+    def __len__(self):
+        return len(self.tags)
+
+
+    #returns the ID of a normalized tag, adding it if it is new
+    def intern(self, tag):
+        tag_id = self.ids.get(tag)
+        if tag_id is None:
+            tag_id = len(self.tags)
+            self.ids[tag] = tag_id
+            self.tags.append(tag)
+        return tag_id
+
+
+    def internAll(self, tags):
+        return [self.intern(tag) for tag in tags]
+
+
+    #returns the ID of a normalized tag, or None if it is not in the vocabulary
+    def lookup(self, tag):
+        return self.ids.get(tag)
+
+
+    def tag(self, tag_id):
+        return self.tags[tag_id]
+
+
+    #writes the vocabulary beside filename and renames it into place
+    def save(self, filename):
+        file = io.open(filename + '.tmp', mode='w', encoding='utf-8', newline=u'\n')
+        try:
+            for tag in self.tags:
+                file.write(tag + u'\n')
+        finally:
+            file.close()
+        os.rename(filename + '.tmp', filename)
+
+
+
+#function loads a saved vocabulary, or returns an empty one if the file does not exist yet
+def loadVocabulary(filename):
+    if not os.path.exists(filename):
+        return Vocabulary()
+
+    file = io.open(filename, mode='r', encoding='utf-8', newline=u'\n')
+    try:
+        return Vocabulary(line.rstrip(u'\n') for line in file)
+    finally:
+        file.close()
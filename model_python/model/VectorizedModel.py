@@ -0,0 +1,140 @@
+# ASU CSE 591
+# Author: Group 4
+
+from array import array
+
+import numpy as np
+import scipy.sparse as sparse
+
+import Metrics
+import NaiveBayesModel
+import ScoreRanking
+
+
+BATCH_MEMORY_BYTES = 64 * 1024 * 1024     #budget for the dense (query x class) arrays of one batch
+BATCH_ARRAY_COPIES = 4                    #score matrix, plus the temporaries of ranking and normalizing it
+
+
+
+#function parses a model file once into a class x tag sparse count matrix
+def loadVectorizedModel(model_filename, smoothing_constant=NaiveBayesModel.SMOOTHING_CONSTANT):
+
+    vocabulary = {}
+    rows = array('i')
+    cols = array('i')
+    priors = []
+    latitudes = []
+    longitudes = []
+    denominators = []
+
+    for className, prior, lat, lon, tags in NaiveBayesModel.readModelRows(model_filename):
+        index = len(priors)
+        priors.append(prior)
+        latitudes.append(lat)
+        longitudes.append(lon)
+        denominators.append(len(tags))
+
+        for tag in tags:
+            rows.append(index)
+            cols.append(vocabulary.setdefault(tag, len(vocabulary)))
+
+    #DUPLICATE (class, tag) ENTRIES ARE SUMMED INTO COUNTS
+    counts = sparse.csr_matrix(
+        (np.ones(len(rows)), (np.frombuffer(rows, dtype=np.int32), np.frombuffer(cols, dtype=np.int32))),
+        shape=(len(priors), len(vocabulary)))
+    counts.sum_duplicates()
+
+    return VectorizedModel(vocabulary, counts, priors, latitudes, longitudes, denominators, smoothing_constant)
+
+
+
+#Naive Bayes model scored in log space for whole batches of tag sets with one sparse matrix product
+class VectorizedModel:
+
+    def __init__(self, vocabulary, counts, priors, latitudes, longitudes, denominators,
+                 smoothing_constant=NaiveBayesModel.SMOOTHING_CONSTANT):
+        self.smoothing = smoothing_constant
+        self.vocabulary = vocabulary
+        self.latitudes = np.asarray(latitudes, dtype=np.float64)
+        self.longitudes = np.asarray(longitudes, dtype=np.float64)
+
+        with np.errstate(divide='ignore'):
+            self.logPriors = np.log(np.asarray(priors, dtype=np.float64))
+
+        #log((count + s) / (d + s)) = log((count + s) / s) + log(s / (d + s))
+        #THE FIRST TERM IS ZERO FOR ABSENT TAGS, SO ONLY STORED COUNTS ARE WEIGHTED
+        denominators = np.asarray(denominators, dtype=np.float64)
+        self.logMisses = np.log(smoothing_constant) - np.log(denominators + smoothing_constant)
+
+        weights = counts.astype(np.float64)
+        weights.data = np.log1p(weights.data / smoothing_constant)
+        self.weights = weights.T.tocsr()        #tag x class
+
+
+    def numClasses(self):
+        return len(self.logPriors)
+
+
+    #tag sets scored per batch, so that a batch's dense arrays fit in BATCH_MEMORY_BYTES whatever the class count
+    def batchSize(self):
+        return max(1, BATCH_MEMORY_BYTES // (BATCH_ARRAY_COPIES * 8 * max(1, self.numClasses())))
+
+
+    #builds the query x tag count matrix; tags outside the vocabulary only add to the tag counts
+    def queryMatrix(self, tag_sets):
+        indptr = [0]
+        indices = []
+        lengths = np.zeros(len(tag_sets), dtype=np.float64)
+
+        for ii, tags in enumerate(tag_sets):
+            lengths[ii] = len(tags)
+            for tag in tags:
+                col = self.vocabulary.get(tag)
+                if col is not None:
+                    indices.append(col)
+            indptr.append(len(indices))
+
+        query = sparse.csr_matrix(
+            (np.ones(len(indices)), np.asarray(indices, dtype=np.int32), np.asarray(indptr, dtype=np.int32)),
+            shape=(len(tag_sets), len(self.vocabulary)))
+        query.sum_duplicates()
+        return query, lengths
+
+
+    #returns the (query x class) log posteriors of a batch of tag sets
+    def logPosteriors(self, tag_sets):
+        query, lengths = self.queryMatrix(tag_sets)
+        scores = query.dot(self.weights).toarray()
+        scores += self.logPriors
+        scores += np.outer(lengths, self.logMisses)
+        return scores
+
+
+    #always scored in log space; logSpace is accepted for interface compatibility with NaiveBayesModel
+    def findOptimalClass(self, Given_Tags, return_num, logSpace=True):
+        return self.findOptimalClasses([Given_Tags], return_num)[0]
+
+
+    #scores a batch of tag sets and returns the most likely class(es) for each, in order
+    def findOptimalClasses(self, tag_sets, return_num, logSpace=True):
+        results = []
+        batch_size = self.batchSize()
+        for start in range(0, len(tag_sets), batch_size):
+            results.extend(self.scoreBatch(tag_sets[start:start + batch_size], return_num))
+        return results
+
+
+    def scoreBatch(self, tag_sets, return_num):
+        top, confidences = ScoreRanking.rankLogPosteriors(self.logPosteriors(tag_sets), return_num)
+
+        results = []
+        for ii, tags in enumerate(tag_sets):
+
+            #IGNORE EMPTY TAG SETS
+            if len(tags) == 0:
+                results.append([])
+            else:
+                Metrics.recordScan(self.numClasses())
+                results.append(ScoreRanking.buildCoordinates(top[ii], confidences[ii], self.latitudes, self.longitudes))
+
+        return results
@@ -2,9 +2,13 @@
 # Author: Group 4
 
 #all the imports
-from flask import Flask, request, session, g, redirect, url_for, abort, render_template, flash, jsonify
+from flask import Flask, Response, request, session, g, redirect, url_for, abort, render_template, flash, jsonify
 import CLASSIFIER
+import Metrics
+import ModelServer
 import json
+import threading
+import time
 
 
 #configuration
@@ -12,6 +16,11 @@ DEBUG = True
 SECRET_KEY = 'brian'
 USERNAME = 'admin'
 PASSWORD = 'default'
+MODEL_FILENAME = CLASSIFIER.MODEL_FILENAME    #set by INSTA_PREDICT_MODEL; may be a .bin written by BinaryModel.py
+WORKERS = 0        #forked scoring processes sharing the model; 0 scores on the request thread
+PROFILE_SLOW_REQUESTS = 0      #seconds; requests slower than this get a cProfile dump, 0 turns profiling off
+PROFILE_SAMPLE_RATE = 1.0      #fraction of requests run under the profiler while it is on
+PROFILE_DIR = '/tmp/flaskr-profiles'
 
 
 
@@ -23,6 +32,72 @@ app.config.from_object(__name__)
 app.config.from_envvar('FLASKR_SETTINGS', silent=True)
 
 
+#the model every request scores against; loaded by preload(), which flaskr.wsgi calls before taking traffic
+model = None
+preload_lock = threading.Lock()
+
+profiler = None
+if app.config['PROFILE_SLOW_REQUESTS'] > 0:
+    profiler = Metrics.SlowRequestProfiler(app.config['PROFILE_SLOW_REQUESTS'], app.config['PROFILE_DIR'],
+        app.config['PROFILE_SAMPLE_RATE'])
+
+
+
+#loads and warms the model, then forks the scoring workers from the warm process
+#a server that skips this loads the model on its first request instead
+def preload():
+    global model
+
+    with preload_lock:
+        if model is None:
+            resident = CLASSIFIER.preload(app.config['MODEL_FILENAME'])
+            if app.config['WORKERS'] > 0:
+                model = ModelServer.ModelServer(resident, app.config['WORKERS'])
+            else:
+                model = resident
+    return model
+
+
+#returns the model to score with, following CLASSIFIER's hot-swaps when a new model version is published
+def currentModel():
+    if model is None:
+        preload()
+    resident = CLASSIFIER.getModel(app.config['MODEL_FILENAME'])
+    if isinstance(model, ModelServer.ModelServer):
+        if model.model is not resident:
+            model.swapModel(resident)
+        return model
+    return resident
+
+
+#reports the scoring pool's queue depth on every /metrics scrape
+def collectWorkerMetrics():
+    if isinstance(model, ModelServer.ModelServer):
+        return [('queue_depth', 'gauge', 'Requests waiting on the scoring pool.', [({}, model.stats()['queueDepth'])])]
+    return []
+
+Metrics.registerCollector(collectWorkerMetrics)
+
+
+
+#every request is timed by endpoint, and sampled into the profiler when it is on
+@app.before_request
+def start_request_timer():
+    g.request_start = time.time()
+    g.profile = profiler.start() if profiler is not None else None
+
+
+@app.teardown_request
+def stop_request_timer(exc=None):
+    start = getattr(g, 'request_start', None)
+    if start is None:
+        return
+    elapsed = time.time() - start
+    endpoint = request.endpoint or 'none'
+    Metrics.REQUEST_SECONDS.observe(elapsed, (endpoint,))
+    if profiler is not None:
+        profiler.stop(g.profile, endpoint, elapsed)
+
 
 
 
@@ -45,13 +120,14 @@ def respond_to_request(tags='',count=''):
         Tags = tags.split(',')
 
         #building json object to serialize
-        request = {}
-        request['tags'] = Tags
-        request['count'] = count
-        request = json.dumps(request)
+        with Metrics.timer('build_request'):
+            request = {}
+            request['tags'] = Tags
+            request['count'] = count
+            request = json.dumps(request)
 
         #calling classifier
-        response = CLASSIFIER.webFacingFindOptimalClass(request)
+        response = CLASSIFIER.webFacingFindOptimalClass(request, currentModel())
 
     except Exception as exc:
         response = exc.message
@@ -61,5 +137,60 @@ def respond_to_request(tags='',count=''):
 
 
 
+#batch endpoint: POST a json array of {tags, count, param} requests, get the responses back in order
+@app.route('/predict', methods=['POST'])
+def respond_to_batch_request():
+
+    try:
+        response = CLASSIFIER.webFacingFindOptimalClasses(request.get_data(), currentModel())
+        status = 200
+    except Exception as exc:
+        response = json.dumps({'status': 400, 'error': str(exc)})
+        status = 400
+
+    return Response(response=response, status=status, mimetype='application/json')
+
+
+
+
+@app.route('/workers')
+def worker_stats():
+    if isinstance(model, ModelServer.ModelServer):
+        return jsonify(model.stats())
+    return jsonify(workers=0)
+
+
+
+
+
+#liveness: the process is up and answering, whether or not the model is loaded yet
+@app.route('/health')
+def health():
+    status = CLASSIFIER.status()
+    status['status'] = 'ok'
+    return jsonify(status)
+
+
+#readiness: 200 once the model is resident and warm, 503 until then
+@app.route('/ready')
+def readiness():
+    status = CLASSIFIER.status()
+    status['ready'] = status['ready'] and model is not None
+    response = jsonify(status)
+    response.status_code = 200 if status['ready'] else 503
+    return response
+
+
+
+
+#metrics of this process in the Prometheus text format
+@app.route('/metrics')
+def metrics():
+    return Response(response=Metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+
+
 if __name__ == '__main__':
+    preload()
     app.run(host='0.0.0.0')
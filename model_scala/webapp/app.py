@@ -3,15 +3,28 @@
 # Author: Group 4
 
 from flask import Flask, Response, request, render_template, abort, jsonify
+from contextlib import closing
 import requests
 import argparse
 
 app = Flask(__name__)
 
+# One keep-alive connection pool to the engine for every request.
+engine_session = requests.Session()
+
 @app.route('/')
 def index():
     return render_template('index.html')
 
+def stream_body(upstream):
+    '''Yields the engine's response as it arrives. The WSGI server closes
+    this generator when the client hangs up, which also closes the engine
+    response and returns its connection to the pool.
+    '''
+    with closing(upstream):
+        for chunk in upstream.iter_content(chunk_size=None):
+            yield chunk
+
 @app.route('/api/predict/<string:tags>')
 def predict(tags):
     if 'count' in request.args:
@@ -19,19 +32,33 @@ def predict(tags):
     else:
         params = {}
 
-    req = requests.get(args.engine + tags, params=params)
+    req = engine_session.get(args.engine + tags, params=params, timeout=args.timeout, stream=True)
     if req.status_code != 200:
+        req.close()
         abort(req.status_code)
-    return Response(response=req.content, status=200, mimetype='application/json')
+    return Response(response=stream_body(req), status=200, mimetype='application/json')
 
 def get_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('-e', '--engine', help='Prediction engine connection info.',
         default='http://localhost:8080/predict/')
     parser.add_argument('-b', '--bind', help='Address to bind to.', default='127.0.0.1')
+    parser.add_argument('-p', '--port', type=int, help='Port to listen on.', default=5000)
     parser.add_argument('-d', '--debug', help='Run Flask in debug mode.', action='store_true')
+    parser.add_argument('-g', '--gateway', action='store_true',
+        help='Serve with the asyncio gateway (gateway.py) instead of Flask.')
+    parser.add_argument('-t', '--timeout', type=float, default=10.0,
+        help='Seconds an engine request may take (default 10).')
+    parser.add_argument('--cache-ttl', type=float, default=2.0,
+        help='Seconds the gateway caches an engine response, 0 to disable (default 2).')
+    parser.add_argument('--connections', type=int, default=100,
+        help='Keep-alive connections the gateway holds to the engine (default 100).')
     return parser.parse_args()
 
 if __name__ == '__main__':
     args = get_args()
-    app.run(debug=args.debug, host=args.bind)
+    if args.gateway:
+        import gateway
+        gateway.run(args)
+    else:
+        app.run(debug=args.debug, host=args.bind, port=args.port)
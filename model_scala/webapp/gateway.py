@@ -0,0 +1,208 @@
+# ASU CSE 591
+# Author: Group 4
+
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from urllib.parse import quote
+
+import aiohttp
+from aiohttp import web
+from yarl import URL
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+class ResponseCache:
+    '''Bounded LRU of successful engine responses, each kept for ttl seconds.'''
+    def __init__(self, ttl=2.0, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires, body = entry
+        if expires < time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return body
+
+    def put(self, key, body):
+        if self.ttl <= 0:
+            return
+        self.entries[key] = (time.monotonic() + self.ttl, body)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+class Flight:
+    '''One upstream request, shared by every client that asks the same
+    query while it is in flight. Chunks are kept as they arrive so that
+    clients joining late replay them before following the live stream.
+    '''
+    def __init__(self):
+        self.status = None
+        self.started = asyncio.Event()
+        self.changed = asyncio.Event()
+        self.chunks = []
+        self.done = False
+        self.error = None
+
+    def notify(self):
+        # Waiters hold the old event, so a fresh one is armed for the next change.
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+    def start(self, status):
+        self.status = status
+        self.started.set()
+
+    def publish(self, chunk):
+        self.chunks.append(chunk)
+        self.notify()
+
+    def finish(self, error=None):
+        self.error = error
+        if self.status is None:
+            self.status = 502
+        self.done = True
+        self.started.set()
+        self.notify()
+
+    async def stream(self):
+        '''Yields every chunk of the body, waiting for the ones not yet received.'''
+        index = 0
+        while True:
+            while index < len(self.chunks):
+                yield self.chunks[index]
+                index += 1
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            await self.changed.wait()
+
+class Gateway:
+    '''Async proxy from /api/predict/<tags> to the prediction engine.
+    Responses stream through from one pooled keep-alive session, identical
+    queries in flight at the same time share a single upstream request, and
+    successful responses are cached for a short TTL.
+    '''
+    def __init__(self, engine, cache_ttl=2.0, cache_entries=10000, connections=100, timeout=10.0, retries=2,
+            backoff=0.05):
+        '''engine: Prefix the tags are appended to, e.g. http://localhost:8080/predict/.
+        connections: Keep-alive connections held open to the engine.
+        timeout: Seconds an engine request may take in total.
+        retries: Attempts repeated when the engine cannot be reached; a
+            response that has started is never retried.
+        '''
+        self.engine = engine
+        self.cache = ResponseCache(cache_ttl, cache_entries)
+        self.connections = connections
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.inflight = {}
+        self.session = None
+        self.stats = {'requests': 0, 'cacheHits': 0, 'coalesced': 0, 'upstreamRequests': 0, 'upstreamErrors': 0}
+
+    async def on_startup(self, app):
+        connector = aiohttp.TCPConnector(limit=self.connections, keepalive_timeout=60, ttl_dns_cache=300)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+    async def on_cleanup(self, app):
+        await self.session.close()
+
+    async def predict(self, request):
+        self.stats['requests'] += 1
+        tags = request.match_info['tags']
+        count = request.query.get('count')
+        key = (tags, count)
+
+        body = self.cache.get(key)
+        if body is not None:
+            self.stats['cacheHits'] += 1
+            return web.Response(body=body, content_type='application/json')
+
+        flight = self.inflight.get(key)
+        if flight is None:
+            flight = self.inflight[key] = Flight()
+            # The fetch runs on its own task so a client hanging up does not cancel it for the others.
+            asyncio.ensure_future(self.fetch(key, flight, tags, count))
+        else:
+            self.stats['coalesced'] += 1
+
+        await flight.started.wait()
+        if flight.status != 200:
+            return web.Response(status=flight.status)
+
+        response = web.StreamResponse()
+        response.content_type = 'application/json'
+        await response.prepare(request)
+        async for chunk in flight.stream():
+            await response.write(chunk)
+        await response.write_eof()
+        return response
+
+    def engine_url(self, tags, count):
+        url = URL(self.engine + quote(tags, safe=',+'), encoded=True)
+        if count is not None:
+            url = url.update_query(count=count)
+        return url
+
+    async def fetch(self, key, flight, tags, count):
+        '''Requests a query from the engine and publishes the response to
+        its flight, caching it once it completes with status 200.
+        '''
+        error = None
+        try:
+            for attempt in range(self.retries + 1):
+                try:
+                    self.stats['upstreamRequests'] += 1
+                    async with self.session.get(self.engine_url(tags, count)) as upstream:
+                        flight.start(upstream.status)
+                        if upstream.status == 200:
+                            async for chunk in upstream.content.iter_any():
+                                flight.publish(chunk)
+                    break
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                    if flight.status is not None or attempt == self.retries:
+                        raise
+                    await asyncio.sleep(self.backoff * 2 ** attempt)
+            if flight.status == 200:
+                self.cache.put(key, b''.join(flight.chunks))
+        except Exception as e:
+            self.stats['upstreamErrors'] += 1
+            error = e
+        finally:
+            del self.inflight[key]
+            flight.finish(error)
+
+    async def gateway_stats(self, request):
+        return web.json_response(dict(self.stats, inFlight=len(self.inflight), cached=len(self.cache.entries)))
+
+    async def index(self, request):
+        return web.FileResponse(os.path.join(ROOT, 'templates', 'index.html'))
+
+def make_app(engine, **kwargs):
+    '''Builds the aiohttp application serving the page, its static files
+    and the gateway. kwargs are passed on to Gateway.
+    '''
+    gateway = Gateway(engine, **kwargs)
+    app = web.Application()
+    app['gateway'] = gateway
+    app.on_startup.append(gateway.on_startup)
+    app.on_cleanup.append(gateway.on_cleanup)
+    app.router.add_get('/', gateway.index)
+    app.router.add_get('/api/predict/{tags}', gateway.predict)
+    app.router.add_get('/api/gateway/stats', gateway.gateway_stats)
+    app.router.add_static('/static', os.path.join(ROOT, 'static'))
+    return app
+
+def run(args):
+    app = make_app(args.engine, cache_ttl=args.cache_ttl, connections=args.connections, timeout=args.timeout)
+    web.run_app(app, host=args.bind, port=args.port)
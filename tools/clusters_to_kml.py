@@ -3,11 +3,28 @@
 
 #!/usr/bin/env python
 
-import sys
+import argparse
 import csv
-import random
+import hashlib
+import io
+import math
+import os
+import shutil
+import sys
+import tempfile
+import zipfile
+from collections import OrderedDict
+
+HEADER = """<?xml version="1.0" encoding="UTF-8"?>
+<kml xmlns="http://www.opengis.net/kml/2.2">
+<Document>
+"""
 
-STYLE = """<Style id="random{id}"><IconStyle>
+FOOTER = """</Document>
+</kml>
+"""
+
+STYLE = """<Style id="cluster{id}"><IconStyle>
 <color>{color}</color>
 <Icon><href>http://maps.google.com/mapfiles/kml/shapes/placemark_circle.png</href></Icon>
 </IconStyle></Style>
@@ -15,11 +32,41 @@ STYLE = """<Style id="random{id}"><IconStyle>
 
 PLACEMARK = """<Placemark>
 <description>{tags}</description>
-<styleUrl>#random{id}</styleUrl>
+<styleUrl>#cluster{id}</styleUrl>
 <Point><coordinates>{lon},{lat}</coordinates></Point>
 </Placemark>
 """
 
+CENTROID = """<Placemark>
+<name>{count}</name>
+<description>Cluster {id}: {count} points</description>
+<styleUrl>#cluster{id}</styleUrl>
+<Point><coordinates>{lon:.6f},{lat:.6f}</coordinates></Point>
+</Placemark>
+"""
+
+REGION = """<Region>
+<LatLonAltBox><north>{north}</north><south>{south}</south><east>{east}</east><west>{west}</west></LatLonAltBox>
+<Lod><minLodPixels>{min_pixels}</minLodPixels><maxLodPixels>{max_pixels}</maxLodPixels></Lod>
+</Region>
+"""
+
+NETWORK_LINK = """<NetworkLink>
+<name>{name}</name>
+{region}<Link><href>{href}</href><viewRefreshMode>onRegion</viewRefreshMode></Link>
+</NetworkLink>
+"""
+
+FOLDER_START = """<Folder>
+<name>{name}</name>
+{region}"""
+
+FOLDER_END = """</Folder>
+"""
+
+# Tiles and centroids trade places on screen at this size in pixels.
+LOD_PIXELS = 256
+
 def xml_escape(s):
     return (s.replace('&', '&amp;')
         .replace('"', '&quot;')
@@ -27,36 +74,339 @@ def xml_escape(s):
         .replace('<', '&lt;')
         .replace('>', '&gt;'))
 
-def random_color():
-    return 'ff{0:02x}{1:02x}{2:02x}'.format(
-        random.randint(0, 255),
-        random.randint(0, 255),
-        random.randint(0, 255))
+def cluster_color(cluster):
+    '''Derives a stable color from the cluster ID, so no pass over the
+    input is needed to assign colors and reruns color clusters alike.
+    '''
+    digest = hashlib.md5(cluster.encode('utf-8')).digest()
+    return 'ff{0:02x}{1:02x}{2:02x}'.format(digest[0], digest[1], digest[2])
 
-def main():
-    if len(sys.argv) != 3:
-        print("Usage: ./clusters_to_kml.py INPUTFILE OUTPUTFILE")
+def region(north, south, east, west, min_pixels=-1, max_pixels=-1):
+    return REGION.format(north=north, south=south, east=east, west=west,
+        min_pixels=min_pixels, max_pixels=max_pixels)
+
+def cell_region(cell, size, min_pixels=-1, max_pixels=-1):
+    '''Region bounding the grid cell (row, col) of size degrees.'''
+    south, west = cell[0] * size, cell[1] * size
+    return region(min(90, south + size), south, min(180, west + size), west, min_pixels, max_pixels)
+
+def read_points(path):
+    '''Yields (tags, lat, lon, cluster) for each row of the input CSV.'''
+    with open(path, 'r', encoding='utf-8', newline='') as inf:
+        for line in csv.reader(inf):
+            try:
+                yield line[1], float(line[2]), float(line[3]), line[4]
+            except (IndexError, ValueError):
+                continue
+
+def grid_cell(lat, lon, size):
+    return int(math.floor(lat / size)), int(math.floor(lon / size))
+
+class Thinner:
+    '''Keeps at most max_per_cell points of each cluster in each grid cell
+    of cell_size degrees.
+    '''
+    def __init__(self, cell_size, max_per_cell):
+        self.cell_size = cell_size
+        self.max_per_cell = max_per_cell
+        self.counts = {}
+
+    def keep(self, lat, lon, cluster):
+        key = (cluster,) + grid_cell(lat, lon, self.cell_size)
+        count = self.counts.get(key, 0)
+        if count >= self.max_per_cell:
+            return False
+        self.counts[key] = count + 1
+        return True
+
+class Centroids:
+    '''Aggregates the points of each cluster in each grid cell into one
+    centroid placemark labelled with the number of points.
+    '''
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.cells = {}
+
+    def add(self, lat, lon, cluster):
+        key = (cluster,) + grid_cell(lat, lon, self.cell_size)
+        cell = self.cells.get(key)
+        if cell is None:
+            self.cells[key] = [lat, lon, 1]
+        else:
+            cell[0] += lat
+            cell[1] += lon
+            cell[2] += 1
+
+    def placemarks(self):
+        '''Yields (cluster, lat, lon, count) per cell.'''
+        for (cluster, row, col), (lat_sum, lon_sum, count) in self.cells.items():
+            yield cluster, lat_sum / count, lon_sum / count, count
+
+    def by_tile(self, tile_size):
+        '''Returns {tile: [(cluster, lat, lon, count)]} of the centroids in each tile.'''
+        tiles = {}
+        for placemark in self.placemarks():
+            tiles.setdefault(grid_cell(placemark[1], placemark[2], tile_size), []).append(placemark)
+        return tiles
+
+class SpoolSet:
+    '''Partitions rows into groups in one pass, so every group can
+    afterwards be written out as its own KML file. Rows are kept in memory
+    up to max_buffered in all, then spilled to one temporary CSV per group,
+    each file opened once per spill. Input in no particular order therefore
+    costs a few opens per group rather than one per row.
+    '''
+    def __init__(self, max_buffered=500000):
+        self.dir = tempfile.mkdtemp(prefix='clusters_to_kml')
+        self.max_buffered = max_buffered
+        self.buffered = 0
+        self.buffers = {}
+        self.groups = {}
+        self.spilled = 0
+
+    def append(self, group, row):
+        self.groups.setdefault(group, None)
+        self.buffers.setdefault(group, []).append(row)
+        self.buffered += 1
+        if self.buffered >= self.max_buffered:
+            self.spill()
+
+    def spill(self):
+        for group, rows in self.buffers.items():
+            name = self.groups[group]
+            if name is None:
+                name = self.groups[group] = os.path.join(self.dir, str(self.spilled))
+                self.spilled += 1
+            with open(name, 'a', encoding='utf-8', newline='') as f:
+                csv.writer(f).writerows(rows)
+        self.buffers = {}
+        self.buffered = 0
+
+    def rows(self, group):
+        '''Yields the group's rows in the order they were appended.'''
+        if self.groups[group] is not None:
+            with open(self.groups[group], 'r', encoding='utf-8', newline='') as inf:
+                for row in csv.reader(inf):
+                    yield row
+        for row in self.buffers.get(group, []):
+            yield row
+
+    def close(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+class Output:
+    '''Writes the files of one export either into a KMZ archive or, for
+    plain KML, as the root file plus a <name>_files directory of linked
+    files. Files are written one at a time as streams.
+    '''
+    def __init__(self, path):
+        self.kmz = path.lower().endswith('.kmz')
+        if self.kmz:
+            self.zip = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+            self.root = 'doc.kml'
+        else:
+            self.dir = os.path.dirname(path)
+            self.root = os.path.basename(path)
+            self.files_dir = os.path.splitext(self.root)[0] + '_files'
+
+    def link(self, name):
+        '''The href under which the root document refers to a linked file.'''
+        return name if self.kmz else '{0}/{1}'.format(self.files_dir, name)
+
+    def open(self, name=None):
+        '''Opens the root file (name None) or a linked file for writing.
+        In a KMZ the root must be opened first, since viewers read the first
+        .kml entry as the document.
+        '''
+        if self.kmz:
+            return io.TextIOWrapper(self.zip.open(name or self.root, 'w', force_zip64=True), encoding='utf-8')
+        if name is None:
+            return open(os.path.join(self.dir, self.root), 'w', encoding='utf-8')
+        os.makedirs(os.path.join(self.dir, self.files_dir, os.path.dirname(name)), exist_ok=True)
+        return open(os.path.join(self.dir, self.files_dir, name), 'w', encoding='utf-8')
+
+    def close(self):
+        if self.kmz:
+            self.zip.close()
+
+def write_styles(outf, clusters):
+    for cluster in clusters:
+        outf.write(STYLE.format(id=xml_escape(cluster), color=cluster_color(cluster)))
+
+def write_placemark(outf, tags, lat, lon, cluster):
+    outf.write(PLACEMARK.format(tags=xml_escape(tags), lat=lat, lon=lon, id=xml_escape(cluster)))
+
+def write_centroids(outf, placemarks):
+    for cluster, lat, lon, count in placemarks:
+        outf.write(CENTROID.format(id=xml_escape(cluster), lat=lat, lon=lon, count=count))
+
+def points(args):
+    '''Yields the input points that survive thinning, feeding every point
+    to the centroid aggregation on the way.
+    '''
+    for tags, lat, lon, cluster in read_points(args.input):
+        if args.centroids is not None:
+            args.centroids.add(lat, lon, cluster)
+        if args.thinner is None or args.thinner.keep(lat, lon, cluster):
+            yield tags, lat, lon, cluster
+
+def export_flat(args, output):
+    '''One document. Without centroids it is streamed straight from the
+    input, writing styles the first time a cluster is seen. With centroids
+    the points are spooled by grid cell in one pass, and each cell's points
+    and centroids go in two folders carrying the cell's Region, so a viewer
+    shows a cell's centroids until the cell is large enough on screen and
+    its points from then on.
+    '''
+    if args.centroids is not None:
+        export_flat_cells(args, output)
         return
+    seen = set()
+    with output.open() as outf:
+        outf.write(HEADER)
+        for tags, lat, lon, cluster in points(args):
+            if cluster not in seen:
+                seen.add(cluster)
+                write_styles(outf, [cluster])
+            write_placemark(outf, tags, lat, lon, cluster)
+        outf.write(FOOTER)
+
+def export_flat_cells(args, output):
+    spool = SpoolSet()
+    clusters = set()
+    try:
+        for tags, lat, lon, cluster in points(args):
+            clusters.add(cluster)
+            spool.append(grid_cell(lat, lon, args.cell_size), [tags, lat, lon, cluster])
+
+        with output.open() as outf:
+            outf.write(HEADER)
+            write_styles(outf, sorted(clusters))
+            outf.write(FOLDER_START.format(name='Points', region=''))
+            for cell in sorted(spool.groups):
+                outf.write(FOLDER_START.format(name='Points {0},{1}'.format(cell[0] * args.cell_size,
+                    cell[1] * args.cell_size), region=cell_region(cell, args.cell_size, min_pixels=LOD_PIXELS)))
+                for tags, lat, lon, cluster in spool.rows(cell):
+                    write_placemark(outf, tags, lat, lon, cluster)
+                outf.write(FOLDER_END)
+            outf.write(FOLDER_END)
+            outf.write(FOLDER_START.format(name='Centroids', region=''))
+            # A cell's centroids are means of points inside it, so they lie in the same cell.
+            for cell, placemarks in sorted(args.centroids.by_tile(args.cell_size).items()):
+                outf.write(FOLDER_START.format(name='Centroids {0},{1}'.format(cell[0] * args.cell_size,
+                    cell[1] * args.cell_size), region=cell_region(cell, args.cell_size, max_pixels=LOD_PIXELS)))
+                write_centroids(outf, placemarks)
+                outf.write(FOLDER_END)
+            outf.write(FOLDER_END)
+            outf.write(FOOTER)
+    finally:
+        spool.close()
+
+def export_split(args, output):
+    '''Spools the input by cluster or tile in one pass, then writes a root
+    document of NetworkLinks and one linked file per group. Tile links
+    carry a Region, so a viewer only loads the tiles in view once they are
+    large enough on screen, and shows the tile's centroids until then.
+    Cluster links carry the Region of the cluster's bounding box, so only
+    the clusters in view are loaded.
+    '''
+    spool = SpoolSet()
+    clusters = set()
+    group_clusters = {}
+    bounds = {}
+    try:
+        for tags, lat, lon, cluster in points(args):
+            clusters.add(cluster)
+            if args.split == 'cluster':
+                group = cluster
+                box = bounds.get(group)
+                if box is None:
+                    bounds[group] = [lat, lat, lon, lon]
+                else:
+                    box[0], box[1] = max(box[0], lat), min(box[1], lat)
+                    box[2], box[3] = max(box[2], lon), min(box[3], lon)
+            else:
+                group = grid_cell(lat, lon, args.tile_size)
+                group_clusters.setdefault(group, set()).add(cluster)
+            spool.append(group, [tags, lat, lon, cluster])
+
+        groups = sorted(spool.groups)
+        names = {}
+        for i, group in enumerate(groups):
+            if args.split == 'cluster':
+                names[group] = 'clusters/{0}.kml'.format(i)
+                group_clusters[group] = [group]
+            else:
+                names[group] = 'tiles/{0}_{1}.kml'.format(*group)
+
+        with output.open() as outf:
+            outf.write(HEADER)
+            write_styles(outf, sorted(clusters))
+            for group in groups:
+                if args.split == 'cluster':
+                    link_region = region(*bounds[group])
+                    name = 'Cluster {0}'.format(xml_escape(group))
+                else:
+                    link_region = cell_region(group, args.tile_size, min_pixels=LOD_PIXELS)
+                    name = 'Tile {0},{1}'.format(group[0] * args.tile_size, group[1] * args.tile_size)
+                outf.write(NETWORK_LINK.format(name=name, region=link_region, href=output.link(names[group])))
+            if args.centroids is not None:
+                if args.split == 'cluster':
+                    write_centroids(outf, args.centroids.placemarks())
+                else:
+                    tiles = args.centroids.by_tile(args.tile_size)
+                    for group in groups:
+                        outf.write(FOLDER_START.format(name='Centroids {0},{1}'.format(group[0] * args.tile_size,
+                            group[1] * args.tile_size), region=cell_region(group, args.tile_size, max_pixels=LOD_PIXELS)))
+                        write_centroids(outf, tiles.get(group, []))
+                        outf.write(FOLDER_END)
+            outf.write(FOOTER)
+
+        for group in groups:
+            with output.open(names[group]) as outf:
+                outf.write(HEADER)
+                # Linked files do not share the root's styles.
+                write_styles(outf, sorted(group_clusters[group]))
+                for tags, lat, lon, cluster in spool.rows(group):
+                    write_placemark(outf, tags, lat, lon, cluster)
+                outf.write(FOOTER)
+    finally:
+        spool.close()
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Converts clustered points (CSV rows of id,tags,lat,lon,cluster) to KML or KMZ.')
+    parser.add_argument('input', help='Input CSV file.')
+    parser.add_argument('output', help='Output file; a .kmz extension writes a zipped KMZ.')
+    parser.add_argument('--split', choices=['none', 'cluster', 'tile'], default='none',
+        help='Write one NetworkLinked file per cluster or per tile (default none).')
+    parser.add_argument('--tile-size', type=float, default=10.0,
+        help='Tile size in degrees for --split tile (default 10).')
+    parser.add_argument('--thin', type=int, metavar='N',
+        help='Keep at most N points of each cluster per grid cell.')
+    parser.add_argument('--centroids', action='store_true',
+        help='Add a centroid placemark per cluster and grid cell, shown while zoomed out.')
+    parser.add_argument('--cell-size', type=float, default=1.0,
+        help='Grid cell size in degrees for --thin and --centroids (default 1).')
+    args = parser.parse_args()
+
+    args.thinner = Thinner(args.cell_size, args.thin) if args.thin is not None else None
+    args.centroids = Centroids(args.cell_size) if args.centroids else None
+    return args
+
+def main():
+    args = get_args()
 
     # Generate KML by formatting strings rather than building a DOM
     # in memory with xml.minidom because files may potentially be too
     # large to hold in memory at once.
-    with open(sys.argv[1], 'r') as inf:
-        reader = csv.reader(inf)
-        colorset = set(r[4] for r in reader)
-        colors = { c: random_color() for c in colorset }
-
-    with open(sys.argv[1], 'r') as inf:
-        with open(sys.argv[2], 'w') as outf:
-            outf.write('<kml>\n<Document>\n')
-            for k, v in colors.items():
-                outf.write(STYLE.format(id=k, color=v))
-
-            reader = csv.reader(inf)
-            for line in reader:
-                outf.write(PLACEMARK.format(tags=xml_escape(line[1]),
-                    lat=line[2], lon=line[3], id=line[4]))
-            outf.write('</Document>\n</kml>\n')
+    output = Output(args.output)
+    try:
+        if args.split == 'none':
+            export_flat(args, output)
+        else:
+            export_split(args, output)
+    finally:
+        output.close()
 
 if __name__ == '__main__':
     main()